@@ -32,17 +32,20 @@ __status__ = "beta"
 __docformat__ = 'restructuredtext'
 
 import os
+import json
 import logging
 logger = logging.getLogger("pyFAI.azimuthalIntegrator")
 import tempfile
 import types
 import threading
+import itertools
 import gc
 import numpy
 from numpy import rad2deg, deg2rad, pi
 EPS32 = (1.0 + numpy.finfo(numpy.float32).eps)
 from .geometry import Geometry
 from . import units
+from . import lut_cache
 import fabio
 error = None
 try:
@@ -97,6 +100,44 @@ except ImportError as error:
 del error  # just to see how clever pylint is !
 
 
+def _float32_buffer(out):
+    """
+    @param out: output array provided by the user, or None
+    @return: out if the look-up table and bounding box integrators can write into it directly, else None
+    """
+    if (out is not None) and (out.dtype == numpy.float32):
+        return out
+
+
+def _float64_buffer(out):
+    """
+    @param out: output array provided by the user, or None
+    @return: out if the pixel splitting integrators can write into it directly, else None
+    """
+    if (out is not None) and (out.dtype == numpy.float64):
+        return out
+
+
+# name in Geometry.calc_arrays of the positions of the pixel centers in each radial unit
+_CENTER_ARRAYS = {"twoThetaArray": "tth",
+                  "qArray": "q",
+                  "rArray": "r"}
+
+
+def _as_tuple(value):
+    """
+    Convert recursively lists (as read from json) into tuples
+
+    @param value: list or scalar
+    @return: tuple or scalar
+    """
+    if isinstance(value, list):
+        return tuple(_as_tuple(i) for i in value)
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+
 class AzimuthalIntegrator(Geometry):
     """
     This class is an azimuthal integrator based on P. Boesecke's
@@ -159,16 +200,27 @@ class AzimuthalIntegrator(Geometry):
         self._ocl_sem = threading.Semaphore()
         self._lut_sem = threading.Semaphore()
         self._ocl_lut_sem = threading.Semaphore()
+        self.lut_cache = lut_cache.get_default_cache()
+        self._lut_integrators = lut_cache.IntegratorCache()
 
-    def reset(self):
+    def invalidate(self, *parameters):
         """
-        Reset azimuthal integrator in addition to other arrays.
+        Drop the cached arrays and the integrators depending on any of
+        the given parameters, or all of them if no parameter is given.
+
+        A change of wavelength only drops the look-up tables in q.
         """
-        Geometry.reset(self)
+        Geometry.invalidate(self, *parameters)
+        if parameters and (set(parameters) == set(["wavelength"])):
+            with self._lut_sem:
+                self._lut_integrator = None
+                self._lut_integrators.discard(lambda key: units.to_unit(key[0]).center == "qArray")
+            return
         with self._ocl_sem:
             self._ocl_integrator = None
         with self._lut_sem:
             self._lut_integrator = None
+            self._lut_integrators.clear()
 
     def makeMask(self, data, mask=None,
                  dummy=None, delta_dummy=None, mode="normal"):
@@ -312,6 +364,9 @@ class AzimuthalIntegrator(Geometry):
         The *dark* and the *flat* can be provided to correct the data
         before computing the radial integration.
         """
+        self._calc_integration_arrays(data.shape, units.TTH,
+                                      solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
         mask = self.makeMask(data, mask, dummy, delta_dummy, mode="where")
         tth = self.twoThetaArray(data.shape)[mask]
         data = numpy.ascontiguousarray(data, dtype=numpy.float32)
@@ -373,6 +428,9 @@ class AzimuthalIntegrator(Geometry):
                                    delta_dummy=delta_dummy,
                                    polarization_factor=polarization_factor)
 
+        self._calc_integration_arrays(data.shape, units.TTH,
+                                      solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
         mask = self.makeMask(data, mask, dummy, delta_dummy, mode="where")
         tth = self.twoThetaArray(data.shape)[mask]
         data = numpy.ascontiguousarray(data, dtype=numpy.float32)
@@ -502,6 +560,9 @@ class AzimuthalIntegrator(Geometry):
                                    dark=dark,
                                    flat=flat)
         shape = data.shape
+        self._calc_integration_arrays(shape, units.TTH, chi=(chiRange is not None),
+                                      solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
         if chiRange is not None:
             chi = self.chiArray(shape)
             dchi = self.deltaChi(shape)
@@ -649,7 +710,9 @@ class AzimuthalIntegrator(Geometry):
                                    dark=dark,
                                    flat=flat)
 
-        pos = self.cornerArray(data.shape)
+        self._calc_integration_arrays(data.shape, solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
+        pos = self.vertexArray(data.shape)
         if correctSolidAngle:
             solidangle = self.solidAngleArray(data.shape)
         else:
@@ -877,7 +940,7 @@ class AzimuthalIntegrator(Geometry):
 
     def setup_LUT(self, shape, nbPt, mask=None,
                   pos0_range=None, pos1_range=None, mask_checksum=None,
-                  unit=units.TTH):
+                  unit=units.TTH, csr=False):
         """
         Prepare a look-up-table
 
@@ -895,6 +958,8 @@ class AzimuthalIntegrator(Geometry):
         @type mask_checksum: int (or anything else ...)
         @param unit: use to propagate the LUT object for further checkings
         @type unit: pyFAI.units.Enum
+        @param csr: store the look-up table in compressed sparse row format
+        @type csr: bool
 
         This method is called when a look-up table needs to be set-up.
         The *shape* parameter, correspond to the shape of the original
@@ -921,12 +986,34 @@ class AzimuthalIntegrator(Geometry):
         The *unit* parameter is just propagated to the LUT integrator
         for further checkings: The aim is to prevent an integration to
         be performed in 2th-space when the LUT was setup in q space.
+
+        With *csr*, the look-up table is stored as a compressed sparse
+        row matrix (data, indices, indptr) whose size scales with the
+        number of pixel-bin contributions instead of nbPt*lut_max_size.
+
+        If *lut_cache* is set (or the PYFAI_LUT_CACHE environment
+        variable defines a cache directory), the look-up table is read
+        back from the cache when the same geometry, mask, unit,
+        number of points and ranges were already used, possibly by
+        another process.
         """
 
         if "__len__" in dir(nbPt) and len(nbPt) == 2:
             int2d = True
         else:
             int2d = False
+        cache_key = None
+        if self.lut_cache is not None:
+            if mask is None:
+                mask_checksum = None
+            elif not mask_checksum:
+                mask_checksum = crc32(mask)
+            cache_key = self._lut_cache_key(shape, nbPt, mask_checksum,
+                                            pos0_range, pos1_range, unit, csr)
+            integrator = self.lut_cache.load(cache_key)
+            if integrator is not None:
+                return integrator
+        self._calc_integration_arrays(shape, unit, chi=(pos1_range is not None) or int2d)
         pos0 = self.array_from_unit(shape, "center", unit)
         dpos0 = self.array_from_unit(shape, "delta", unit)
         if (pos1_range is None) and (not int2d):
@@ -952,23 +1039,227 @@ class AzimuthalIntegrator(Geometry):
         else:
             assert mask.shape == shape
         if int2d:
-            return splitBBoxLUT.HistoBBox2d(pos0, dpos0, pos1, dpos1,
-                                            bins=nbPt,
-                                            pos0Range=pos0Range,
-                                            pos1Range=pos1Range,
-                                            mask=mask,
-                                            mask_checksum=mask_checksum,
-                                            allow_pos0_neg=False,
-                                            unit=unit)
+            if csr:
+                HistoBBox = splitBBoxLUT.HistoBBox2dCSR
+            else:
+                HistoBBox = splitBBoxLUT.HistoBBox2d
         else:
-            return splitBBoxLUT.HistoBBox1d(pos0, dpos0, pos1, dpos1,
-                                            bins=nbPt,
-                                            pos0Range=pos0Range,
-                                            pos1Range=pos1Range,
-                                            mask=mask,
-                                            mask_checksum=mask_checksum,
-                                            allow_pos0_neg=False,
-                                            unit=unit)
+            if csr:
+                HistoBBox = splitBBoxLUT.HistoBBox1dCSR
+            else:
+                HistoBBox = splitBBoxLUT.HistoBBox1d
+        integrator = HistoBBox(pos0, dpos0, pos1, dpos1,
+                               bins=nbPt,
+                               pos0Range=pos0Range,
+                               pos1Range=pos1Range,
+                               mask=mask,
+                               mask_checksum=mask_checksum,
+                               allow_pos0_neg=False,
+                               unit=unit)
+        if cache_key is not None:
+            self.lut_cache.save(cache_key, integrator)
+        return integrator
+
+    def _setup_parameters(self):
+        """
+        Parameters the geometry arrays depend on: geometry, detector
+        (including the content of the spline file), position of the chi
+        discontinuity, solid angle correction for the spline, exact solid
+        angle and precision of the arrays.
+
+        @return: dict of parameters
+        """
+        param = self.getPyFAI()
+        spline = param.get("splineFile")
+        if spline and os.path.isfile(spline):
+            param["splineFile"] = lut_cache.file_checksum(spline)
+        param["chiDiscAtPi"] = self.chiDiscAtPi
+        param["correct_SA_spline"] = self._correct_solid_angle_for_spline
+        param["exact_solid_angle"] = self._exact_solid_angle
+        param["dtype"] = numpy.dtype(self._dtype).name
+        return param
+
+    def _lut_cache_key(self, shape, nbPt, mask_checksum, pos0_range, pos1_range, unit, csr=False):
+        """
+        Calculate the key of a look-up table in the persistent cache.
+
+        It depends on the setup (see _setup_parameters), the wavelength
+        for q units, the shape of the data, the mask, the unit, the number
+        of points and the ranges.
+
+        @return: key for LUTCache
+        @rtype: str
+        """
+        unit = units.to_unit(unit)
+        param = self._setup_parameters()
+        if unit.center == "qArray":
+            param["wavelength"] = self._wavelength
+        if "__len__" in dir(nbPt):
+            nbPt = tuple(int(i) for i in nbPt)
+        if "__len__" in dir(pos0_range):
+            pos0_range = tuple(float(i) for i in pos0_range)
+        if "__len__" in dir(pos1_range):
+            pos1_range = tuple(float(i) for i in pos1_range)
+        return lut_cache.LUTCache.key(sorted(param.items()), tuple(shape), nbPt,
+                                      mask_checksum, pos0_range, pos1_range,
+                                      unit.REPR, bool(csr))
+
+    def _get_lut_integrator(self, shape, nbPt, mask=None,
+                            pos0_range=None, pos1_range=None,
+                            unit=units.TTH, csr=False, safe=True):
+        """
+        Retrieve a look-up table integrator from the in-memory cache or
+        build it with setup_LUT.
+
+        Integrators are kept in a LRU cache (self._lut_integrators) keyed on
+        the dimension, unit, number of points, ranges, shape, storage and
+        mask checksum, so alternating between 1D and 2D integrations, or
+        between units or ranges, does not rebuild the look-up tables.
+
+        With *safe* = False the mask checksum is not calculated and the most
+        recently used integrator matching all other parameters is used.
+
+        The _lut_sem is only held while looking up the cache and while
+        building a missing look-up table. An integrator is never modified
+        once built, so several threads can integrate with it concurrently:
+        callers have to use the returned integrator and not
+        self._lut_integrator which may be replaced by another thread.
+
+        @return: look-up table integrator, also stored in self._lut_integrator
+        """
+        if "__len__" in dir(nbPt):
+            nbPt = tuple(int(i) for i in nbPt)
+        if pos0_range is not None:
+            pos0_range = tuple(float(i) for i in pos0_range)
+        if pos1_range is not None:
+            pos1_range = tuple(float(i) for i in pos1_range)
+        partial_key = (unit.REPR, nbPt, pos0_range, pos1_range, tuple(shape), bool(csr))
+        integrator = None
+        if not safe:
+            with self._lut_sem:
+                key, integrator = self._lut_integrators.find(lambda key: key[:-1] == partial_key)
+        if integrator is None:
+            if mask is None:
+                mask = self.detector.mask
+                mask_crc = self.detector._mask_crc
+            else:
+                mask_crc = crc32(mask)
+            key = partial_key + (mask_crc,)
+            with self._lut_sem:
+                integrator = self._lut_integrators.get(key)
+                if integrator is None:
+                    logger.info("AI: Building look-up table for %s points in %s (%s)" %
+                                (nbPt, unit.REPR, self._lut_integrators))
+                    integrator = self.setup_LUT(shape, nbPt, mask, pos0_range, pos1_range,
+                                                mask_checksum=mask_crc, unit=unit, csr=csr)
+                    self._lut_integrators.set(key, integrator)
+        self._lut_integrator = integrator
+        return integrator
+
+    def _export_signature(self):
+        """
+        Everything the cached arrays depend on: the setup (see
+        _setup_parameters) and the wavelength.
+
+        @return: string identifying the setup
+        """
+        param = self._setup_parameters()
+        param["wavelength"] = self._wavelength
+        return repr(sorted(param.items()))
+
+    def export(self, directory):
+        """
+        Publish the cached geometry arrays and look-up table integrators
+        into a directory, ideally on a memory backed file-system like
+        /dev/shm, so that other processes using the same geometry can
+        attach to them instead of recalculating their own copy.
+
+        Only what is already calculated is exported: integrate once (or
+        call the *Array methods) before exporting.
+
+        @param directory: where to write the arrays, created if needed
+        @type directory: str
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        metadata = {"signature": self._export_signature(),
+                    "arrays": [],
+                    "integrators": []}
+        for name in self._CACHE_DEPENDENCIES:
+            value = self.__dict__.get(name)
+            if isinstance(value, numpy.ndarray):
+                numpy.save(os.path.join(directory, name + ".npy"), value)
+                metadata["arrays"].append(name)
+        value = self._dssa_crc
+        if isinstance(value, numpy.generic):
+            value = value.item()
+        metadata["_dssa_crc"] = value
+        polarization = self._polarization
+        if polarization is not None:
+            key, value, crc = polarization
+            numpy.save(os.path.join(directory, "_polarization.npy"), value)
+            metadata["_polarization"] = [key, int(crc)]
+        cache = lut_cache.LUTCache(os.path.join(directory, "lut"))
+        with self._lut_sem:
+            integrators = self._lut_integrators.items()
+        for key, integrator in integrators:
+            digest = cache.key(key)
+            cache.save(digest, integrator)
+            metadata["integrators"].append([key, digest])
+        # written last: a directory without metadata is not attached
+        tmp = os.path.join(directory, ".metadata.json")
+        with open(tmp, "w") as f:
+            json.dump(metadata, f)
+        os.rename(tmp, os.path.join(directory, "metadata.json"))
+        logger.info("AI: exported %s arrays and %s integrators to %s" %
+                    (len(metadata["arrays"]), len(metadata["integrators"]), directory))
+
+    def attach(self, directory):
+        """
+        Use the geometry arrays and look-up table integrators exported
+        by another process (see export) instead of calculating them.
+
+        Arrays are memory-mapped copy-on-write: all processes attached
+        share the same physical pages and nothing is ever written back.
+
+        @param directory: where the arrays were exported
+        @type directory: str
+        @return: True if attached, False if the directory does not contain an export of the same geometry
+        """
+        metafile = os.path.join(directory, "metadata.json")
+        if not os.path.isfile(metafile):
+            logger.warning("AI: nothing to attach in %s" % directory)
+            return False
+        with open(metafile) as f:
+            metadata = json.load(f)
+        if metadata["signature"] != self._export_signature():
+            logger.warning("AI: arrays in %s were exported for another geometry" % directory)
+            return False
+        arrays = {}
+        for name in metadata["arrays"]:
+            arrays[str(name)] = numpy.load(os.path.join(directory, name + ".npy"), mmap_mode="c")
+        cache = lut_cache.LUTCache(os.path.join(directory, "lut"))
+        integrators = []
+        for key, digest in metadata["integrators"]:
+            integrator = cache.load(digest)
+            if integrator is not None:
+                integrators.append((_as_tuple(key), integrator))
+        polarization = metadata.get("_polarization")
+        if polarization is not None:
+            key, crc = polarization
+            polarization = (_as_tuple(key),
+                            numpy.load(os.path.join(directory, "_polarization.npy"), mmap_mode="c"),
+                            crc)
+        with self._sem:
+            self.__dict__.update(arrays)
+            self._dssa_crc = metadata["_dssa_crc"]
+            self._polarization = polarization
+        with self._lut_sem:
+            for key, integrator in integrators:
+                self._lut_integrators.set(key, integrator)
+        logger.info("AI: attached %s arrays and %s integrators from %s" %
+                    (len(arrays), len(integrators), directory))
+        return True
 
     def xrpd_LUT(self, data, nbPt, filename=None, correctSolidAngle=True,
                  tthRange=None, chiRange=None, mask=None,
@@ -1288,7 +1579,7 @@ class AzimuthalIntegrator(Geometry):
         mask_crc = None
         with self._lut_sem:
             reset = None
-            if self._lut_integrator is None:
+            if (self._lut_integrator is None) or ("lut" not in dir(self._lut_integrator)):
                 reset = "init"
                 if tthRange is None:
                     pos0_range = None
@@ -1453,6 +1744,8 @@ class AzimuthalIntegrator(Geometry):
         """
         mask = self.makeMask(data, mask, dummy, delta_dummy, mode="numpy")
         shape = data.shape
+        self._calc_integration_arrays(shape, units.TTH, chi=True,
+                                      solid_angle=correctSolidAngle)
         tth = self.twoThetaArray(shape)[mask]
         chi = self.chiArray(shape)[mask]
         data = data.astype(numpy.float32)[mask]
@@ -1464,7 +1757,7 @@ class AzimuthalIntegrator(Geometry):
             flat = self.flatfield
         if flat is not None:
             data /= flat[mask]
-        if correctSolidAngle is not None:
+        if correctSolidAngle:
             data /= self.solidAngleArray(shape)[mask]
 
         if tthRange is not None:
@@ -1580,6 +1873,8 @@ class AzimuthalIntegrator(Geometry):
 
         mask = self.makeMask(data, mask, dummy, delta_dummy, mode="numpy")
         shape = data.shape
+        self._calc_integration_arrays(shape, units.TTH, chi=True,
+                                      solid_angle=correctSolidAngle)
         tth = self.twoThetaArray(data.shape)[mask]
         chi = self.chiArray(data.shape)[mask]
         data = data.astype(numpy.float32)[mask]
@@ -1591,7 +1886,7 @@ class AzimuthalIntegrator(Geometry):
             flat = self.flatfield
         if flat is not None:
             data /= flat[mask]
-        if correctSolidAngle is not None:
+        if correctSolidAngle:
             data /= self.solidAngleArray(data.shape)[mask]
         if dummy is None:
             dummy = 0.0
@@ -1702,6 +1997,9 @@ class AzimuthalIntegrator(Geometry):
                                         mask=mask,
                                         dummy=dummy,
                                         delta_dummy=delta_dummy)
+        self._calc_integration_arrays(data.shape, units.TTH, chi=True,
+                                      solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
         tth = self.twoThetaArray(data.shape)
         chi = self.chiArray(data.shape)
         dtth = self.delta2Theta(data.shape)
@@ -1845,7 +2143,9 @@ class AzimuthalIntegrator(Geometry):
                 dark=dark,
                 flat=flat)
 
-        pos = self.cornerArray(data.shape)
+        self._calc_integration_arrays(data.shape, solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
+        pos = self.vertexArray(data.shape)
         if correctSolidAngle:
             solidangle = self.solidAngleArray(data.shape)
         else:
@@ -1886,7 +2186,7 @@ class AzimuthalIntegrator(Geometry):
 
         @param shape: shape of the expected array
         @type shape: ndarray.shape
-        @param typ: "center", "corner" or "delta"
+        @param typ: "center", "corner", "vertex" or "delta"
         @type typ: str
         @param unit: can be Q, TTH, R for now
         @type unit: pyFAI.units.Enum
@@ -1894,7 +2194,7 @@ class AzimuthalIntegrator(Geometry):
         @return: R, Q or 2Theta array depending on unit
         @rtype: ndarray
         """
-        if not typ in ("center", "corner", "delta"):
+        if not typ in ("center", "corner", "vertex", "delta"):
             logger.warning("Unknown type of array %s,"
                            " defaulting to 'center'" % typ)
             typ = "center"
@@ -1902,13 +2202,60 @@ class AzimuthalIntegrator(Geometry):
         out = Geometry.__dict__[unit[typ]](self, shape)
         return out
 
+    def _calc_integration_arrays(self, shape, unit=None, chi=False,
+                                 solid_angle=False, polarization=False):
+        """
+        Calculate in a single pass (see calc_arrays) the cached arrays an
+        integration needs, instead of filling the caches one by one.
+
+        @param shape: shape of the image
+        @param unit: radial unit of which the pixel center positions are needed, or None
+        @param chi: if True, the azimuthal angle is needed
+        @param solid_angle: if True, the solid angle is needed
+        @param polarization: if True, the polarization correction is needed (2theta and chi)
+        """
+        names = set()
+        if unit is not None:
+            names.add(_CENTER_ARRAYS[units.to_unit(unit).center])
+        if chi or polarization:
+            names.add("chi")
+        if polarization:
+            names.add("tth")
+        if solid_angle:
+            names.add("dssa")
+        if names:
+            self.calc_arrays(shape, *sorted(names))
+
+    def _preprocess(self, data, dark=None, flat=None, polarization=None, solidangle=None):
+        """
+        Apply the dark, flat, polarization and solid angle corrections in
+        a single pass over the image, without temporary arrays.
+
+        @return: corrected image (float32), same shape as data
+        """
+        if splitBBoxLUT is None:
+            data = numpy.array(data, dtype=numpy.float32)
+            if dark is not None:
+                data -= dark
+            if flat is not None:
+                data /= flat
+            if polarization is not None:
+                data /= polarization
+            if solidangle is not None:
+                data /= solidangle
+            return data
+        return splitBBoxLUT.preprocess(data, dark=dark, flat=flat,
+                                       solidAngle=solidangle,
+                                       polarization=polarization).reshape(data.shape)
+
     def integrate1d(self, data, nbPt, filename=None,
                     correctSolidAngle=True,
                     variance=None, error_model=None,
                     radial_range=None, azimuth_range=None,
                     mask=None, dummy=None, delta_dummy=None,
                     polarization_factor=None, dark=None, flat=None,
-                    method="lut", unit=units.Q, safe=True):
+                    method="lut", unit=units.Q, safe=True,
+                    out=None, out_sigma=None):
         """
         Calculate the azimuthal integrated Saxs curve in q(nm^-1) by
         default
@@ -1943,12 +2290,17 @@ class AzimuthalIntegrator(Geometry):
         @type dark: ndarray
         @param flat: flat field image
         @type flat: ndarray
-        @param method: can be "numpy", "cython", "BBox" or "splitpixel", "lut", "lut_ocl" if you want to go on GPU, ....
+        @param method: can be "numpy", "cython", "BBox" or "splitpixel", "lut", "csr", "lut_ocl" if you want to go on GPU, ....
+                       "lut_fused" or "csr_fused" apply the corrections within the look-up table product.
         @type method: str
         @param unit: can be Q, TTh, R for now
         @type unit: pyFAI.units.Enum
         @param safe: Do some extra checks to ensure LUT is still valid. False is faster.
         @type safe: bool
+        @param out: array of size nbPt receiving the intensity. With the "lut", "csr" and "bbox" methods a float32 buffer, with "splitpixel" a float64 one, is filled directly, without any temporary array
+        @type out: ndarray
+        @param out_sigma: array of size nbPt receiving the error, if any
+        @type out_sigma: ndarray
 
         @return: azimuthaly regrouped data, 2theta pos. and chi pos.
         @rtype: 3-tuple of ndarrays
@@ -1968,6 +2320,14 @@ class AzimuthalIntegrator(Geometry):
             error_model = error_model.lower()
             if error_model == "poisson":
                 variance = numpy.ascontiguousarray(data, numpy.float32)
+        if error_model == "azimuthal":
+            variance = None  # calculated from the integrated signal
+        # positions are read from the look-up table or from the vertices for these methods
+        need_center = not (("lut" in method) or ("csr" in method) or ("splitpix" in method))
+        self._calc_integration_arrays(shape, unit if need_center else None,
+                                      chi=(azimuth_range is not None),
+                                      solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
         if azimuth_range is not None:
             azimuth_range = tuple([numpy.deg2rad(i) for i in azimuth_range])
             chi = self.chiArray(shape)
@@ -1979,9 +2339,9 @@ class AzimuthalIntegrator(Geometry):
         else:
             solidangle = None
         if polarization_factor is None:
-            polarization = None
+            polarization = polarization_crc = None
         else:
-            polarization = self.polarization(shape, float(polarization_factor))
+            _, polarization, polarization_crc = self._get_polarization(shape, polarization_factor)
 
         if dark is None:
             dark = self.darkcurrent
@@ -1991,127 +2351,83 @@ class AzimuthalIntegrator(Geometry):
         I = None
         sigma = None
 
-        if (I is None) and ("lut" in method):
-            mask_crc = None
-            with self._lut_sem:
-                reset = None
-                if self._lut_integrator is None:
-                    reset = "init"
-                    if mask is None:
-                        mask = self.detector.mask
-                        mask_crc = self.detector._mask_crc
-                    else:
-                        mask_crc = crc32(mask)
-                if (not reset) and safe:
-                    if mask is None:
-                        mask = self.detector.mask
-                        mask_crc = self.detector._mask_crc
-                    else:
-                        mask_crc = crc32(mask)
-                    if self._lut_integrator.unit != unit:
-                        reset = "unit changed"
-                    if self._lut_integrator.bins != nbPt:
-                        reset = "number of points changed"
-                    if self._lut_integrator.size != data.size:
-                        reset = "input image size changed"
-                    if (mask is not None) and\
-                            (not self._lut_integrator.check_mask):
-                        reset = "mask but LUT was without mask"
-                    elif (mask is None) and (self._lut_integrator.check_mask):
-                        reset = "no mask but LUT has mask"
-                    elif (mask is not None) and\
-                            (self._lut_integrator.mask_checksum != mask_crc):
-                        reset = "mask changed"
-                    if (radial_range is None) and\
-                            (self._lut_integrator.pos0Range is not None):
-                        reset = "radial_range was defined in LUT"
-                    elif (radial_range is not None) and\
-                            (self._lut_integrator.pos0Range !=
-                             (min(radial_range), max(radial_range) * EPS32)):
-                        reset = ("radial_range is defined"
-                                 " but not the same as in LUT")
-                    if (azimuth_range is None) and\
-                            (self._lut_integrator.pos1Range is not None):
-                        reset = ("azimuth_range not defined and"
-                                 " LUT had azimuth_range defined")
-                    elif (azimuth_range is not None) and\
-                            (self._lut_integrator.pos1Range !=
-                             (min(azimuth_range), max(azimuth_range) * EPS32)):
-                        reset = ("azimuth_range requested and"
-                                 " LUT's azimuth_range don't match")
+        if (I is None) and (("lut" in method) or ("csr" in method)):
+            csr = ("csr" in method)
+            try:
+                integrator = self._get_lut_integrator(shape, nbPt, mask,
+                                                      radial_range, azimuth_range,
+                                                      unit=unit, csr=csr, safe=safe)
                 error = False
-                if reset:
-                    logger.info("AI.integrate1d: Resetting integrator because %s" % reset)
-                    try:
-                        self._lut_integrator = self.setup_LUT(shape, nbPt, mask,
-                                                              radial_range, azimuth_range,
-                                                              mask_checksum=mask_crc, unit=unit)
-                        error = False
-                    except MemoryError:  # LUT method is hungry...
-                        logger.warning("MemoryError: falling back on forward implementation")
-                        self._ocl_lut_integr = None
-                        gc.collect()
-                        method = "splitbbox"
-                        error = True
-                if not error:
-                    if ("ocl" in method) and ocl_azim_lut:
-                        with self._ocl_lut_sem:
-                            if "," in method:
-                                c = method.index(",")
-                                platformid = int(method[c - 1])
-                                deviceid = int(method[c + 1])
-                                devicetype = "all"
-                            elif "gpu" in method:
-                                platformid = None
-                                deviceid = None
-                                devicetype = "gpu"
-                            elif "cpu" in method:
-                                platformid = None
-                                deviceid = None
-                                devicetype = "cpu"
-                            else:
-                                platformid = None
-                                deviceid = None
-                                devicetype = "all"
-                            if (self._ocl_lut_integr is None) or\
-                                    (self._ocl_lut_integr.on_device["lut"] != self._lut_integrator.lut_checksum):
-                                self._ocl_lut_integr = ocl_azim_lut.OCL_LUT_Integrator(self._lut_integrator.lut,
-                                                                                       self._lut_integrator.size,
-                                                                                       devicetype=devicetype,
-                                                                                       platformid=platformid,
-                                                                                       deviceid=deviceid,
-                                                                                       checksum=self._lut_integrator.lut_checksum)
-                            I, _, _ = self._ocl_lut_integr.integrate(data, dark=dark, flat=flat,
-                                                                     solidAngle=solidangle,
-                                                                     solidAngle_checksum=self._dssa_crc,
-                                                                     dummy=dummy,
-                                                                     delta_dummy=delta_dummy,
-                                                                     polarization=polarization,
-                                                                     polarization_checksum=self._polarization_crc)
-                            qAxis = self._lut_integrator.outPos  # this will be copied later
-                            if error_model == "azimuthal":
-                                variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
-                            if variance is not None:
-                                var1d, a, b = self._ocl_lut_integr.integrate(variance,
-                                                                             solidAngle=None,
-                                                                             dummy=dummy,
-                                                                             delta_dummy=delta_dummy)
-                                sigma = numpy.sqrt(a) / numpy.maximum(b, 1)
-                    else:
-                        qAxis, I, a, b = self._lut_integrator.integrate(data, dark=dark, flat=flat,
-                                                           solidAngle=solidangle,
-                                                           dummy=dummy,
-                                                           delta_dummy=delta_dummy,
-                                                           polarization=polarization)
-
+            except MemoryError:  # LUT method is hungry...
+                logger.warning("MemoryError: falling back on forward implementation")
+                self._ocl_lut_integr = None
+                gc.collect()
+                method = "splitbbox"
+                error = True
+            if not error:
+                if ("ocl" in method) and ocl_azim_lut and not csr:
+                    with self._ocl_lut_sem:
+                        if "," in method:
+                            c = method.index(",")
+                            platformid = int(method[c - 1])
+                            deviceid = int(method[c + 1])
+                            devicetype = "all"
+                        elif "gpu" in method:
+                            platformid = None
+                            deviceid = None
+                            devicetype = "gpu"
+                        elif "cpu" in method:
+                            platformid = None
+                            deviceid = None
+                            devicetype = "cpu"
+                        else:
+                            platformid = None
+                            deviceid = None
+                            devicetype = "all"
+                        if (self._ocl_lut_integr is None) or\
+                                (self._ocl_lut_integr.on_device["lut"] != integrator.lut_checksum):
+                            self._ocl_lut_integr = ocl_azim_lut.OCL_LUT_Integrator(integrator.lut,
+                                                                                   integrator.size,
+                                                                                   devicetype=devicetype,
+                                                                                   platformid=platformid,
+                                                                                   deviceid=deviceid,
+                                                                                   checksum=integrator.lut_checksum)
+                        I, _, _ = self._ocl_lut_integr.integrate(data, dark=dark, flat=flat,
+                                                                 solidAngle=solidangle,
+                                                                 solidAngle_checksum=self._dssa_crc,
+                                                                 dummy=dummy,
+                                                                 delta_dummy=delta_dummy,
+                                                                 polarization=polarization,
+                                                                 polarization_checksum=polarization_crc)
+                        qAxis = integrator.outPos  # this will be copied later
                         if error_model == "azimuthal":
                             variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
                         if variance is not None:
-                            _, var1d, a, b = self._lut_integrator.integrate(variance,
-                                                               solidAngle=None,
-                                                               dummy=dummy,
-                                                               delta_dummy=delta_dummy)
+                            var1d, a, b = self._ocl_lut_integr.integrate(variance,
+                                                                         solidAngle=None,
+                                                                         dummy=dummy,
+                                                                         delta_dummy=delta_dummy)
                             sigma = numpy.sqrt(a) / numpy.maximum(b, 1)
+                else:
+                    # signal, variance and normalization in a single pass
+                    res = integrator.integrate(data, dark=dark, flat=flat,
+                                               solidAngle=solidangle,
+                                               dummy=dummy,
+                                               delta_dummy=delta_dummy,
+                                               polarization=polarization,
+                                               fused=("fused" in method),
+                                               variance=variance,
+                                               out=_float32_buffer(out))
+                    qAxis, I, a, b = res[:4]
+                    if variance is not None:
+                        sigma = numpy.sqrt(res[4]) / numpy.maximum(b, 1)
+                    elif error_model == "azimuthal":
+                        variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
+                        _, var1d, a, b = integrator.integrate(variance,
+                                                              solidAngle=None,
+                                                              dummy=dummy,
+                                                              delta_dummy=delta_dummy)
+                        sigma = numpy.sqrt(a) / numpy.maximum(b, 1)
 
         if (I is None) and ("splitpix" in method):
             if splitPixel is None:
@@ -2120,23 +2436,27 @@ class AzimuthalIntegrator(Geometry):
                 method = "bbox"
             else:
                 logger.debug("integrate1d uses SplitPixel implementation")
-                pos = self.array_from_unit(shape, "corner", unit)
-                qAxis, I, a, b = splitPixel.fullSplit1D(pos=pos,
-                                                        weights=data,
-                                                        bins=nbPt,
-                                                        pos0Range=radial_range,
-                                                        pos1Range=azimuth_range,
-                                                        dummy=dummy,
-                                                        delta_dummy=delta_dummy,
-                                                        mask=mask,
-                                                        dark=dark,
-                                                        flat=flat,
-                                                        solidangle=solidangle,
-                                                        polarization=polarization
-                                                        )
-                if error_model == "azimuthal":
-                    variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
+                pos = self.array_from_unit(shape, "vertex", unit)
+                res = splitPixel.fullSplit1D(pos=pos,
+                                             weights=data,
+                                             bins=nbPt,
+                                             pos0Range=radial_range,
+                                             pos1Range=azimuth_range,
+                                             dummy=dummy,
+                                             delta_dummy=delta_dummy,
+                                             mask=mask,
+                                             dark=dark,
+                                             flat=flat,
+                                             solidangle=solidangle,
+                                             polarization=polarization,
+                                             variance=variance,
+                                             out=_float64_buffer(out)
+                                             )
+                qAxis, I, a, b = res[:4]
                 if variance is not None:
+                    sigma = numpy.sqrt(res[4]) / numpy.maximum(b, 1)
+                elif error_model == "azimuthal":
+                    variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
                     _, var1d, a, b = splitPixel.fullSplit1D(pos=pos,
                                                             weights=variance,
                                                             bins=nbPt,
@@ -2162,24 +2482,28 @@ class AzimuthalIntegrator(Geometry):
                     dchi = None
                 pos0 = self.array_from_unit(shape, "center", unit)
                 dpos0 = self.array_from_unit(shape, "delta", unit)
-                qAxis, I, a, b = splitBBox.histoBBox1d(weights=data,
-                                                       pos0=pos0,
-                                                       delta_pos0=dpos0,
-                                                       pos1=chi,
-                                                       delta_pos1=dchi,
-                                                       bins=nbPt,
-                                                       pos0Range=radial_range,
-                                                       pos1Range=azimuth_range,
-                                                       dummy=dummy,
-                                                       delta_dummy=delta_dummy,
-                                                       mask=mask,
-                                                       dark=dark,
-                                                       flat=flat,
-                                                       solidangle=solidangle,
-                                                       polarization=polarization)
-                if error_model == "azimuthal":
-                    variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
+                res = splitBBox.histoBBox1d(weights=data,
+                                            pos0=pos0,
+                                            delta_pos0=dpos0,
+                                            pos1=chi,
+                                            delta_pos1=dchi,
+                                            bins=nbPt,
+                                            pos0Range=radial_range,
+                                            pos1Range=azimuth_range,
+                                            dummy=dummy,
+                                            delta_dummy=delta_dummy,
+                                            mask=mask,
+                                            dark=dark,
+                                            flat=flat,
+                                            solidangle=solidangle,
+                                            polarization=polarization,
+                                            variance=variance,
+                                            out=_float32_buffer(out))
+                qAxis, I, a, b = res[:4]
                 if variance is not None:
+                    sigma = numpy.sqrt(res[4]) / numpy.maximum(b, 1)
+                elif error_model == "azimuthal":
+                    variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
                     _, var1d, a, b = splitBBox.histoBBox1d(weights=variance,
                                                            pos0=pos0,
                                                            delta_pos0=dpos0,
@@ -2216,14 +2540,7 @@ class AzimuthalIntegrator(Geometry):
                 pos0 = pos0[mask]
                 if variance is not None:
                     variance = variance[mask]
-                if dark is not None:
-                    data -= dark
-                if flat is not None:
-                    data /= flat
-                if polarization is not None:
-                    data /= polarization
-                if solidangle is not None:
-                    data /= solidangle
+                data = self._preprocess(data, dark, flat, polarization, solidangle)
                 data = data[mask]
                 if dummy is None:
                     dummy = 0
@@ -2256,14 +2573,7 @@ class AzimuthalIntegrator(Geometry):
                 mask *= (chi >= chiMin) * (chi <= chiMax)
             mask = numpy.where(mask)
             pos0 = pos0[mask]
-            if dark is not None:
-                data -= dark
-            if flat is not None:
-                data /= flat
-            if polarization is not None:
-                data /= polarization
-            if solidangle is not None:
-                data /= solidangle
+            data = self._preprocess(data, dark, flat, polarization, solidangle)
             data = data[mask]
             if variance is not None:
                 variance = variance[mask]
@@ -2281,6 +2591,12 @@ class AzimuthalIntegrator(Geometry):
             I = val / count
         if pos0_scale:
             qAxis = qAxis * pos0_scale
+        if (out is not None) and (I is not out):
+            out[...] = I
+            I = out
+        if (out_sigma is not None) and (sigma is not None):
+            out_sigma[...] = sigma
+            sigma = out_sigma
         if filename:
             self.save1D(filename, qAxis, I, sigma, unit, dark, flat, polarization_factor)
         if sigma is not None:
@@ -2288,12 +2604,151 @@ class AzimuthalIntegrator(Geometry):
         else:
             return qAxis, I
 
+    def integrate1d_stack(self, frames, nbPt, correctSolidAngle=True,
+                          radial_range=None, azimuth_range=None,
+                          mask=None, dummy=None, delta_dummy=None,
+                          polarization_factor=None, dark=None, flat=None,
+                          method="lut", unit=units.Q, safe=True, block_size=16,
+                          out=None):
+        """
+        Calculate the azimuthal integrated curves of a stack of frames
+        sharing the same geometry, mask and corrections.
+
+        With the "lut" and "csr" methods, the look-up table and the correction
+        arrays are retrieved once and the look-up table is applied to blocks
+        of *block_size* frames as a sparse matrix - dense matrix product,
+        which is much faster than calling integrate1d on each frame.
+        Other methods are processed frame by frame with integrate1d.
+
+        @param frames: 3D array (nframes, ny, nx) or an iterable over 2D images
+        @type frames: ndarray
+        @param nbPt: number of points in the output pattern
+        @type nbPt: int
+        @param correctSolidAngle: correct for solid angle of each pixel if True
+        @type correctSolidAngle: bool
+        @param radial_range: The lower and upper range of the radial unit. If not provided, range is simply (data.min(), data.max()). Values outside the range are ignored.
+        @type radial_range: (float, float), optional
+        @param azimuth_range: The lower and upper range of the azimuthal angle in degree. If not provided, range is simply (data.min(), data.max()). Values outside the range are ignored.
+        @type azimuth_range: (float, float), optional
+        @param mask: array (same size as image) with 1 for masked pixels, and 0 for valid pixels
+        @type mask: ndarray
+        @param dummy: value for dead/masked pixels
+        @type dummy: float
+        @param delta_dummy: precision for dummy value
+        @type delta_dummy: float
+        @param polarization_factor: polarization factor between -1 and +1. 0 for no correction
+        @type polarization_factor: float
+        @param dark: dark noise image
+        @type dark: ndarray
+        @param flat: flat field image
+        @type flat: ndarray
+        @param method: "lut" or "csr" for the stacked integration, else any method of integrate1d
+        @type method: str
+        @param unit: can be Q, TTh, R for now
+        @type unit: pyFAI.units.Enum
+        @param safe: Do some extra checks to ensure LUT is still valid. False is faster.
+        @type safe: bool
+        @param block_size: number of frames integrated together
+        @type block_size: int
+        @param out: array of shape (nframes, nbPt) receiving the curves, e.g. a memory-mapped array. A float32 buffer is filled in place, block by block
+        @type out: ndarray
+
+        @return: radial positions and azimuthaly regrouped data of shape (nframes, nbPt)
+        @rtype: 2-tuple of ndarrays
+        """
+        method = method.lower()
+        unit = units.to_unit(unit)
+        frames = iter(frames)
+        blocks = iter(lambda: list(itertools.islice(frames, block_size)), [])
+        block = next(blocks, None)
+        if block is None:
+            raise RuntimeError("No frame to integrate")
+        shape = block[0].shape
+
+        integrator = None
+        if (("lut" in method) or ("csr" in method)) and ("ocl" not in method):
+            if radial_range:
+                pos0_range = tuple([i / unit.scale for i in radial_range])
+            else:
+                pos0_range = None
+            if azimuth_range is not None:
+                pos1_range = tuple([numpy.deg2rad(i) for i in azimuth_range])
+            else:
+                pos1_range = None
+            if mask is None:
+                mask = self.mask
+            try:
+                integrator = self._get_lut_integrator(shape, nbPt, mask,
+                                                      pos0_range, pos1_range,
+                                                      unit=unit, csr=("csr" in method),
+                                                      safe=safe)
+            except MemoryError:  # LUT method is hungry...
+                logger.warning("MemoryError: falling back on frame by frame integration")
+                gc.collect()
+
+        result = []
+        start = 0
+        if integrator is None:
+            for block in itertools.chain([block], blocks):
+                for data in block:
+                    qAxis, I = self.integrate1d(data, nbPt,
+                                                correctSolidAngle=correctSolidAngle,
+                                                radial_range=radial_range,
+                                                azimuth_range=azimuth_range,
+                                                mask=mask, dummy=dummy,
+                                                delta_dummy=delta_dummy,
+                                                polarization_factor=polarization_factor,
+                                                dark=dark, flat=flat,
+                                                method=method, unit=unit, safe=safe,
+                                                out=None if out is None else out[start])
+                    start += 1
+                    result.append(I)
+            if out is not None:
+                return qAxis, out
+            return qAxis, numpy.array(result)
+
+        self._calc_integration_arrays(shape, solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
+        if correctSolidAngle:
+            solidangle = self.solidAngleArray(shape)
+        else:
+            solidangle = None
+        if polarization_factor is None:
+            polarization = None
+        else:
+            polarization = self.polarization(shape, float(polarization_factor))
+        if dark is None:
+            dark = self.darkcurrent
+        if flat is None:
+            flat = self.flatfield
+
+        for block in itertools.chain([block], blocks):
+            stop = start + len(block)
+            if out is None:
+                block_out = None
+            else:
+                block_out = _float32_buffer(out[start:stop])
+            qAxis, I, _, _ = integrator.integrate_stack(block, dark=dark, flat=flat,
+                                                        solidAngle=solidangle,
+                                                        dummy=dummy,
+                                                        delta_dummy=delta_dummy,
+                                                        polarization=polarization,
+                                                        out=block_out)
+            if out is None:
+                result.append(I)
+            elif block_out is None:
+                out[start:stop] = I
+            start = stop
+        if out is not None:
+            return qAxis * unit.scale, out
+        return qAxis * unit.scale, numpy.concatenate(result)
+
     def integrate2d(self, data, nbPt_rad, nbPt_azim=360,
                     filename=None, correctSolidAngle=True, variance=None,
                     error_model=None, radial_range=None, azimuth_range=None,
                     mask=None, dummy=None, delta_dummy=None,
                     polarization_factor=None, dark=None, flat=None,
-                    method="bbox", unit=units.Q, safe=True):
+                    method="bbox", unit=units.Q, safe=True, out=None, out_sigma=None):
         """
         Calculate the azimuthal regrouped 2d image in q(nm^-1)/deg by default
 
@@ -2329,12 +2784,17 @@ class AzimuthalIntegrator(Geometry):
         @type dark: ndarray
         @param flat: flat field image
         @type flat: ndarray
-        @param method: can be "numpy", "cython", "BBox" or "splitpixel", "lut", "lut_ocl" if you want to go on GPU, ....
+        @param method: can be "numpy", "cython", "BBox" or "splitpixel", "lut", "csr", "lut_ocl" if you want to go on GPU, ....
+                       "lut_fused" or "csr_fused" apply the corrections within the look-up table product.
         @type method: str
         @param unit: can be Q, TTH, R for now
         @type unit: pyFAI.units.Enum
         @param safe: Do some extra checks to ensure LUT is still valid. False is faster.
         @type safe: bool
+        @param out: array of shape (nbPt_azim, nbPt_rad) receiving the image. With the "lut", "csr" and "bbox" methods a float32 buffer, with "splitpixel" a float64 one, is filled directly, without any temporary array
+        @type out: ndarray
+        @param out_sigma: array of shape (nbPt_azim, nbPt_rad) receiving the error, if any
+        @type out_sigma: ndarray
 
         @return: azimuthaly regrouped data, 2theta pos. and chi pos.
         @rtype: 3-tuple of ndarrays (2d, 1d, 1d)
@@ -2356,15 +2816,21 @@ class AzimuthalIntegrator(Geometry):
                 variance = numpy.ascontiguousarray(data, numpy.float32)
         if azimuth_range is not None:
             azimuth_range = tuple([numpy.deg2rad(i) for i in azimuth_range])
+        # positions are read from the look-up table or from the vertices for these methods
+        need_center = not (("lut" in method) or ("csr" in method) or ("splitpix" in method))
+        self._calc_integration_arrays(shape, unit if need_center else None,
+                                      chi=need_center,
+                                      solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
 
         if correctSolidAngle:
             solidangle = self.solidAngleArray(shape)
         else:
             solidangle = None
         if polarization_factor is None:
-            polarization = None
+            polarization = polarization_crc = None
         else:
-            polarization = self.polarization(shape, polarization_factor)
+            _, polarization, polarization_crc = self._get_polarization(shape, polarization_factor)
 
         if dark is None:
             dark = self.darkcurrent
@@ -2374,105 +2840,76 @@ class AzimuthalIntegrator(Geometry):
         I = None
         sigma = None
 
-        if (I is None) and ("lut" in method):
+        if (I is None) and (("lut" in method) or ("csr" in method)):
             logger.debug("in lut")
-            mask_crc = None
-            with self._lut_sem:
-                reset = None
-                if self._lut_integrator is None:
-                    reset = "init"
-                    if mask is None:
-                        mask = self.detector.mask
-                        mask_crc = self.detector._mask_crc
-                    else:
-                        mask_crc = crc32(mask)
-                if (not reset) and safe:
-                    if mask is None:
-                        mask = self.detector.mask
-                        mask_crc = self.detector._mask_crc
-                    else:
-                        mask_crc = crc32(mask)
-                    if self._lut_integrator.unit != unit:
-                        reset = "unit changed"
-                    if self._lut_integrator.bins != nbPt:
-                        reset = "number of points changed"
-                    if self._lut_integrator.size != data.size:
-                        reset = "input image size changed"
-                    if (mask is not None) and (not self._lut_integrator.check_mask):
-                        reset = "mask but LUT was without mask"
-                    elif (mask is None) and (self._lut_integrator.check_mask):
-                        reset = "no mask but LUT has mask"
-                    elif (mask is not None) and (self._lut_integrator.mask_checksum != mask_crc):
-                        reset = "mask changed"
-                    if (radial_range is None) and (self._lut_integrator.pos0Range is not None):
-                        reset = "radial_range was defined in LUT"
-                    elif (radial_range is not None) and self._lut_integrator.pos0Range != (min(radial_range), max(radial_range) * EPS32):
-                        reset = "radial_range is defined but not the same as in LUT"
-                    if (azimuth_range is None) and (self._lut_integrator.pos1Range is not None):
-                        reset = "azimuth_range not defined and LUT had azimuth_range defined"
-                    elif (azimuth_range is not None) and self._lut_integrator.pos1Range != (min(azimuth_range), max(azimuth_range) * EPS32):
-                        reset = "azimuth_range requested and LUT's azimuth_range don't match"
+            csr = ("csr" in method)
+            try:
+                integrator = self._get_lut_integrator(shape, nbPt, mask,
+                                                      radial_range, azimuth_range,
+                                                      unit=unit, csr=csr, safe=safe)
                 error = False
-                if reset:
-                    logger.info("AI.integrate2d: Resetting integrator because %s" % reset)
-                    try:
-                        self._lut_integrator = self.setup_LUT(shape, nbPt, mask, radial_range, azimuth_range, mask_checksum=mask_crc, unit=unit)
-                        error = False
-                    except MemoryError:  # LUT method is hungry...
-                        logger.warning("MemoryError: falling back on forward implementation")
-                        self._ocl_lut_integr = None
-                        gc.collect()
-                        method = "splitbbox"
-                        error = True
-                if not error:  # not yet implemented...
-                    if  ("ocl" in method) and ocl_azim_lut:
-                        with self._ocl_lut_sem:
-                            if "," in method:
-                                c = method.index(",")
-                                platformid = int(method[c - 1])
-                                deviceid = int(method[c + 1])
-                                devicetype = "all"
-                            elif "gpu" in method:
-                                platformid = None
-                                deviceid = None
-                                devicetype = "gpu"
-                            elif "cpu" in method:
-                                platformid = None
-                                deviceid = None
-                                devicetype = "cpu"
-                            else:
-                                platformid = None
-                                deviceid = None
-                                devicetype = "all"
-                            if (self._ocl_lut_integr is None) or (self._ocl_lut_integr.on_device["lut"] != self._lut_integrator.lut_checksum):
-                                self._ocl_lut_integr = ocl_azim_lut.OCL_LUT_Integrator(self._lut_integrator.lut,
-                                                                                       self._lut_integrator.size,
-                                                                                       devicetype=devicetype,
-                                                                                       platformid=platformid,
-                                                                                       deviceid=deviceid,
-                                                                                       checksum=self._lut_integrator.lut_checksum)
-                            I, _, _ = self._ocl_lut_integr.integrate(data, dark=dark, flat=flat,
-                                                                     solidAngle=solidangle,
-                                                                     solidAngle_checksum=self._dssa_crc,
-                                                                     dummy=dummy,
-                                                                     delta_dummy=delta_dummy,
-                                                                     polarization=polarization,
-                                                                     polarization_checksum=self._polarization_crc)
-                            I.shape = nbPt
-                            I = I.T
-                            bins_rad = self._lut_integrator.outPos0  # this will be copied later
-                            bins_azim = self._lut_integrator.outPos1
+            except MemoryError:  # LUT method is hungry...
+                logger.warning("MemoryError: falling back on forward implementation")
+                self._ocl_lut_integr = None
+                gc.collect()
+                method = "splitbbox"
+                error = True
+            if not error:  # not yet implemented...
+                if  ("ocl" in method) and ocl_azim_lut and not csr:
+                    with self._ocl_lut_sem:
+                        if "," in method:
+                            c = method.index(",")
+                            platformid = int(method[c - 1])
+                            deviceid = int(method[c + 1])
+                            devicetype = "all"
+                        elif "gpu" in method:
+                            platformid = None
+                            deviceid = None
+                            devicetype = "gpu"
+                        elif "cpu" in method:
+                            platformid = None
+                            deviceid = None
+                            devicetype = "cpu"
+                        else:
+                            platformid = None
+                            deviceid = None
+                            devicetype = "all"
+                        if (self._ocl_lut_integr is None) or (self._ocl_lut_integr.on_device["lut"] != integrator.lut_checksum):
+                            self._ocl_lut_integr = ocl_azim_lut.OCL_LUT_Integrator(integrator.lut,
+                                                                                   integrator.size,
+                                                                                   devicetype=devicetype,
+                                                                                   platformid=platformid,
+                                                                                   deviceid=deviceid,
+                                                                                   checksum=integrator.lut_checksum)
+                        I, _, _ = self._ocl_lut_integr.integrate(data, dark=dark, flat=flat,
+                                                                 solidAngle=solidangle,
+                                                                 solidAngle_checksum=self._dssa_crc,
+                                                                 dummy=dummy,
+                                                                 delta_dummy=delta_dummy,
+                                                                 polarization=polarization,
+                                                                 polarization_checksum=polarization_crc)
+                        I.shape = nbPt
+                        I = I.T
+                        bins_rad = integrator.outPos0  # this will be copied later
+                        bins_azim = integrator.outPos1
 #                            if error_model == "azimuthal":
 #                                variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
 #                            if variance is not None:
 #                                var1d, a, b = self._ocl_lut_integr.integrate(variance, solidAngle=None, dummy=dummy, delta_dummy=delta_dummy)
 #                                sigma = numpy.sqrt(a) / numpy.maximum(b, 1)
-                    else:
-                        I, bins_rad, bins_azim, _, _ = self._lut_integrator.integrate(data, dark=dark, flat=flat,
-                                                                                      solidAngle=solidangle,
-                                                                                      dummy=dummy,
-                                                                                      delta_dummy=delta_dummy,
-                                                                                      polarization=polarization)
+                else:
+                    # signal, variance and normalization in a single pass
+                    res = integrator.integrate(data, dark=dark, flat=flat,
+                                               solidAngle=solidangle,
+                                               dummy=dummy,
+                                               delta_dummy=delta_dummy,
+                                               polarization=polarization,
+                                               fused=("fused" in method),
+                                               variance=variance,
+                                               out=_float32_buffer(out))
+                    I, bins_rad, bins_azim, _, b = res[:5]
+                    if variance is not None:
+                        sigma = numpy.sqrt(res[5]) / numpy.maximum(b, 1)
 
 #                        if error_model == "azimuthal":
 #                            variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
@@ -2487,7 +2924,7 @@ class AzimuthalIntegrator(Geometry):
                 method = "bbox"
             else:
                 logger.debug("integrate2d uses SplitPixel implementation")
-                pos = self.array_from_unit(shape, "corner", unit)
+                pos = self.array_from_unit(shape, "vertex", unit)
                 I, bins_rad, bins_azim, _, _ = splitPixel.fullSplit2D(pos=pos,
                                                                       weights=data,
                                                                       bins=(nbPt_rad, nbPt_azim),
@@ -2499,7 +2936,8 @@ class AzimuthalIntegrator(Geometry):
                                                                       dark=dark,
                                                                       flat=flat,
                                                                       solidangle=solidangle,
-                                                                      polarization=polarization)
+                                                                      polarization=polarization,
+                                                                      out=_float64_buffer(out))
 #                if error_model == "azimuthal":
 #                    variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
 #                if variance is not None:
@@ -2539,7 +2977,8 @@ class AzimuthalIntegrator(Geometry):
                                                                       dark=dark,
                                                                       flat=flat,
                                                                       solidangle=solidangle,
-                                                                      polarization=polarization)
+                                                                      polarization=polarization,
+                                                                      out=_float32_buffer(out))
 #                if error_model == "azimuthal":
 #                    variance = (data - self.calcfrom1d(qAxis * pos0_scale, I, dim1_unit=unit)) ** 2
 #                if variance is not None:
@@ -2577,14 +3016,7 @@ class AzimuthalIntegrator(Geometry):
                     mask *= (pos1 <= max(azimuth_range))
                 if variance is not None:
                     variance = variance[mask]
-                if dark is not None:
-                    data -= dark
-                if flat is not None:
-                    data /= flat
-                if polarization is not None:
-                    data /= polarization
-                if solidangle is not None:
-                    data /= solidangle
+                data = self._preprocess(data, dark, flat, polarization, solidangle)
                 data = data[mask]
                 pos0 = pos0[mask]
                 pos1 = pos1[mask]
@@ -2610,14 +3042,7 @@ class AzimuthalIntegrator(Geometry):
             logger.debug("integrate2d uses Numpy implementation")
             data = numpy.ascontiguousarray(data, dtype=numpy.float32)
             mask = self.makeMask(data, mask, dummy, delta_dummy, mode="numpy")
-            if dark is not None:
-                data -= dark
-            if flat is not None:
-                data /= flat
-            if polarization is not None:
-                data /= polarization
-            if solidangle is not None:
-                data /= solidangle
+            data = self._preprocess(data, dark, flat, polarization, solidangle)
             pos0 = self.array_from_unit(shape, "center", unit)
             pos1 = self.chiArray(shape)
             if radial_range is not None:
@@ -2650,6 +3075,12 @@ class AzimuthalIntegrator(Geometry):
         # I know I make copies ....
         bins_rad = bins_rad * pos0_scale
         bins_azim = bins_azim * 180.0 / pi
+        if (out is not None) and (I is not out):
+            out[...] = I
+            I = out
+        if (out_sigma is not None) and (sigma is not None):
+            out_sigma[...] = sigma
+            sigma = out_sigma
         if filename:
             self.save2D(filename, I, bins_rad, bins_azim, sigma, unit, dark=dark, flat=flat, polarization_factor=polarization_factor)
         if sigma is not None:
@@ -2657,6 +3088,147 @@ class AzimuthalIntegrator(Geometry):
         else:
             return I, bins_rad, bins_azim
 
+    def integrate2d_stack(self, frames, nbPt_rad, nbPt_azim=360,
+                          correctSolidAngle=True,
+                          radial_range=None, azimuth_range=None,
+                          mask=None, dummy=None, delta_dummy=None,
+                          polarization_factor=None, dark=None, flat=None,
+                          method="lut", unit=units.Q, safe=True, block_size=16,
+                          out=None):
+        """
+        Calculate the azimuthal regrouped 2d images of a stack of frames
+        sharing the same geometry, mask and corrections.
+
+        With the "lut" and "csr" methods, the look-up table and the correction
+        arrays are retrieved once and the look-up table is applied to blocks
+        of *block_size* frames as a sparse matrix - dense matrix product.
+        Other methods are processed frame by frame with integrate2d.
+
+        @param frames: 3D array (nframes, ny, nx) or an iterable over 2D images
+        @type frames: ndarray
+        @param nbPt_rad: number of points in the radial direction
+        @type nbPt_rad: int
+        @param nbPt_azim: number of points in the azimuthal direction
+        @type nbPt_azim: int
+        @param correctSolidAngle: correct for solid angle of each pixel if True
+        @type correctSolidAngle: bool
+        @param radial_range: The lower and upper range of the radial unit. If not provided, range is simply (data.min(), data.max()). Values outside the range are ignored.
+        @type radial_range: (float, float), optional
+        @param azimuth_range: The lower and upper range of the azimuthal angle in degree. If not provided, range is simply (data.min(), data.max()). Values outside the range are ignored.
+        @type azimuth_range: (float, float), optional
+        @param mask: array (same size as image) with 1 for masked pixels, and 0 for valid pixels
+        @type mask: ndarray
+        @param dummy: value for dead/masked pixels
+        @type dummy: float
+        @param delta_dummy: precision for dummy value
+        @type delta_dummy: float
+        @param polarization_factor: polarization factor between -1 and +1. 0 for no correction
+        @type polarization_factor: float
+        @param dark: dark noise image
+        @type dark: ndarray
+        @param flat: flat field image
+        @type flat: ndarray
+        @param method: "lut" or "csr" for the stacked integration, else any method of integrate2d
+        @type method: str
+        @param unit: can be Q, TTH, R for now
+        @type unit: pyFAI.units.Enum
+        @param safe: Do some extra checks to ensure LUT is still valid. False is faster.
+        @type safe: bool
+        @param block_size: number of frames integrated together
+        @type block_size: int
+        @param out: array of shape (nframes, nbPt_azim, nbPt_rad) receiving the images. A float32 buffer is filled in place, block by block
+        @type out: ndarray
+
+        @return: azimuthaly regrouped data of shape (nframes, nbPt_azim, nbPt_rad), radial and chi positions
+        @rtype: 3-tuple of ndarrays (3d, 1d, 1d)
+        """
+        method = method.lower()
+        unit = units.to_unit(unit)
+        frames = iter(frames)
+        blocks = iter(lambda: list(itertools.islice(frames, block_size)), [])
+        block = next(blocks, None)
+        if block is None:
+            raise RuntimeError("No frame to integrate")
+        shape = block[0].shape
+
+        integrator = None
+        if (("lut" in method) or ("csr" in method)) and ("ocl" not in method):
+            if radial_range:
+                pos0_range = tuple([i / unit.scale for i in radial_range])
+            else:
+                pos0_range = None
+            if azimuth_range is not None:
+                pos1_range = tuple([numpy.deg2rad(i) for i in azimuth_range])
+            else:
+                pos1_range = None
+            if mask is None:
+                mask = self.mask
+            try:
+                integrator = self._get_lut_integrator(shape, (nbPt_rad, nbPt_azim), mask,
+                                                      pos0_range, pos1_range,
+                                                      unit=unit, csr=("csr" in method),
+                                                      safe=safe)
+            except MemoryError:  # LUT method is hungry...
+                logger.warning("MemoryError: falling back on frame by frame integration")
+                gc.collect()
+
+        result = []
+        start = 0
+        if integrator is None:
+            for block in itertools.chain([block], blocks):
+                for data in block:
+                    I, bins_rad, bins_azim = self.integrate2d(data, nbPt_rad, nbPt_azim,
+                                                              correctSolidAngle=correctSolidAngle,
+                                                              radial_range=radial_range,
+                                                              azimuth_range=azimuth_range,
+                                                              mask=mask, dummy=dummy,
+                                                              delta_dummy=delta_dummy,
+                                                              polarization_factor=polarization_factor,
+                                                              dark=dark, flat=flat,
+                                                              method=method, unit=unit, safe=safe,
+                                                              out=None if out is None else out[start])[:3]
+                    start += 1
+                    result.append(I)
+            if out is not None:
+                return out, bins_rad, bins_azim
+            return numpy.array(result), bins_rad, bins_azim
+
+        self._calc_integration_arrays(shape, solid_angle=correctSolidAngle,
+                                      polarization=(polarization_factor is not None))
+        if correctSolidAngle:
+            solidangle = self.solidAngleArray(shape)
+        else:
+            solidangle = None
+        if polarization_factor is None:
+            polarization = None
+        else:
+            polarization = self.polarization(shape, float(polarization_factor))
+        if dark is None:
+            dark = self.darkcurrent
+        if flat is None:
+            flat = self.flatfield
+
+        for block in itertools.chain([block], blocks):
+            stop = start + len(block)
+            if out is None:
+                block_out = None
+            else:
+                block_out = _float32_buffer(out[start:stop])
+            I, bins_rad, bins_azim, _, _ = integrator.integrate_stack(block, dark=dark, flat=flat,
+                                                                      solidAngle=solidangle,
+                                                                      dummy=dummy,
+                                                                      delta_dummy=delta_dummy,
+                                                                      polarization=polarization,
+                                                                      out=block_out)
+            if out is None:
+                result.append(I)
+            elif block_out is None:
+                out[start:stop] = I
+            start = stop
+        if out is not None:
+            return out, bins_rad * unit.scale, bins_azim * 180.0 / pi
+        return numpy.concatenate(result), bins_rad * unit.scale, bins_azim * 180.0 / pi
+
     def saxs(self, data, nbPt, filename=None,
              correctSolidAngle=True, variance=None,
              error_model=None, qRange=None, chiRange=None,
@@ -342,6 +342,7 @@ decrease the value if arcs are mixed together.""", default=None)
             self.geoRef.del_ttha()
             self.geoRef.del_dssa()
             self.geoRef.del_chia()
+            self.geoRef.calc_arrays(self.peakPicker.shape, "tth", "chi", "dssa")
 #            t0 = time.time()
             tth = self.geoRef.twoThetaArray(self.peakPicker.shape)
 #            t1 = time.time()
@@ -791,6 +792,7 @@ class Recalibration(object):
             self.geoRef.del_ttha()
             self.geoRef.del_dssa()
             self.geoRef.del_chia()
+            self.geoRef.calc_arrays(self.peakPicker.shape, "tth", "chi", "dssa")
 #            t0 = time.time()
             tth = self.geoRef.twoThetaArray(self.peakPicker.shape)
 #            t1 = time.time()
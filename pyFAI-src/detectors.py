@@ -32,6 +32,7 @@ __date__ = "29/11/2012"
 __status__ = "stable"
 
 import os
+import hashlib
 import logging
 import threading
 import numpy
@@ -77,7 +78,7 @@ class Detector(object):
         self._maskfile = None
         self._splineFile = None
         self.spline = None
-        self._splineCache = {}  # key=(dx,xpoints,ypoints) value: ndarray
+        self._splineCache = {}  # key=(size, crc of ypoints, crc of xpoints) value: (dX, dY)
         self._sem = threading.Semaphore()
         if splineFile:
             self.set_splineFile(splineFile)
@@ -215,20 +216,13 @@ class Detector(object):
             dY = 0.
         else:
             if d2.ndim == 1:
-                keyX = ("dX", tuple(d1), tuple(d2))
-                keyY = ("dY", tuple(d1), tuple(d2))
-                if keyX not in self._splineCache:
-                    self._splineCache[keyX] = \
-                        numpy.array([self.spline.splineFuncX(i2, i1)
-                                     for i1, i2 in zip(d1 + 0.5, d2 + 0.5)],
-                                    dtype="float64")
-                if keyY not in self._splineCache:
-                    self._splineCache[keyY] = \
-                        numpy.array([self.spline.splineFuncY(i2, i1)
-                                     for i1, i2 in zip(d1 + 0.5, d2 + 0.5)],
-                                    dtype="float64")
-                dX = self._splineCache[keyX]
-                dY = self._splineCache[keyY]
+                c1 = numpy.ascontiguousarray(d1 + 0.5, dtype=numpy.float64)
+                c2 = numpy.ascontiguousarray(d2 + 0.5, dtype=numpy.float64)
+                key = (c1.size, hashlib.sha1(c1.tostring() + c2.tostring()).hexdigest())
+                if key not in self._splineCache:
+                    self._splineCache[key] = (self.spline.splineFuncXPoints(c2, c1),
+                                              self.spline.splineFuncYPoints(c2, c1))
+                dX, dY = self._splineCache[key]
             else:
                 dX = self.spline.splineFuncX(d2 + 0.5, d1 + 0.5)
                 dY = self.spline.splineFuncY(d2 + 0.5, d1 + 0.5)
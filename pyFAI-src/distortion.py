@@ -46,10 +46,14 @@ class Distortion(object):
     This class applies a distortion correction on an image.
 
     """
-    def __init__(self, detector="detector", shape=None):
+    def __init__(self, detector="detector", shape=None, engine="cpu"):
         """
         @param detector: detector instance or detector name
+        @param engine: "cpu" to apply the look-up table with numpy or "ocl" to use OpenCL
         """
+        if engine not in ("cpu", "ocl"):
+            raise ValueError("engine has to be 'cpu' or 'ocl', not %s" % engine)
+        self.engine = engine
         if type(detector) in types.StringTypes:
             self.detector = detectors.detector_factory(detector)
         else:  # we assume it is a Detector instance
@@ -113,27 +117,8 @@ class Distortion(object):
                     pos0max = (numpy.ceil(pos[:, :, :, 0].max(axis= -1)).astype(numpy.int32) + 1).clip(0, self.shape[0])
                     pos1max = (numpy.ceil(pos[:, :, :, 1].max(axis= -1)).astype(numpy.int32) + 1).clip(0, self.shape[1])
                     lut_size = numpy.zeros(self.shape, dtype=numpy.int32)
-                    max0 = 0
-                    max1 = 0
-                    print "pos0min"
-                    print pos0min
-                    print "pos1min"
-                    print pos1min
-                    print "pos0max"
-                    print pos0max
-                    print "pos1max"
-                    print pos1max
                     for i in range(self.shape[0]):
                         for j in range(self.shape[1]):
-                            if (pos0max[i, j] - pos0min[i, j]) > max0:
-                                old = max0
-                                max0 = pos0max[i, j] - pos0min[i, j]
-                                print old, "new max0", max0, i, j
-                            if (pos1max[i, j] - pos1min[i, j]) > max1:
-                                old = max1
-                                max1 = pos1max[i, j] - pos1min[i, j]
-                                print old, "new max1", max1, i, j
-
                             lut_size[pos0min[i, j]:pos0max[i, j], pos1min[i, j]:pos1max[i, j]] += 1
                     self.lut_size = lut_size.max()
                     return lut_size
@@ -148,11 +133,10 @@ class Distortion(object):
                     lut = numpy.recarray(shape=(self.shape[0] , self.shape[1], self.lut_size), dtype=[("idx", numpy.uint32), ("coef", numpy.float32)])
                     lut[:, :, :].idx = 0
                     lut[:, :, :].coef = 0.0
-                    print "LUT shape", lut.shape
+                    logger.info("LUT shape: %s" % (lut.shape,))
                     outMax = numpy.zeros(self.shape, dtype=numpy.uint32)
                     idx = 0
                     buffer = numpy.empty((self.delta0, self.delta1))
-                    print "Buffer shape: ", buffer.shape
                     quad = Quad(buffer)
                     for i in range(self.shape[0]):
                         for j in range(self.shape[1]):
@@ -197,9 +181,13 @@ class Distortion(object):
         @param image: 2D-array with the image
         @return: corrected 2D image
         """
+        if self.LUT is None:
+            self.calc_LUT()
+        if self.engine == "cpu":
+            out = (image.ravel()[self.LUT.idx] * self.LUT.coef).sum(axis= -1).astype(numpy.float32)
+            out.shape = self.shape
+            return out
         if self.integrator is None:
-            if self.LUT is None:
-                self.calc_LUT()
             self.integrator = ocl_azim_lut.OCL_LUT_Integrator(self.LUT, self.shape[0] * self.shape[1])
         out = self.integrator.integrate(image)
         out[1].shape = self.shape
@@ -213,24 +201,17 @@ class Distortion(object):
         @param image: 2D-array with the image
         @return: uncorrected 2D image and a mask (pixels in raw image
         """
+        if image.size != self.shape[0] * self.shape[1]:
+            raise ValueError("image of shape %s does not match a detector of shape %s" % (image.shape, self.shape))
         if self.LUT is None:
             self.calc_LUT()
-        out = numpy.zeros(self.shape,dtype=numpy.float32)
-        mask = numpy.zeros(self.shape, dtype=numpy.int8)
-        lmask = mask.ravel()
-        lout = out.ravel()
-        lin = image.ravel()
         tot = self.LUT.coef.sum(axis= -1)
-        for idx in range(self.LUT.shape[0]):
-            t = tot[idx]
-            if t <= 0:
-                lmask[idx] = 1
-                continue
-            val = lin[idx]/t
-            lout[self.LUT[idx].idx] += val * self.LUT[idx].coef
-#            lout[]
-
-
+        mask = (tot <= 0).astype(numpy.int8)
+        mask.shape = self.shape
+        valid = self.LUT.coef > 0
+        weights = (image.ravel() / numpy.where(tot > 0, tot, 1))[:, None] * self.LUT.coef
+        out = numpy.bincount(self.LUT.idx[valid], weights=weights[valid], minlength=tot.size).astype(numpy.float32)
+        out.shape = self.shape
         return out, mask
 
 
@@ -546,6 +527,7 @@ try:
 except ImportError:
     logger.warning("Import _distortion cython implementation failed ... pure python version is terribly slow !!!")
 else:
+    # the parallel Cython implementation is the production one
     logger.debug(" ".join(dir(pyFAI._distortion)))
     Quad = pyFAI._distortion.Quad
     Distortion = pyFAI._distortion.Distortion
@@ -37,6 +37,7 @@ import threading
 import logging
 import types
 import numpy
+from collections import OrderedDict
 
 from numpy import radians, degrees, arccos, arctan2, sin, cos, sqrt
 from pyFAI import detectors
@@ -53,6 +54,51 @@ except ImportError:
 from . import units
 
 
+def _expandVertices(vertices):
+    """
+    Expand a (ny+1, nx+1, 2) vertex grid into the (ny, nx, 4, 2) layout
+    with the 4 corners of every pixel
+
+    @param vertices: (radial, chi) at the vertices of the pixel grid
+    @return: 4d array of shape (ny, nx, 4, 2), float32
+    """
+    if _geometry:
+        return _geometry.calc_corners(vertices[:, :, 0], vertices[:, :, 1])
+    corners = numpy.empty((vertices.shape[0] - 1, vertices.shape[1] - 1, 4, 2),
+                          dtype=numpy.float32)
+    corners[:, :, 0] = vertices[:-1, :-1]
+    corners[:, :, 1] = vertices[1:, :-1]
+    corners[:, :, 2] = vertices[1:, 1:]
+    corners[:, :, 3] = vertices[:-1, 1:]
+    return corners
+
+
+def _maxCornerDelta(vertices, center, period=None):
+    """
+    Max distance between the center of every pixel and any of its corners
+
+    @param vertices: (ny+1, nx+1) values at the vertices of the pixel grid
+    @param center: (ny, nx) values at the center of the pixels
+    @param period: period of the values, like 2pi for chi, or None
+    @return: 2d array of shape (ny, nx), float32
+    """
+    if _geometry:
+        return _geometry.calc_delta(vertices, center, period or 0)
+    delta = None
+    for corner in (vertices[:-1, :-1], vertices[1:, :-1],
+                   vertices[1:, 1:], vertices[:-1, 1:]):
+        if period:
+            dist = numpy.minimum((corner - center) % period,
+                                 (center - corner) % period)
+        else:
+            dist = abs(corner - center)
+        if delta is None:
+            delta = dist.astype(numpy.float32)
+        else:
+            numpy.maximum(delta, dist, out=delta)
+    return delta
+
+
 class Geometry(object):
     """
     This class is an azimuthal integrator based on P. Boesecke's geometry and
@@ -165,6 +211,38 @@ class Geometry(object):
                             d2*(cos(rot1)*cos(rot3) + sin(rot1)*sin(rot2)*sin(rot3)))
 
     """
+    # parameters each cached array depends on, see invalidate.
+    # The solid angle does not depend on the rotations, only q depends
+    # on the wavelength and only chi on the position of its discontinuity.
+    _POSITION = ("dist", "poni1", "poni2", "rot1", "rot2", "rot3")
+    _CACHE_DEPENDENCIES = {"_ttha": _POSITION,
+                           "_dttha": _POSITION,
+                           "_dssa": ("dist", "poni1", "poni2", "correct_SA_spline", "exact_solid_angle"),
+                           "_chia": _POSITION + ("chiDiscAtPi",),
+                           "_dchia": _POSITION,
+                           "_qa": _POSITION + ("wavelength",),
+                           "_dqa": _POSITION + ("wavelength",),
+                           "_ra": _POSITION,
+                           "_dra": _POSITION,
+                           "_vertexa": _POSITION,
+                           "_vertexqa": _POSITION + ("wavelength",),
+                           "_vertexra": _POSITION,
+                           "_polarization": _POSITION,
+                           "_polarization_ab": _POSITION,
+                           "_polarizations": _POSITION,
+                           }
+    # name of the cache of each quantity calculated by calc_arrays
+    _ARRAYS = {"tth": "_ttha",
+               "chi": "_chia",
+               "q": "_qa",
+               "r": "_ra",
+               "dssa": "_dssa"}
+    # name of the cached vertex grid of each radial quantity
+    _VERTICES = {"tth": "_vertexa",
+                 "q": "_vertexqa",
+                 "r": "_vertexra"}
+    # number of polarization arrays (and factor independent pairs) kept
+    _POLARIZATION_CACHE_SIZE = 4
 
     def __init__(self, dist=1, poni1=0, poni2=0, rot1=0, rot2=0, rot3=0,
                  pixel1=None, pixel2=None, splineFile=None, detector=None, wavelength=None):
@@ -198,17 +276,18 @@ class Geometry(object):
         self._dqa = None
         self._ra = None
         self._dra = None
-        self._corner4Da = None
-        self._corner4Dqa = None
-        self._corner4Dra = None
+        self._vertexa = None  # (2theta, chi) at the vertices of the pixels
+        self._vertexqa = None
+        self._vertexra = None
         self._wavelength = wavelength
         self._oversampling = None
         self._correct_solid_angle_for_spline = True
+        self._exact_solid_angle = False  # solid angle of the whole rectangular pixel, opt-in
+        self._dtype = numpy.float32  # precision of the cached arrays
         self._sem = threading.Semaphore()
-        self._polarization_factor = 0
-        self._polarization_axis_offset = 0
-        self._polarization = None
-        self._polarization_crc = None  # checksum associated with _polarization
+        self._polarization = None  # ((shape, factor, axis_offset), array, checksum) of the last call
+        self._polarization_ab = None  # (shape, axis_offset) -> (A, B) arrays
+        self._polarizations = None  # (shape, factor, axis_offset) -> (key, array, checksum)
 
         if detector:
             if type(detector) in types.StringTypes:
@@ -372,16 +451,92 @@ class Geometry(object):
             out = directDist * numpy.tan(self.tth(d1=d1, d2=d2, param=param))
         return out
 
+    def calc_arrays(self, shape, *names):
+        """
+        Calculate the cached arrays of the given shape for the quantities
+        among "tth", "chi", "q", "r" and "dssa" (solid angle) which are
+        not yet available, in a single pass over the pixels.
+
+        Calling this method with all the quantities needed by an
+        integration is cheaper than filling the caches one by one: the
+        pixel positions and the rotation are calculated only once.
+
+        @param shape: shape of the detector array
+        @param names: quantities to calculate, "tth", "chi" and "dssa" by default
+        """
+        if not names:
+            names = ("tth", "chi", "dssa")
+        for name in names:
+            if name not in self._ARRAYS:
+                raise KeyError("Unknown quantity %s" % name)
+        if ("q" in names) and not self.wavelength:
+            raise RuntimeError(("Scattering vector q cannot be calculated"
+                                " without knowing wavelength !!!"))
+        with self._sem:
+            missing = [name for name in names
+                       if self.__dict__[self._ARRAYS[name]] is None]
+            if not missing:
+                return
+            d1, d2 = numpy.mgrid[:shape[0], :shape[1]].astype(numpy.float32)
+            p1, p2 = self._calcCartesianPositions(d1, d2)
+            if _geometry:
+                quantities = [name for name in missing if name != "dssa"]
+                if quantities:
+                    arrays = _geometry.calc_all(L=self._dist,
+                                                rot1=self._rot1,
+                                                rot2=self._rot2,
+                                                rot3=self._rot3,
+                                                pos1=p1,
+                                                pos2=p2,
+                                                quantities=quantities,
+                                                wavelength=self._wavelength,
+                                                dtype=self._dtype)
+                else:
+                    arrays = {}
+                if "dssa" in missing:
+                    area = self._pixelArea(d1, d2)
+                    if self._exact_solid_angle:
+                        pixel1, pixel2 = self.detector.pixel1, self.detector.pixel2
+                    else:
+                        pixel1 = pixel2 = None
+                    arrays["dssa"] = _geometry.calc_solid_angle(L=self._dist,
+                                                                pos1=p1,
+                                                                pos2=p2,
+                                                                pixel1=pixel1,
+                                                                pixel2=pixel2,
+                                                                area=None if numpy.isscalar(area) else area,
+                                                                dtype=self._dtype)
+                for value in arrays.values():
+                    value.shape = p1.shape
+            else:
+                arrays = {}
+                if ("tth" in missing) or ("q" in missing) or ("r" in missing):
+                    tth = self.tth(d1, d2, path="tan")
+                    arrays["tth"] = tth
+                    if "q" in missing:
+                        arrays["q"] = 4.0e-9 * numpy.pi / self._wavelength * numpy.sin(tth / 2.0)
+                    if "r" in missing:
+                        arrays["r"] = self._dist / (cos(self._rot1) * cos(self._rot2)) * numpy.tan(tth)
+                if "chi" in missing:
+                    arrays["chi"] = self.chi(d1, d2, path="tan")
+                if "dssa" in missing:
+                    arrays["dssa"] = self.diffSolidAngle(d1, d2)
+                for name in arrays:
+                    arrays[name] = arrays[name].astype(self._dtype)
+            if "chi" in missing and not self.chiDiscAtPi:
+                arrays["chi"] = arrays["chi"] % (2 * numpy.pi)
+            if "dssa" in missing:
+                self._dssa_crc = crc32(arrays["dssa"])
+            for name in missing:
+                self.__dict__[self._ARRAYS[name]] = arrays[name]
+
     def qArray(self, shape):
         """
         Generate an array of the given shape with q(i,j) for all
         elements.
         """
         if self._qa is None:
-            with self._sem:
-                if self._qa is None:
-                    self._qa = numpy.fromfunction(self.qFunction, shape,
-                                                  dtype=numpy.float32)
+            self.calc_arrays(shape, "q")
         return self._qa
 
     def rArray(self, shape):
@@ -393,10 +548,7 @@ class Geometry(object):
         @return: 2d array of the given shape with radius in mm from beam stop.
         """
         if self._ra is None:
-            with self._sem:
-                if self._ra is None:
-                    self._ra = numpy.fromfunction(self.rFunction, shape,
-                                                  dtype=numpy.float32)
+            self.calc_arrays(shape, "r")
         return self._ra
 
     def qCornerFunct(self, d1, d2):
@@ -431,11 +583,7 @@ class Geometry(object):
         all elements.
         """
         if self._ttha is None:
-            with self._sem:
-                if self._ttha is None:
-                    self._ttha = numpy.fromfunction(self.tth,
-                                                    shape,
-                                                    dtype=numpy.float32)
+            self.calc_arrays(shape, "tth")
         return self._ttha
 
     def chi(self, d1, d2, path="cython"):
@@ -509,10 +657,7 @@ class Geometry(object):
         @rtype: ndarray
         """
         if self._chia is None:
-            self._chia = numpy.fromfunction(self.chi, shape,
-                                            dtype=numpy.float32)
-            if not self.chiDiscAtPi:
-                self._chia = self._chia % (2 * numpy.pi)
+            self.calc_arrays(shape, "chi")
         return self._chia
 
     def cornerArray(self, shape):
@@ -520,82 +665,124 @@ class Geometry(object):
         Generate a 3D array of the given shape with (i,j) (radial
         angle 2th, azimuthal angle chi ) for all elements.
 
+        The array is expanded on demand from the vertex grid
+        (see vertexArray), only the latter is cached.
+
         @param shape: expected shape
         @type shape: ndarray.shape
         @return: 3d array with shape=(*shape,2) the two elements are (radial angle 2th, azimuthal angle chi)
         """
-        if self._corner4Da is None:
-            with self._sem:
-                if self._corner4Da is None:
-                    self._corner4Da = numpy.zeros((shape[0], shape[1], 4, 2),
-                                                  dtype=numpy.float32)
-                    chi = numpy.fromfunction(self.chi_corner,
-                                             (shape[0] + 1, shape[1] + 1),
-                                             dtype=numpy.float32)
-                    tth = numpy.fromfunction(self.tth_corner,
-                                             (shape[0] + 1, shape[1] + 1),
-                                             dtype=numpy.float32)
-                    self._corner4Da[:, :, 0, 0] = tth[:-1, :-1]
-                    self._corner4Da[:, :, 0, 1] = chi[:-1, :-1]
-                    self._corner4Da[:, :, 1, 0] = tth[1:, :-1]
-                    self._corner4Da[:, :, 1, 1] = chi[1:, :-1]
-                    self._corner4Da[:, :, 2, 0] = tth[1:, 1:]
-                    self._corner4Da[:, :, 2, 1] = chi[1:, 1:]
-                    self._corner4Da[:, :, 3, 0] = tth[:-1, 1:]
-                    self._corner4Da[:, :, 3, 1] = chi[:-1, 1:]
-        return self._corner4Da
+        return _expandVertices(self.vertexArray(shape))
 
     def cornerQArray(self, shape):
         """
         Generate a 3D array of the given shape with (i,j) (azimuthal
         angle) for all elements.
         """
-        if self._corner4Dqa is None:
-            with self._sem:
-                if self._corner4Dqa is None:
-                    self._corner4Dqa = numpy.zeros((shape[0], shape[1], 4, 2),
-                                                   dtype=numpy.float32)
-                    qar = numpy.fromfunction(self.qCornerFunct,
-                                             (shape[0] + 1, shape[1] + 1),
-                                             dtype=numpy.float32)
-                    chi = numpy.fromfunction(self.chi_corner,
-                                             (shape[0] + 1, shape[1] + 1),
-                                             dtype=numpy.float32)
-                    self._corner4Dqa[:, :, 0, 0] = qar[:-1, :-1]
-                    self._corner4Dqa[:, :, 0, 1] = chi[:-1, :-1]
-                    self._corner4Dqa[:, :, 1, 0] = qar[1:, :-1]
-                    self._corner4Dqa[:, :, 1, 1] = chi[1:, :-1]
-                    self._corner4Dqa[:, :, 2, 0] = qar[1:, 1:]
-                    self._corner4Dqa[:, :, 2, 1] = chi[1:, 1:]
-                    self._corner4Dqa[:, :, 3, 0] = qar[:-1, 1:]
-                    self._corner4Dqa[:, :, 3, 1] = chi[:-1, 1:]
-        return self._corner4Dqa
+        return _expandVertices(self.vertexQArray(shape))
 
     def cornerRArray(self, shape):
         """
         Generate a 3D array of the given shape with (i,j) (azimuthal
         angle) for all elements.
         """
-        if self._corner4Dra is None:
-            with self._sem:
-                if self._corner4Dra is None:
-                    self._corner4Dra = numpy.zeros((shape[0], shape[1], 4, 2),
-                                                   dtype=numpy.float32)
-                    rar = numpy.fromfunction(self.rCornerFunct,
-                                             (shape[0] + 1, shape[1] + 1),
-                                             dtype=numpy.float32)
-                    chi = numpy.fromfunction(self.chi_corner,
-                                             (shape[0] + 1, shape[1] + 1),
-                                             dtype=numpy.float32)
-                    self._corner4Dra[:, :, 0, 0] = rar[:-1, :-1]
-                    self._corner4Dra[:, :, 0, 1] = chi[:-1, :-1]
-                    self._corner4Dra[:, :, 1, 0] = rar[1:, :-1]
-                    self._corner4Dra[:, :, 1, 1] = chi[1:, :-1]
-                    self._corner4Dra[:, :, 2, 0] = rar[1:, 1:]
-                    self._corner4Dra[:, :, 2, 1] = chi[1:, 1:]
-                    self._corner4Dra[:, :, 3, 0] = rar[:-1, 1:]
-                    self._corner4Dra[:, :, 3, 1] = chi[:-1, 1:]
-        return self._corner4Dra
+        return _expandVertices(self.vertexRArray(shape))
+
+    def vertexArray(self, shape):
+        """
+        Generate an array with (radial angle 2th, azimuthal angle chi)
+        at the vertices of the pixel grid: the corners of pixel (i,j) are
+        the vertices (i,j), (i+1,j), (i+1,j+1) and (i,j+1).
+
+        @param shape: shape of the detector array
+        @type shape: ndarray.shape
+        @return: 3d array with shape=(shape[0]+1, shape[1]+1, 2), float32
+        """
+        if self._vertexa is None:
+            self._vertexa = self._vertexArray(shape, "tth")
+        return self._vertexa
+
+    def vertexQArray(self, shape):
+        """
+        Generate an array with (q, azimuthal angle chi) at the vertices
+        of the pixel grid.
+
+        @param shape: shape of the detector array
+        @return: 3d array with shape=(shape[0]+1, shape[1]+1, 2), float32
+        """
+        if self._vertexqa is None:
+            self._vertexqa = self._vertexArray(shape, "q")
+        return self._vertexqa
+
+    def vertexRArray(self, shape):
+        """
+        Generate an array with (r, azimuthal angle chi) at the vertices
+        of the pixel grid.
+
+        @param shape: shape of the detector array
+        @return: 3d array with shape=(shape[0]+1, shape[1]+1, 2), float32
+        """
+        if self._vertexra is None:
+            self._vertexra = self._vertexArray(shape, "r")
+        return self._vertexra
+
+    def _vertexArray(self, shape, name):
+        """
+        Calculate the (radial, chi) positions at the vertices of the pixel
+        grid. The chi values are copied from any other vertex grid already
+        available rather than recalculated.
+
+        @param shape: shape of the detector array
+        @param name: radial quantity, "tth", "q" or "r"
+        @return: 3d array of shape (shape[0]+1, shape[1]+1, 2), float32
+        """
+        vshape = (shape[0] + 1, shape[1] + 1)
+        vertices = numpy.empty(vshape + (2,), dtype=numpy.float32)
+        chi = None
+        for other in (self._vertexa, self._vertexqa, self._vertexra):
+            if other is not None and other.shape[:2] == vshape:
+                chi = other[:, :, 1]
+                break
+        with self._sem:
+            d1, d2 = numpy.mgrid[:vshape[0], :vshape[1]].astype(numpy.float32) - 0.5
+            if _geometry:
+                p1, p2 = self._calcCartesianPositions(d1, d2)
+                quantities = [name]
+                if chi is None:
+                    quantities.append("chi")
+                arrays = _geometry.calc_all(L=self._dist,
+                                            rot1=self._rot1,
+                                            rot2=self._rot2,
+                                            rot3=self._rot3,
+                                            pos1=p1,
+                                            pos2=p2,
+                                            quantities=quantities,
+                                            wavelength=self._wavelength)
+                vertices[:, :, 0] = arrays[name].reshape(vshape)
+                if chi is None:
+                    chi = arrays["chi"].reshape(vshape)
+            else:
+                funct = {"tth": self.tth, "q": self.qFunction, "r": self.rFunction}[name]
+                vertices[:, :, 0] = funct(d1, d2)
+                if chi is None:
+                    chi = self.chi(d1, d2)
+            vertices[:, :, 1] = chi
+        return vertices
+
+    def _vertexValues(self, shape, name, index=0):
+        """
+        Values at the vertices of the pixel grid, taken from the cached
+        vertex grid when available, else calculated without being cached.
+
+        @param shape: shape of the detector array
+        @param name: radial quantity, "tth", "q" or "r"
+        @param index: 0 for the radial position, 1 for chi
+        @return: 2d array of shape (shape[0]+1, shape[1]+1)
+        """
+        vertices = self.__dict__[self._VERTICES[name]]
+        if vertices is None or vertices.shape[:2] != (shape[0] + 1, shape[1] + 1):
+            vertices = self._vertexArray(shape, name)
+        return vertices[:, :, index]
 
     def delta2Theta(self, shape):
         """
@@ -607,24 +794,10 @@ class Geometry(object):
         """
         tth_center = self.twoThetaArray(shape)
         if self._dttha is None:
+            vertices = self._vertexValues(shape, "tth")
             with self._sem:
                 if self._dttha is None:
-                    delta = numpy.zeros([shape[0], shape[1], 4],
-                                        dtype=numpy.float32)
-                    if self._corner4Da is not None\
-                            and self._corner4Da.shape[:2] == tuple(shape):
-                        for i in range(4):
-                            delta[:, :, i] = \
-                                abs(self._corner4Da[:, :, i, 0] - tth_center)
-                    else:
-                        tth_corner = numpy.fromfunction(
-                            self.tth_corner,
-                            (shape[0] + 1, shape[1] + 1), dtype=numpy.float32)
-                        delta[:, :, 0] = abs(tth_corner[:-1, :-1] - tth_center)
-                        delta[:, :, 1] = abs(tth_corner[1:, :-1] - tth_center)
-                        delta[:, :, 2] = abs(tth_corner[1:, 1:] - tth_center)
-                        delta[:, :, 3] = abs(tth_corner[:-1, 1:] - tth_center)
-                    self._dttha = delta.max(axis=2)
+                    self._dttha = _maxCornerDelta(vertices, tth_center)
         return self._dttha
 
     def deltaChi(self, shape):
@@ -637,47 +810,14 @@ class Geometry(object):
         """
         chi_center = self.chiArray(shape)
         if self._dchia is None:
+            name = "tth"
+            for key in ("q", "r"):
+                if self.__dict__[self._VERTICES[key]] is not None:
+                    name = key
+            vertices = self._vertexValues(shape, name, 1)
             with self._sem:
                 if self._dchia is None:
-                    twoPi = 2 * numpy.pi
-                    delta = numpy.zeros([shape[0], shape[1], 4],
-                                        dtype=numpy.float32)
-                    if self._corner4Da is not None\
-                            and self._corner4Da.shape[:2] == tuple(shape):
-                        for i in range(4):
-                            delta[:, :, i] = \
-                                numpy.minimum(((self._corner4Da[:, :, i, 1] - chi_center) % twoPi),
-                                              ((chi_center - self._corner4Da[:, :, i, 1]) % twoPi))
-                    if self._corner4Dqa is not None\
-                            and self._corner4Dqa.shape[:2] == tuple(shape):
-                        for i in range(4):
-                            delta[:, :, i] = \
-                                numpy.minimum(((self._corner4Dqa[:, :, i, 1] - chi_center) % twoPi),
-                                              ((chi_center - self._corner4Dqa[:, :, i, 1]) % twoPi))
-                    if self._corner4Dra is not None\
-                            and self._corner4Dra.shape[:2] == tuple(shape):
-                        for i in range(4):
-                            delta[:, :, i] = \
-                                numpy.minimum(((self._corner4Dra[:, :, i, 1] - chi_center) % twoPi),
-                                              ((chi_center - self._corner4Dra[:, :, i, 1]) % twoPi))
-                    else:
-                        chi_corner = \
-                            numpy.fromfunction(self.chi_corner,
-                                               (shape[0] + 1, shape[1] + 1),
-                                               dtype=numpy.float32)
-                        delta[:, :, 0] = \
-                            numpy.minimum(((chi_corner[:-1, :-1] - chi_center) % twoPi),
-                                          ((chi_center - chi_corner[:-1, :-1]) % twoPi))
-                        delta[:, :, 1] = \
-                            numpy.minimum(((chi_corner[1: , :-1] - chi_center) % twoPi),
-                                          ((chi_center - chi_corner[1: , :-1]) % twoPi))
-                        delta[:, :, 2] = \
-                            numpy.minimum(((chi_corner[1: , 1: ] - chi_center) % twoPi),
-                                          ((chi_center - chi_corner[1: , 1: ]) % twoPi))
-                        delta[:, :, 3] = \
-                            numpy.minimum(((chi_corner[:-1, 1: ] - chi_center) % twoPi),
-                                          ((chi_center - chi_corner[:-1, 1: ]) % twoPi))
-                    self._dchia = delta.max(axis= -1)
+                    self._dchia = _maxCornerDelta(vertices, chi_center, 2 * numpy.pi)
         return self._dchia
 
     def deltaQ(self, shape):
@@ -691,25 +831,10 @@ class Geometry(object):
         """
         q_center = self.qArray(shape)
         if self._dqa is None:
+            vertices = self._vertexValues(shape, "q")
             with self._sem:
                 if self._dqa is None:
-                    delta = numpy.zeros([shape[0], shape[1], 4],
-                                        dtype=numpy.float32)
-                    if self._corner4Dqa is not None\
-                            and self._corner4Dqa.shape[:2] == tuple(shape):
-                        for i in range(4):
-                            delta[:, :, i] = \
-                                abs(self._corner4Dqa[:, :, i, 0] - q_center)
-                    else:
-                        q_corner = \
-                            numpy.fromfunction(self.qCornerFunct,
-                                               (shape[0] + 1, shape[1] + 1),
-                                               dtype=numpy.float32)
-                        delta[:, :, 0] = abs(q_corner[:-1, :-1] - q_center)
-                        delta[:, :, 1] = abs(q_corner[1:, :-1] - q_center)
-                        delta[:, :, 2] = abs(q_corner[1:, 1:] - q_center)
-                        delta[:, :, 3] = abs(q_corner[:-1, 1:] - q_center)
-                    self._dqa = delta.max(axis= -1)
+                    self._dqa = _maxCornerDelta(vertices, q_center)
         return self._dqa
 
     def deltaR(self, shape):
@@ -720,39 +845,55 @@ class Geometry(object):
         @param shape: The shape of the detector array: 2-tuple of integer
         @return: array 2D containing the max delta Q between a pixel center and any corner in q_vector unit (nm^-1)
         """
-        q_center = self.rArray(shape)
+        r_center = self.rArray(shape)
         if self._dra is None:
+            vertices = self._vertexValues(shape, "r")
             with self._sem:
                 if self._dra is None:
-                    delta = numpy.zeros([shape[0], shape[1], 4],
-                                        dtype=numpy.float32)
-                    if self._corner4Dra is not None\
-                            and self._corner4Dra.shape[:2] == tuple(shape):
-                        for i in range(4):
-                            delta[:, :, i] = \
-                                abs(self._corner4Dra[:, :, i, 0] - q_center)
-                    else:
-                        q_corner = \
-                            numpy.fromfunction(self.rCornerFunct,
-                                               (shape[0] + 1, shape[1] + 1),
-                                               dtype=numpy.float32)
-                        delta[:, :, 0] = abs(q_corner[:-1, :-1] - q_center)
-                        delta[:, :, 1] = abs(q_corner[1:, :-1] - q_center)
-                        delta[:, :, 2] = abs(q_corner[1:, 1:] - q_center)
-                        delta[:, :, 3] = abs(q_corner[:-1, 1:] - q_center)
-                    self._dra = delta.max(axis= -1)
+                    self._dra = _maxCornerDelta(vertices, r_center)
         return self._dra
 
     def diffSolidAngle(self, d1, d2):
         """
         Calulate the solid angle of the current pixels
 
+        With exact_solid_angle, the closed form of the solid angle of a
+        rectangle in the (tilted) detector plane is used instead of
+        cos(alpha), relative to the one of a pixel at the PONI:
+
+        Omega = sum of +/- arctan(x.y / (L.sqrt(L^2 + x^2 + y^2))) over the 4 corners (x, y) of the pixel
+
         @param d1: 1d or 2d set
         @param d2:
         """
         p1, p2 = self._calcCartesianPositions(d1, d2)
 #        p1 = (0.5 + d1) * self.pixel1 - self._poni1
 #        p2 = (0.5 + d2) * self.pixel2 - self._poni2
+        ds = self._pixelArea(d1, d2)
+        pixel1 = self.detector.pixel1
+        pixel2 = self.detector.pixel2
+        if self._exact_solid_angle and pixel1 and pixel2:
+            # differences of nearly equal angles: double precision is needed
+            p1 = numpy.asarray(p1, dtype=numpy.float64)
+            p2 = numpy.asarray(p2, dtype=numpy.float64)
+            L = self._dist
+            h1 = 0.5 * pixel1
+            h2 = 0.5 * pixel2
+            rectangle = lambda x, y: numpy.arctan(x * y / (L * sqrt(L ** 2 + x ** 2 + y ** 2)))
+            dsa = ds * (rectangle(p1 + h1, p2 + h2) - rectangle(p1 - h1, p2 + h2) -
+                        rectangle(p1 + h1, p2 - h2) + rectangle(p1 - h1, p2 - h2)) * L ** 2 / (pixel1 * pixel2)
+        else:
+            dsa = ds * (self._dist) / sqrt(self._dist ** 2 + p1 ** 2 + p2 ** 2)
+        return dsa
+
+    def _pixelArea(self, d1, d2):
+        """
+        Relative area of the pixels, distorted by the spline
+
+        @param d1: 2d set of pixel coordinates along the 1st dimension
+        @param d2: 2d set of pixel coordinates along the 2nd dimension
+        @return: 1.0 or the 2d array of relative pixel areas
+        """
         ds = 1.0
 
         # #######################################################
@@ -770,9 +911,7 @@ class Geometry(object):
             dX = sX[:, 1:] - sX[:, :-1]
             dY = sY[1:, : ] - sY[:-1, :]
             ds = (dX + 1.0) * (dY + 1.0)
-
-        dsa = ds * (self._dist) / sqrt(self._dist ** 2 + p1 ** 2 + p2 ** 2)
-        return dsa
+        return ds
 
     def solidAngleArray(self, shape):
         """
@@ -780,11 +919,7 @@ class Geometry(object):
         the current element two-theta(i,j) for all elements.
         """
         if self._dssa is None:
-#            with self._sem:
-#                if self._dssa is None:
-            self._dssa = numpy.fromfunction(self.diffSolidAngle,
-                                            shape, dtype=numpy.float32)
-            self._dssa_crc = crc32(self._dssa)
+            self.calc_arrays(shape, "dssa")
         return self._dssa
 
     def save(self, filename):
@@ -1014,10 +1149,7 @@ class Geometry(object):
         0 and 2pi.  By default it is between pi and -pi
         """
         self.chiDiscAtPi = False
-        self._chia = None
-        self._corner4Da = None
-        self._corner4Dqa = None
-        self._corner4Dra = None
+        self.invalidate("chiDiscAtPi")
 
     def setChiDiscAtPi(self):
         """
@@ -1025,10 +1157,7 @@ class Geometry(object):
         -pi and +pi.  This is the default behavour
         """
         self.chiDiscAtPi = True
-        self._chia = None
-        self._corner4Da = None
-        self._corner4Dqa = None
-        self._corner4Dra = None
+        self.invalidate("chiDiscAtPi")
 
     def setOversampling(self, iOversampling):
         """
@@ -1040,10 +1169,7 @@ class Geometry(object):
             lastOversampling = float(self._oversampling)
 
         self._oversampling = iOversampling
-        self._ttha = None
-        self._dssa = None
-        self._chia = None
-        self._qa = None
+        self.invalidate()
         self.pixel1 /= self._oversampling / lastOversampling
         self.pixel2 /= self._oversampling / lastOversampling
 
@@ -1070,6 +1196,8 @@ class Geometry(object):
 
         The axis_offset parameter allows correction for the misalignement of the polarization plane (or ellipse main axis) and the the detector's X axis.
 
+        The last few arrays (and their checksum) are kept, so that switching between polarization factors does not recalculate them.
+
         @param factor: (Ih-Iv)/(Ih+Iv): varies between 0 (no polarization) and 1 (where division by 0 could occure at 2th=90, chi=0)
         @param axis_offset: Angle between the polarization main axis and detector X direction (in radians !!!)
         @return: 2D array with polarization correction array (intensity/polarisation)
@@ -1084,47 +1212,107 @@ class Geometry(object):
 
         if factor is None:
             return numpy.ones(shape, dtype=numpy.float32)
-        else:
-            factor = float(factor)
-
-        if self._polarization is not None:
-            with self._sem:
-                if (factor == self._polarization_factor) \
-                    and (shape == self._polarization.shape)\
-                    and (axis_offset == self._polarization_axis_offset):
-                    return self._polarization
-
+        return self._get_polarization(shape, factor, axis_offset)[1]
+
+    def _get_polarization(self, shape, factor, axis_offset=0):
+        """
+        Polarization array and its checksum, from the last array used, the
+        cache or calculated.
+
+        The last entry is published as a single tuple and read once, so that
+        concurrent calls never mix the array of one factor with the key or
+        checksum of another one.
+
+        @param shape: shape of the array
+        @param factor: polarization factor, not None
+        @param axis_offset: angle between the polarization main axis and detector X direction
+        @return: ((shape, factor, axis_offset), polarization array, checksum)
+        """
+        key = (tuple(shape), float(factor), axis_offset)
+        # fast path, without lock: the last array used or any array cached
+        last = self._polarization
+        if (last is not None) and (last[0] == key):
+            return last
+        polarizations = self._polarizations
+        entry = polarizations.get(key) if polarizations else None
+        if entry is None:
+            entry = self._calc_polarization(*key)
+        self._polarization = entry
+        return entry
+
+    def _calc_polarization(self, shape, factor, axis_offset):
+        """
+        Calculate and cache a polarization array from the factor independent
+        pair A = (1 + cos²2θ) / 2 and B = cos(2χ) (1 - cos²2θ) / 2, also cached
+        for the given axis offset: polarization = A - factor * B.
+
+        @param shape: shape of the array
+        @param factor: polarization factor
+        @param axis_offset: angle between the polarization main axis and detector X direction
+        @return: ((shape, factor, axis_offset), polarization array, checksum)
+        """
+        key = (shape, factor, axis_offset)
+        self.calc_arrays(shape, "tth", "chi")
         tth = self.twoThetaArray(shape)
-        chi = self.chiArray(shape) + axis_offset
+        chi = self.chiArray(shape)
         with self._sem:
+            if self._polarizations is None:
+                self._polarizations = OrderedDict()
+            if self._polarization_ab is None:
+                self._polarization_ab = OrderedDict()
+            if key in self._polarizations:
+                return self._polarizations[key]
+            ab = self._polarization_ab.get((shape, axis_offset))
+            if ab is None:
                 cos2_tth = numpy.cos(tth) ** 2
-                self._polarization = ((1 + cos2_tth - factor * numpy.cos(2 * chi) * (1 - cos2_tth)) / 2.0)  # .astype(numpy.float32)
-                self._polarization_factor = factor
-                self._polarization_axis_offset = axis_offset
-                self._polarization_crc = crc32(self._polarization)
-                return self._polarization
+                ab = ((1 + cos2_tth) / 2.0,
+                      numpy.cos(2 * (chi + axis_offset)) * (1 - cos2_tth) / 2.0)
+                self._polarization_ab[(shape, axis_offset)] = ab
+                while len(self._polarization_ab) > self._POLARIZATION_CACHE_SIZE:
+                    self._polarization_ab.popitem(last=False)
+            polarization = ab[1] * (-factor)
+            polarization += ab[0]
+            entry = (key, polarization, crc32(polarization))
+            self._polarizations[key] = entry
+            while len(self._polarizations) > self._POLARIZATION_CACHE_SIZE:
+                self._polarizations.popitem(last=False)
+            return entry
 
     def reset(self):
         """
         reset most arrays that are cached: used when a parameter
         changes.
         """
+        self.invalidate()
+
+    def invalidate(self, *parameters):
+        """
+        Drop the cached arrays depending on any of the given parameters
+        (see _CACHE_DEPENDENCIES), or all of them if no parameter is given.
+
+        @param parameters: names of the parameters which changed, like "dist" or "wavelength"
+        """
         self.param = [self._dist, self._poni1, self._poni2,
                       self._rot1, self._rot2, self._rot3]
-        self._ttha = None
-        self._dttha = None
-        self._dssa = None
-        self._chia = None
-        self._dchia = None
-        self._qa = None
-        self._dqa = None
-        self._ra = None
-        self._dra = None
-        self._corner4Da = None
-        self._corner4Dqa = None
-        self._corner4Dra = None
-        self._polarization = None
-        self._polarization_factor = 0
+        for key, dependencies in self._CACHE_DEPENDENCIES.items():
+            if (not parameters) or any(i in dependencies for i in parameters):
+                setattr(self, key, None)
+
+    def _set_parameter(self, name, value):
+        """
+        Set a geometry parameter given as a number, a string or a
+        1-sequence and invalidate the cached arrays depending on it if
+        its value changed.
+
+        @param name: name of the parameter, like "dist" or "wavelength"
+        @param value: new value of the parameter
+        """
+        if isinstance(value, (tuple, list)):
+            value = value[0]
+        value = float(value)
+        if value != getattr(self, "_" + name):
+            setattr(self, "_" + name, value)
+            self.invalidate(name)
 
     def calcfrom1d(self, tth, I, shape=None, mask=None,
                    dim1_unit=units.TTH, correctSolidAngle=True):
@@ -1174,11 +1362,7 @@ class Geometry(object):
 # ############################################
 
     def set_dist(self, value):
-        if isinstance(value, float):
-            self._dist = value
-        else:
-            self._dist = float(value)
-        self.reset()
+        self._set_parameter("dist", value)
 
     def get_dist(self):
         return self._dist
@@ -1186,13 +1370,7 @@ class Geometry(object):
     dist = property(get_dist, set_dist)
 
     def set_poni1(self, value):
-        if isinstance(value, float):
-            self._poni1 = value
-        elif isinstance(value, (tuple, list)):
-            self._poni1 = float(value[0])
-        else:
-            self._poni1 = float(value)
-        self.reset()
+        self._set_parameter("poni1", value)
 
     def get_poni1(self):
         return self._poni1
@@ -1200,13 +1378,7 @@ class Geometry(object):
     poni1 = property(get_poni1, set_poni1)
 
     def set_poni2(self, value):
-        if isinstance(value, float):
-            self._poni2 = value
-        elif isinstance(value, (tuple, list)):
-            self._poni2 = float(value[0])
-        else:
-            self._poni2 = float(value)
-        self.reset()
+        self._set_parameter("poni2", value)
 
     def get_poni2(self):
         return self._poni2
@@ -1214,13 +1386,7 @@ class Geometry(object):
     poni2 = property(get_poni2, set_poni2)
 
     def set_rot1(self, value):
-        if isinstance(value, float):
-            self._rot1 = value
-        elif isinstance(value, (tuple, list)):
-            self._rot1 = float(value[0])
-        else:
-            self._rot1 = float(value)
-        self.reset()
+        self._set_parameter("rot1", value)
 
     def get_rot1(self):
         return self._rot1
@@ -1228,13 +1394,7 @@ class Geometry(object):
     rot1 = property(get_rot1, set_rot1)
 
     def set_rot2(self, value):
-        if isinstance(value, float):
-            self._rot2 = value
-        elif isinstance(value, (tuple, list)):
-            self._rot2 = float(value[0])
-        else:
-            self._rot2 = float(value)
-        self.reset()
+        self._set_parameter("rot2", value)
 
     def get_rot2(self):
         return self._rot2
@@ -1242,29 +1402,36 @@ class Geometry(object):
     rot2 = property(get_rot2, set_rot2)
 
     def set_rot3(self, value):
-        if isinstance(value, float):
-            self._rot3 = value
-        elif isinstance(value, (tuple, list)):
-            self._rot3 = float(value[0])
-        else:
-            self._rot3 = float(value)
-        self.reset()
+        self._set_parameter("rot3", value)
 
     def get_rot3(self):
         return self._rot3
 
     rot3 = property(get_rot3, set_rot3)
 
+    def set_dtype(self, value):
+        """
+        Set the precision of the cached arrays (2theta, chi, q, r,
+        solid angle, polarization). float32, the default, is what all
+        the integrators consume; float64 is only useful when the arrays
+        are used for other calculations. Changing it drops all caches.
+
+        @param value: numpy.float32 or numpy.float64
+        """
+        value = numpy.dtype(value).type
+        if value not in (numpy.float32, numpy.float64):
+            raise ValueError("Cached arrays are float32 or float64, not %s" % value)
+        if value != self._dtype:
+            self._dtype = value
+            self.invalidate()
+
+    def get_dtype(self):
+        return self._dtype
+
+    dtype = property(get_dtype, set_dtype)
+
     def set_wavelength(self, value):
-        if isinstance(value, float):
-            self._wavelength = value
-        elif isinstance(value, (tuple, list)):
-            self._wavelength = float(value[0])
-        else:
-            self._wavelength = float(value)
-        self._qa = None
-        self._dqa = None
-        self._corner4Dqa = None
+        self._set_parameter("wavelength", value)
 
     def get_wavelength(self):
         if self._wavelength is None:
@@ -1357,8 +1524,27 @@ class Geometry(object):
         v = bool(value)
         with self._sem:
             if v != self._correct_solid_angle_for_spline:
-                self._dssa = None
                 self._correct_solid_angle_for_spline = v
+                self.invalidate("correct_SA_spline")
 
     correct_SA_spline = property(get_correct_solid_angle_for_spline,
                                  set_correct_solid_angle_for_spline)
+
+    def get_exact_solid_angle(self):
+        return self._exact_solid_angle
+
+    def set_exact_solid_angle(self, value):
+        """
+        Use the exact solid angle of the rectangular pixels instead of the
+        cos(alpha) factor. Off by default: intensities corrected with it
+        differ by up to tens of percent on pixels far from the PONI.
+
+        @param value: True to use the exact solid angle
+        """
+        v = bool(value)
+        with self._sem:
+            if v != self._exact_solid_angle:
+                self._exact_solid_angle = v
+                self.invalidate("exact_solid_angle")
+
+    exact_solid_angle = property(get_exact_solid_angle, set_exact_solid_angle)
@@ -181,20 +181,24 @@ class AIWidget(QtGui.QWidget):
                 return
 
             elif "ndim" in dir(self.input_data) and (self.input_data.ndim == 3):
-                # We have a numpy array of dim3
+                # We have a numpy array of dim3: frames are integrated by blocks
+                # sharing the look-up table. Errors are not kept anyway.
+                for key in ("filename", "error_model"):
+                    kwarg.pop(key, None)
+                nframes = self.input_data.shape[0]
+                block_size = 16
                 if "nbPt_azim" in kwarg:
-                    out = numpy.zeros((self.input_data.shape[0], kwarg["nbPt_azim"], kwarg["nbPt_rad"]), dtype=numpy.float32)
-                    for i in range(self.input_data.shape[0]):
-                        self.progressBar.setValue(100.0 * i / self.input_data.shape[0])
-                        kwarg["data"] = self.input_data[i]
-                        out[i] = self.ai.integrate2d(**kwarg)[0]
-
+                    out = numpy.zeros((nframes, kwarg["nbPt_azim"], kwarg["nbPt_rad"]), dtype=numpy.float32)
                 else:
-                    out = numpy.zeros((self.input_data.shape[0], kwarg["nbPt_rad"]), dtype=numpy.float32)
-                    for i in range(self.input_data.shape[0]):
-                        self.progressBar.setValue(100.0 * i / self.input_data.shape[0])
-                        kwarg["data"] = self.input_data[i]
-                        out[i] = self.ai.integrate1d(**kwarg)[1]
+                    kwarg["nbPt"] = kwarg.pop("nbPt_rad")
+                    out = numpy.zeros((nframes, kwarg["nbPt"]), dtype=numpy.float32)
+                for start in range(0, nframes, block_size):
+                    self.progressBar.setValue(100.0 * start / nframes)
+                    frames = self.input_data[start:start + block_size]
+                    if "nbPt_azim" in kwarg:
+                        out[start:start + block_size] = self.ai.integrate2d_stack(frames, block_size=block_size, **kwarg)[0]
+                    else:
+                        out[start:start + block_size] = self.ai.integrate1d_stack(frames, block_size=block_size, **kwarg)[1]
 
             elif "__len__" in dir(self.input_data):
                 out = []
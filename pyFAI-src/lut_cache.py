@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: Fast Azimuthal integration
+#             https://github.com/kif/pyFAI
+#
+#    Copyright (C) European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+
+Caches for look-up tables
+
+LUTCache is a persistent on-disk cache: each entry is a directory named
+after the hash of everything the look-up table depends on (geometry,
+detector, mask checksum, unit, number of bins, ranges), containing the
+arrays as .npy files (memory-mapped on reload) and the scalar attributes
+of the integrator in a small json file.
+
+Look-up tables of the distortion correction are stored in the same
+directories, as a single memory-mappable lut.npy file.
+
+IntegratorCache is an in-memory LRU cache of integrators used by the
+AzimuthalIntegrator.
+
+"""
+
+__author__ = "Jerome Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "GPLv3+"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "16/10/2013"
+__status__ = "development"
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import logging
+import numpy
+from collections import OrderedDict
+from . import units
+logger = logging.getLogger("pyFAI.lut_cache")
+try:
+    from . import splitBBoxLUT
+except ImportError as error:
+    logger.error("Unable to import pyFAI.splitBBoxLUT:"
+                 " no look-up table to cache: %s" % error)
+    splitBBoxLUT = None
+
+ARRAYS = ("lut", "data", "indices", "indptr", "lut_max_idx",
+          "outPos", "outPos0", "outPos1")
+METADATA = "metadata.json"
+SCALARS = (int, long, float, bool, str, unicode, type(None))
+
+
+class LUTCache(object):
+    """
+    Content addressed cache of look-up tables stored in a directory.
+
+    The total size of the cache is bounded by *max_size*: when exceeded, the
+    least recently used entries are removed.
+    """
+    def __init__(self, directory, max_size=None):
+        """
+        @param directory: where to store the look-up tables
+        @type directory: str
+        @param max_size: maximum size of the cache in bytes, None for unlimited
+        @type max_size: int
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self._sem = threading.Semaphore()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return "LUT cache in %s (max_size=%s)" % (self.directory, self.max_size)
+
+    @staticmethod
+    def key(*args):
+        """
+        Calculate the key of an entry from all parameters the look-up table
+        depends on.
+
+        @return: hexadecimal digest
+        @rtype: str
+        """
+        return hashlib.sha1(repr(args)).hexdigest()
+
+    def load(self, key):
+        """
+        Retrieve a look-up table integrator from the cache
+
+        @param key: key of the entry, as calculated by LUTCache.key
+        @return: integrator with memory-mapped arrays or None if not in cache
+        """
+        path = os.path.join(self.directory, key)
+        metafile = os.path.join(path, METADATA)
+        if not os.path.isfile(metafile):
+            return None
+        try:
+            with open(metafile) as f:
+                metadata = json.load(f)
+            klass = getattr(splitBBoxLUT, metadata.pop("__class__"))
+            integrator = klass.__new__(klass)
+            for name, value in metadata.items():
+                if isinstance(value, list):
+                    value = tuple(value)
+                if name == "unit":
+                    value = units.to_unit(value) or value
+                setattr(integrator, str(name), value)
+            for name in ARRAYS:
+                filename = os.path.join(path, name + ".npy")
+                if os.path.isfile(filename):
+                    # copy-on-write: Cython memoryviews need a writable buffer
+                    value = numpy.load(filename, mmap_mode="c")
+                    if name == "lut":
+                        value = value.view(numpy.recarray)
+                    setattr(integrator, name, value)
+        except Exception as error:
+            logger.warning("Unable to read look-up table %s from cache: %s" % (key, error))
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        logger.info("Look-up table %s read from cache" % key)
+        return integrator
+
+    def save(self, key, integrator):
+        """
+        Store a look-up table integrator in the cache
+
+        @param key: key of the entry, as calculated by LUTCache.key
+        @param integrator: HistoBBox1d, HistoBBox2d or their CSR counterparts
+        """
+        path = os.path.join(self.directory, key)
+        if os.path.isdir(path):
+            return
+        metadata = {"__class__": integrator.__class__.__name__}
+        for name, value in integrator.__dict__.items():
+            if name in ARRAYS:
+                continue
+            if name == "unit" and isinstance(value, units.Enum):
+                value = value.REPR
+            elif isinstance(value, numpy.generic):
+                value = value.item()
+            elif isinstance(value, tuple):
+                value = [i.item() if isinstance(i, numpy.generic) else i for i in value]
+            if isinstance(value, SCALARS) or \
+                    (isinstance(value, list) and all(isinstance(i, SCALARS) for i in value)):
+                metadata[name] = value
+        tmp = tempfile.mkdtemp(prefix=".tmp_", dir=self.directory)
+        try:
+            for name in ARRAYS:
+                value = integrator.__dict__.get(name)
+                if isinstance(value, numpy.ndarray):
+                    numpy.save(os.path.join(tmp, name + ".npy"), numpy.asarray(value))
+            with open(os.path.join(tmp, METADATA), "w") as f:
+                json.dump(metadata, f)
+            os.rename(tmp, path)
+        except (IOError, OSError) as error:
+            # most likely an other process stored the same entry meanwhile
+            logger.info("Look-up table %s not stored in cache: %s" % (key, error))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        logger.info("Look-up table %s stored in cache" % key)
+        if self.max_size:
+            self.evict(keep=key)
+
+    def entries(self):
+        """
+        @return: list of (last access time, size in bytes, key) for all entries
+        """
+        res = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, i)) for i in os.listdir(path))
+                res.append((os.path.getmtime(path), size, key))
+            except OSError:  # removed meanwhile
+                pass
+        return res
+
+    def size(self):
+        """
+        @return: total size of the cache in bytes
+        """
+        return sum(i[1] for i in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in max_size
+
+        @param keep: key of an entry which should not be removed
+        """
+        with self._sem:
+            entries = sorted(self.entries())
+            total = sum(i[1] for i in entries)
+            for atime, size, key in entries:
+                if total <= self.max_size:
+                    break
+                if key == keep:
+                    continue
+                logger.info("Removing look-up table %s from cache" % key)
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        with self._sem:
+            for atime, size, key in self.entries():
+                shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+
+def file_checksum(filename):
+    """
+    @param filename: name of a file, like a spline file
+    @return: hexadecimal digest of the content of the file
+    @rtype: str
+    """
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_default_cache():
+    """
+    Cache defined from the environment: PYFAI_LUT_CACHE is the directory
+    and PYFAI_LUT_CACHE_SIZE the maximum size in MB.
+
+    @return: LUTCache instance or None if not configured
+    """
+    directory = os.environ.get("PYFAI_LUT_CACHE")
+    if not directory:
+        return None
+    max_size = os.environ.get("PYFAI_LUT_CACHE_SIZE")
+    if max_size:
+        max_size = int(float(max_size) * 1e6)
+    try:
+        return LUTCache(directory, max_size)
+    except OSError as error:
+        logger.error("Unable to use %s as LUT cache: %s" % (directory, error))
+        return None
+
+
+def nbytes(integrator):
+    """
+    @param integrator: any look-up table integrator
+    @return: memory used by all the arrays of an integrator, in bytes
+    """
+    return sum(value.nbytes for value in integrator.__dict__.values()
+               if isinstance(value, numpy.ndarray))
+
+
+class IntegratorCache(object):
+    """
+    In-memory least recently used cache of look-up table integrators.
+
+    Entries are evicted when there are more than *max_entries* of them or
+    when they use more than *max_size* bytes. The most recent entry is
+    always kept.
+    """
+    def __init__(self, max_size=None, max_entries=8):
+        """
+        @param max_size: memory budget in bytes. By default a quarter of the physical memory.
+        @type max_size: int
+        @param max_entries: maximum number of integrators kept
+        @type max_entries: int
+        """
+        if max_size is None:
+            if (os.name == "posix") and ("SC_PAGE_SIZE" in os.sysconf_names) and ("SC_PHYS_PAGES" in os.sysconf_names):
+                max_size = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 4
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = {}
+
+    def __repr__(self):
+        return "IntegratorCache with %s entries, %.3fMB, %s hits, %s misses" % \
+            (len(self._entries), self.nbytes / 1e6, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def nbytes(self):
+        return sum(self._nbytes.values())
+
+    def get(self, key):
+        """
+        @param key: key of the entry
+        @return: the integrator or None if not in cache
+        """
+        integrator = self._entries.pop(key, None)
+        if integrator is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries[key] = integrator
+        return integrator
+
+    def find(self, match):
+        """
+        Most recently used entry whose key satisfies a condition.
+        Counts as a hit when found, but not as a miss otherwise.
+
+        @param match: function taking a key and returning a boolean
+        @return: (key, integrator) or (None, None)
+        """
+        for key in reversed(self._entries.keys()):
+            if match(key):
+                self.hits += 1
+                integrator = self._entries.pop(key)
+                self._entries[key] = integrator
+                return key, integrator
+        return None, None
+
+    def set(self, key, integrator):
+        """
+        Store an integrator and evict the least recently used ones if needed.
+
+        @param key: key of the entry
+        @param integrator: look-up table integrator
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = integrator
+        self._nbytes[key] = nbytes(integrator)
+        while len(self._entries) > 1 and \
+                ((self.max_entries and len(self._entries) > self.max_entries) or
+                 (self.max_size and self.nbytes > self.max_size)):
+            old, _ = self._entries.popitem(last=False)
+            self._nbytes.pop(old, None)
+            logger.debug("Look-up table %s evicted from memory cache" % (old,))
+
+    def items(self):
+        """
+        @return: list of (key, integrator), from the least to the most recently used
+        """
+        return list(self._entries.items())
+
+    def discard(self, match):
+        """
+        Remove the entries whose key satisfies a condition.
+
+        @param match: function taking a key and returning a boolean
+        @return: number of entries removed
+        """
+        keys = [key for key in self._entries if match(key)]
+        for key in keys:
+            self._entries.pop(key)
+            self._nbytes.pop(key, None)
+        return len(keys)
+
+    def clear(self):
+        """
+        Remove all entries (but keep the statistics)
+        """
+        self._entries.clear()
+        self._nbytes.clear()
@@ -42,9 +42,39 @@ import logging
 import scipy.optimize
 import scipy.interpolate
 from scipy.interpolate import fitpack
+try:
+    from scipy.interpolate.dfitpack import bispeu
+except ImportError:
+    bispeu = None
 logger = logging.getLogger("pyFAI.spline")
 
 
+def evaluate_points(tck, x, y):
+    """
+    Evaluate a bivariate spline on a list of scattered points (x[i], y[i])
+    in a single call, unlike fitpack.bisplev which works on grids.
+
+    @param tck: [knotsX, knotsY, coeff, orderX, orderY] as for fitpack.bisplev
+    @param x: 1D array with the x coordinate of the points
+    @param y: 1D array with the y coordinate of the points, same size as x
+    @return: 1D array with the value of the spline at each point
+    """
+    x = numpy.ascontiguousarray(x, dtype=numpy.float64).ravel()
+    y = numpy.ascontiguousarray(y, dtype=numpy.float64).ravel()
+    assert x.size == y.size
+    if bispeu is None:
+        return numpy.array([fitpack.bisplev(i, j, tck) for i, j in zip(x, y)],
+                           dtype=numpy.float64)
+    tx, ty, c, kx, ky = tck
+    z, ier = bispeu(numpy.asarray(tx, dtype=numpy.float64),
+                    numpy.asarray(ty, dtype=numpy.float64),
+                    numpy.asarray(c, dtype=numpy.float64),
+                    kx, ky, x, y)
+    if ier != 0:
+        raise ValueError("Invalid input data for the spline evaluation: ier=%s" % ier)
+    return z
+
+
 class Spline:
     """
     This class is a python representation of the spline file
@@ -340,6 +370,42 @@ class Spline:
 
         return yDispArray
 
+    def splineFuncXPoints(self, x, y):
+        """
+        Calculates the displacement in the X direction at scattered points
+
+        @param x: x coordinate of the points
+        @type x: 1D ndarray
+        @param y: y coordinate of the points
+        @type y: 1D ndarray
+
+        @return: displacement in the X direction of each point
+        @rtype: 1D ndarray
+        """
+        return evaluate_points([self.xSplineKnotsX,
+                                self.xSplineKnotsY,
+                                self.xSplineCoeff,
+                                self.splineOrder,
+                                self.splineOrder], x, y)
+
+    def splineFuncYPoints(self, x, y):
+        """
+        Calculates the displacement in the Y direction at scattered points
+
+        @param x: x coordinate of the points
+        @type x: 1D ndarray
+        @param y: y coordinate of the points
+        @type y: 1D ndarray
+
+        @return: displacement in the Y direction of each point
+        @rtype: 1D ndarray
+        """
+        return evaluate_points([self.ySplineKnotsX,
+                                self.ySplineKnotsY,
+                                self.ySplineCoeff,
+                                self.splineOrder,
+                                self.splineOrder], x, y)
+
     def array2spline(self, smoothing=1000, timing=False):
         """
         Calculates the spline coefficients from the displacements
@@ -50,12 +50,14 @@ UNDEFINED = Enum(REPR='?')
 
 TTH_DEG = TTH = Enum(REPR="2th_deg",
                      corner="cornerArray",
+                     vertex="vertexArray",
                      center="twoThetaArray",
                      delta="delta2Theta",
                      scale=180.0 / pi)
 
 TTH_RAD = Enum(REPR="2th_rad",
                corner="cornerArray",
+               vertex="vertexArray",
                center="twoThetaArray",
                delta="delta2Theta",
                scale=1.0)
@@ -63,18 +65,21 @@ TTH_RAD = Enum(REPR="2th_rad",
 Q = Q_NM = Enum(REPR="q_nm^-1",
                 center="qArray",
                 corner="cornerQArray",
+                vertex="vertexQArray",
                 delta="deltaQ",
                 scale=1.0)
 
 Q_A = Enum(REPR="q_A^-1",
            center="qArray",
            corner="cornerQArray",
+           vertex="vertexQArray",
            delta="deltaQ",
            scale=0.1)
 
 R = R_MM = Enum(REPR="r_mm",
                 center="rArray",
                 corner="cornerRArray",
+                vertex="vertexRArray",
                 delta="deltaR",
                 scale=1000.0)
 
@@ -29,17 +29,34 @@ import numpy
 from cython.parallel import prange
 from libc.math cimport floor,ceil, fabs
 from libc.string cimport memset
+from openmp cimport omp_get_max_threads, omp_get_thread_num
 import logging, threading
 import types, os, sys, time
 logger = logging.getLogger("pyFAI._distortion")
 from .detectors import detector_factory
 from .utils import timeit
+from .splitBBoxLUT import native_data, output_buffer
+from . import lut_cache
 import fabio
+import tempfile
+try:
+    from . import ocl_azim_lut
+except ImportError:
+    ocl_azim_lut = None
 
 cdef struct lut_point:
     numpy.int32_t idx
     numpy.float32_t coef
 
+# pixel types read without conversion
+ctypedef fused any_t:
+    numpy.uint16_t
+    numpy.int32_t
+    numpy.float32_t
+    numpy.float64_t
+
+ENGINES = ("cpu", "ocl")
+
 cdef inline float min4f(float a, float b, float c, float d) nogil:
     """Calculates the min of 4 float numbers"""
     if (a <= b) and (a <= c) and (a <= d):
@@ -203,6 +220,210 @@ cdef inline void integrate(float[:,:] box, float start, float stop, float slope,
                         AA -= dA
                         h += 1
 
+@cython.wraparound(False)
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cdef int quad_contributions(float[:,:,:,:] pos, int i, int j, float[:,:] buffer,
+                            int shape0, int shape1, numpy.int32_t[:] dest, float[:] coef,
+                            numpy.int64_t start, bint fill) nogil:
+    """
+    Split the distorted pixel (i, j) over the pixels of the regular grid.
+
+    @param pos: position of the 4 corners of all pixels, in pixel units
+    @param i, j: indexes of the pixel in the raw image
+    @param buffer: work area of at least (delta0, delta1), private to the thread
+    @param shape0, shape1: shape of the corrected image
+    @param dest: index in the corrected image of each contribution (written if fill)
+    @param coef: fraction of the pixel in each contribution (written if fill)
+    @param start: position where the first contribution of this pixel is written
+    @param fill: if false, only count the contributions
+    @return: number of contributions of the pixel inside the corrected image
+    """
+    cdef int ms, ml, ns, nl, offset0, offset1, box_size0, box_size1, n = 0
+    cdef float A0, A1, B0, B1, C0, C1, D0, D1, pAB, pBC, pCD, pDA, cAB, cBC, cCD, cDA, area, value
+    memset(&buffer[0, 0], 0, buffer.shape[0] * buffer.shape[1] * sizeof(float))
+    A0 = pos[i, j, 0, 0]
+    A1 = pos[i, j, 0, 1]
+    B0 = pos[i, j, 1, 0]
+    B1 = pos[i, j, 1, 1]
+    C0 = pos[i, j, 2, 0]
+    C1 = pos[i, j, 2, 1]
+    D0 = pos[i, j, 3, 0]
+    D1 = pos[i, j, 3, 1]
+    offset0 = (<int> floor(min4f(A0, B0, C0, D0)))
+    offset1 = (<int> floor(min4f(A1, B1, C1, D1)))
+    box_size0 = (<int> ceil(max4f(A0, B0, C0, D0))) - offset0
+    box_size1 = (<int> ceil(max4f(A1, B1, C1, D1))) - offset1
+    A0 -= <float> offset0
+    A1 -= <float> offset1
+    B0 -= <float> offset0
+    B1 -= <float> offset1
+    C0 -= <float> offset0
+    C1 -= <float> offset1
+    D0 -= <float> offset0
+    D1 -= <float> offset1
+    if B0 != A0:
+        pAB = (B1 - A1) / (B0 - A0)
+        cAB = A1 - pAB * A0
+    else:
+        pAB = cAB = 0.0
+    if C0 != B0:
+        pBC = (C1 - B1) / (C0 - B0)
+        cBC = B1 - pBC * B0
+    else:
+        pBC = cBC = 0.0
+    if D0 != C0:
+        pCD = (D1 - C1) / (D0 - C0)
+        cCD = C1 - pCD * C0
+    else:
+        pCD = cCD = 0.0
+    if A0 != D0:
+        pDA = (A1 - D1) / (A0 - D0)
+        cDA = D1 - pDA * D0
+    else:
+        pDA = cDA = 0.0
+    integrate(buffer, B0, A0, pAB, cAB)
+    integrate(buffer, A0, D0, pDA, cDA)
+    integrate(buffer, D0, C0, pCD, cCD)
+    integrate(buffer, C0, B0, pBC, cBC)
+    area = 0.5 * ((C0 - A0) * (D1 - B1) - (C1 - A1) * (D0 - B0))
+    for ms in range(box_size0):
+        ml = ms + offset0
+        if ml < 0 or ml >= shape0:
+            continue
+        for ns in range(box_size1):
+            # ms,ns are indexes of the corrected image in short form, ml & nl are the same
+            nl = ns + offset1
+            if nl < 0 or nl >= shape1:
+                continue
+            value = buffer[ms, ns] / area
+            if value <= 0:
+                continue
+            if fill:
+                dest[start + n] = ml * shape1 + nl
+                coef[start + n] = value
+            n = n + 1
+    return n
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lut_dot(lut_point[:, :] lut, any_t[:] weights, out=None):
+    """
+    Sparse matrix - vector product between the look-up table of a distortion
+    correction and a raw image, in parallel over the corrected pixels.
+
+    @param lut: look-up table of shape (size, lut_size), packed at the start of each line
+    @param weights: flat raw image, of any type handled natively (see native_data)
+    @param out: float32 array of the size of the image receiving the result (optional)
+    @return: flat corrected image
+    """
+    cdef int i, j, idx, size = lut.shape[0], lut_size = lut.shape[1]
+    cdef double sum_data
+    cdef float coef
+    cdef float[:] cout
+    if weights.shape[0] != size:
+        raise ValueError("image has %s pixels, the look-up table expects %s" % (weights.shape[0], size))
+    out = output_buffer(out, (size,))
+    cout = out
+    for i in prange(size, nogil=True, schedule="guided"):
+        sum_data = 0.0
+        for j in range(lut_size):
+            idx = lut[i, j].idx
+            coef = lut[i, j].coef
+            if coef <= 0:
+                break
+            sum_data = sum_data + coef * weights[idx]
+        cout[i] = sum_data
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def csr_dot(float[:] coefs, numpy.int32_t[:] indices, numpy.int32_t[:] indptr, any_t[:] weights, out=None):
+    """
+    Sparse matrix - vector product between a CSR matrix and an image, in
+    parallel over the lines of the matrix.
+
+    @param coefs, indices, indptr: CSR representation of the matrix
+    @param weights: flat image, of any type handled natively (see native_data)
+    @param out: float32 array of size the number of lines receiving the result (optional)
+    @return: flat result
+    """
+    cdef int i, j, size = indptr.shape[0] - 1
+    cdef double sum_data
+    cdef float[:] cout
+    out = output_buffer(out, (size,))
+    cout = out
+    for i in prange(size, nogil=True, schedule="guided"):
+        sum_data = 0.0
+        for j in range(indptr[i], indptr[i + 1]):
+            sum_data = sum_data + coefs[j] * weights[indices[j]]
+        cout[i] = sum_data
+    return out
+
+
+def tile_order(shape, tile):
+    """
+    Order of the pixels of an image visited tile by tile, each tile being
+    visited line by line. Tiles on the border may be smaller.
+
+    @param shape: shape of the image
+    @param tile: shape of a tile
+    @return: int32 array with the flat index of the pixels in tile order
+    """
+    shape0, shape1 = shape
+    tile0, tile1 = tile
+    n1 = (shape1 + tile1 - 1) // tile1
+    i = numpy.arange(shape0, dtype=numpy.int64)[:, None]
+    j = numpy.arange(shape1, dtype=numpy.int64)[None, :]
+    key = ((i // tile0) * n1 + j // tile1) * (tile0 * tile1) + (i % tile0) * tile1 + j % tile1
+    return numpy.argsort(key.ravel(), kind="mergesort").astype(numpy.int32)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tile_lut(lut_point[:, :] lut, numpy.int32_t[:] order):
+    """
+    Reorder a look-up table: line i of the result is the line order[i] of
+    lut, and raw pixels are numbered by their rank in order, sorted within
+    each line. The image has then to be permuted by order before the
+    product, and the result put back with the inverse permutation.
+
+    @param lut: look-up table of shape (size, lut_size), packed at the start of each line
+    @param order: permutation of the pixels, as given by tile_order
+    @return: reordered look-up table as a recarray
+    """
+    cdef int i, j, k, n, size = lut.shape[0], lut_size = lut.shape[1]
+    cdef numpy.int32_t idx
+    cdef float coef
+    cdef numpy.int32_t[:] rank
+    cdef lut_point[:, :] tiled
+    if order.shape[0] != size:
+        raise ValueError("order has %s pixels, the look-up table expects %s" % (order.shape[0], size))
+    rank_array = numpy.empty(size, dtype=numpy.int32)
+    rank_array[numpy.asarray(order)] = numpy.arange(size, dtype=numpy.int32)
+    rank = rank_array
+    tiled_array = numpy.zeros((size, lut_size), dtype=[("idx", numpy.int32), ("coef", numpy.float32)]).view(numpy.recarray)
+    tiled = tiled_array
+    for i in prange(size, nogil=True, schedule="guided"):
+        n = 0
+        for j in range(lut_size):
+            coef = lut[order[i], j].coef
+            if coef <= 0:
+                break
+            idx = rank[lut[order[i], j].idx]
+            # insertion sort on the (short) line
+            k = n
+            while k > 0 and tiled[i, k - 1].idx > idx:
+                tiled[i, k] = tiled[i, k - 1]
+                k = k - 1
+            tiled[i, k].idx = idx
+            tiled[i, k].coef = coef
+            n = n + 1
+    return tiled_array
+
+
 cdef class Quad:
     """
     Basic quadrilatere object
@@ -529,10 +750,18 @@ class Distortion(object):
     It is also able to apply an inversion of the correction.
 
     """
-    def __init__(self, detector="detector", shape=None):
+    def __init__(self, detector="detector", shape=None, engine="cpu", tile=None):
         """
         @param detector: detector instance or detector name
+        @param engine: "cpu" to apply the look-up table with OpenMP or "ocl" to use OpenCL
+        @param tile: size (int or pair) of the tiles in which pixels are ordered in the look-up table, None to keep the scan order
         """
+        if engine not in ENGINES:
+            raise ValueError("engine has to be one of %s, not %s" % (ENGINES, engine))
+        if engine == "ocl" and ocl_azim_lut is None:
+            logger.warning("OpenCL implementation not available, falling back on the CPU engine")
+            engine = "cpu"
+        self.engine = engine
         if type(detector) in types.StringTypes:
             self.detector = detector_factory(detector)
         else:  # we assume it is a Detector instance
@@ -542,11 +771,23 @@ class Distortion(object):
         else:
             self.shape = shape
         self.shape = tuple([int(i) for i in self.shape])
+        if tile is not None:
+            if type(tile) in (int, long):
+                tile = (tile, tile)
+            tile = tuple(int(i) for i in tile)
+            if len(tile) != 2 or min(tile) < 1:
+                raise ValueError("tile has to be a positive int or a pair of them, not %s" % (tile,))
+        self.tile = tile
+        self.tile_order = None  # permutation of the pixels in the tiled look-up table
         self._sem = threading.Semaphore()
         self.lut_size = None
         self.pos = None
         self.LUT = None
         self.delta0 = self.delta1 = None  # max size of an pixel on a regular grid ...
+        self.integrator = None  # OpenCL integrator of the "ocl" engine
+        self.inverse = None  # (coefs, indices, indptr) of the transposed look-up table
+        self.inverse_mask = None
+        self.lut_cache = lut_cache.get_default_cache()
 
 
     def __repr__(self):
@@ -572,8 +813,6 @@ class Distortion(object):
                     self.delta1 = int((numpy.ceil(pos_corners[:, 1:, 1]) - numpy.floor(pos_corners[:, :-1, 1])).max())
         return self.pos
 
-    @cython.wraparound(False)
-    @cython.boundscheck(False)
     def calc_LUT_size(self):
         """
         Considering the "half-CCD" spline from ID11 which describes a (1025,2048) detector,
@@ -583,11 +822,12 @@ class Distortion(object):
 
         We keep self.pos: pos_corners will not be compatible with systems showing non adjacent pixels (like some xpads)
 
+        The number of bounding boxes of distorted pixels covering each pixel
+        is obtained from the 4 corners of each box, accumulated with
+        bincount then integrated along both dimensions.
+
+        @return: 2D array with the (upper bound of the) number of pixels contributing to each pixel of the corrected image
         """
-        cdef int i, j, k, l, shape0, shape1
-        cdef numpy.ndarray[numpy.float32_t, ndim = 4] pos
-        cdef int[:,:] pos0min, pos1min, pos0max, pos1max
-        cdef numpy.ndarray[numpy.int32_t, ndim = 2] lut_size
         if self.pos is None:
             pos = self.calc_pos()
         else:
@@ -596,121 +836,199 @@ class Distortion(object):
             with self._sem:
                 if self.lut_size is None:
                     shape0, shape1 = self.shape
-                    pos0min = numpy.floor(pos[:, :, :, 0].min(axis= -1)).astype(numpy.int32).clip(0, self.shape[0])
-                    pos1min = numpy.floor(pos[:, :, :, 1].min(axis= -1)).astype(numpy.int32).clip(0, self.shape[1])
-                    pos0max = (numpy.ceil(pos[:, :, :, 0].max(axis= -1)).astype(numpy.int32) + 1).clip(0, self.shape[0])
-                    pos1max = (numpy.ceil(pos[:, :, :, 1].max(axis= -1)).astype(numpy.int32) + 1).clip(0, self.shape[1])
-                    lut_size = numpy.zeros(self.shape, dtype=numpy.int32)
-                    with nogil:
-                        for i in range(shape0):
-                            for j in range(shape1):
-                                for k in range(pos0min[i, j],pos0max[i, j]):
-                                    for l in range(pos1min[i, j],pos1max[i, j]):
-                                        lut_size[k,l] += 1
+                    pos0min = numpy.floor(pos[:, :, :, 0].min(axis= -1)).astype(numpy.int32).clip(0, shape0).ravel()
+                    pos1min = numpy.floor(pos[:, :, :, 1].min(axis= -1)).astype(numpy.int32).clip(0, shape1).ravel()
+                    pos0max = (numpy.ceil(pos[:, :, :, 0].max(axis= -1)).astype(numpy.int32) + 1).clip(0, shape0).ravel()
+                    pos1max = (numpy.ceil(pos[:, :, :, 1].max(axis= -1)).astype(numpy.int32) + 1).clip(0, shape1).ravel()
+                    size = (shape0 + 1) * (shape1 + 1)
+                    # +1 at the start of each box, -1 after its end, along both dimensions
+                    corners = numpy.bincount(pos0min * (shape1 + 1) + pos1min, minlength=size) \
+                            - numpy.bincount(pos0min * (shape1 + 1) + pos1max, minlength=size) \
+                            - numpy.bincount(pos0max * (shape1 + 1) + pos1min, minlength=size) \
+                            + numpy.bincount(pos0max * (shape1 + 1) + pos1max, minlength=size)
+                    corners.shape = shape0 + 1, shape1 + 1
+                    lut_size = corners.cumsum(axis=0).cumsum(axis=1)[:shape0, :shape1].astype(numpy.int32)
                     self.lut_size = lut_size.max()
                     return lut_size
 
     @cython.wraparound(False)
     @cython.boundscheck(False)
-    @cython.cdivision(True)
     def calc_LUT(self):
-        cdef int i, j, ms, ml, ns, nl, shape0, shape1, delta0, delta1, buffer_size, i0, i1, size
-        cdef int offset0, offset1, box_size0, box_size1
-        cdef numpy.int32_t k, idx=0
-        cdef float A0, A1, B0, B1, C0, C1, D0, D1, pAB, pBC, pCD, pDA, cAB, cBC, cCD, cDA, area, value
-#        cdef numpy.ndarray[numpy.float32_t, ndim = 3]  pos
+        """
+        Calculate the look-up table of the distortion correction in two
+        parallel passes over the pixels of the raw image: the first one
+        counts the contributions of each pixel, the second one writes them
+        at their place. They are finally regrouped by pixel of the corrected
+        image, keeping the order of the raw pixels.
+
+        If *tile* is set, the lines of the look-up table are then reordered
+        tile by tile and raw pixels are renumbered the same way (see
+        tile_lut), so that the input of a tile is read from a compact region.
+
+        The width of the look-up table, self.lut_size, is the actual
+        maximum number of contributions to a pixel.
+
+        If *lut_cache* is set (or the PYFAI_LUT_CACHE environment variable
+        defines a cache directory), the look-up table is memory-mapped from
+        the cache when it was already calculated for the same spline file
+        content, binning and shape, possibly by another process.
+        """
+        cdef int i, j, shape0, shape1, tid, nthreads
+        cdef numpy.int32_t d, k, idx, size
+        cdef numpy.int64_t p, nnz
         cdef float[:,:,:,:] pos
-        cdef numpy.ndarray[lut_point, ndim = 3] lut
-        cdef numpy.ndarray[numpy.int32_t, ndim = 2] outMax = numpy.zeros(self.shape, dtype=numpy.int32)
-        cdef  float[:,:] buffer
-        #cdef float[:,:,:] pos
+        cdef float[:,:,:] buffers
+        cdef numpy.int32_t[:] count, dest, outMax
+        cdef numpy.int64_t[:] start
+        cdef float[:] coef
+        cdef lut_point[:,:] lut
         shape0, shape1 = self.shape
-
-        if self.lut_size is None:
-            self.calc_LUT_size()
+        size = shape0 * shape1
         if self.LUT is None:
+            cache_key = None
+            if self.lut_cache is not None:
+                cache_key = self._lut_cache_key()
+            if cache_key is not None:
+                filename = os.path.join(self.lut_cache.directory, cache_key, "lut.npy")
+                if os.path.isfile(filename):
+                    try:
+                        self.load_lut(filename)
+                    except (IOError, ValueError) as error:
+                        logger.warning("Unable to read distortion look-up table %s from cache: %s" % (cache_key, error))
+                    else:
+                        try:
+                            os.utime(os.path.dirname(filename), None)  # mark as recently used
+                        except OSError:
+                            pass
+                        return
+            self.calc_pos()
             with self._sem:
                 if self.LUT is None:
-                    pos = self.pos#.reshape(shape0,shape1,4*sizeof(float))
-                    lut = numpy.recarray(shape=(self.shape[0] , self.shape[1], self.lut_size), dtype=[("idx", numpy.int32), ("coef", numpy.float32)])
-                    size = self.shape[0]*self.shape[1]*self.lut_size*sizeof(lut_point)
-                    memset(&lut[0,0,0], 0, size)
-                    logger.info("LUT shape: (%i,%i,%i) %.3f MByte"%(lut.shape[0], lut.shape[1],lut.shape[2],size/1.0e6))
-                    buffer = numpy.empty((self.delta0, self.delta1),dtype=numpy.float32)
-                    buffer_size = self.delta0 * self.delta1 * sizeof(float)
-                    logger.info("Max pixel size: %ix%i; Max source pixel in target: %i"%(buffer.shape[1],buffer.shape[0], self.lut_size))
+                    pos = self.pos
+                    nthreads = omp_get_max_threads()
+                    buffers = numpy.empty((nthreads, self.delta0, self.delta1), dtype=numpy.float32)
+                    count = numpy.zeros(size, dtype=numpy.int32)
+                    dest = numpy.zeros(1, dtype=numpy.int32)
+                    coef = numpy.zeros(1, dtype=numpy.float32)
+                    # first pass: number of contributions of every raw pixel
+                    for i in prange(shape0, nogil=True, schedule="guided"):
+                        tid = omp_get_thread_num()
+                        for j in range(shape1):
+                            count[i * shape1 + j] = quad_contributions(pos, i, j, buffers[tid], shape0, shape1,
+                                                                       dest, coef, 0, 0)
+                    start_array = numpy.zeros(size + 1, dtype=numpy.int64)
+                    numpy.cumsum(count, out=start_array[1:])
+                    start = start_array
+                    nnz = start[size]
+                    dest = numpy.empty(nnz, dtype=numpy.int32)
+                    coef = numpy.empty(nnz, dtype=numpy.float32)
+                    # second pass: write the contributions
+                    for i in prange(shape0, nogil=True, schedule="guided"):
+                        tid = omp_get_thread_num()
+                        for j in range(shape1):
+                            quad_contributions(pos, i, j, buffers[tid], shape0, shape1,
+                                               dest, coef, start[i * shape1 + j], 1)
+                    # regroup by pixel of the corrected image
+                    lut_size = max(1, int(numpy.bincount(dest, minlength=size).max())) if nnz else 1
+                    lut_array = numpy.zeros((size, lut_size), dtype=[("idx", numpy.int32), ("coef", numpy.float32)]).view(numpy.recarray)
+                    logger.info("LUT shape: (%i,%i) %.3f MByte" % (size, lut_size, lut_array.nbytes / 1.0e6))
+                    lut = lut_array
+                    outMax = numpy.zeros(size, dtype=numpy.int32)
                     with nogil:
-                        # i,j, idx are indexes of the raw image uncorrected
-                        for i in range(shape0):
-                            for j in range(shape1):
-                                #reinit of buffer
-                                memset(&buffer[0,0], 0, buffer_size)
-                                A0 = pos[i, j, 0, 0]
-                                A1 = pos[i, j, 0, 1]
-                                B0 = pos[i, j, 1, 0]
-                                B1 = pos[i, j, 1, 1]
-                                C0 = pos[i, j, 2, 0]
-                                C1 = pos[i, j, 2, 1]
-                                D0 = pos[i, j, 3, 0]
-                                D1 = pos[i, j, 3, 1]
-                                offset0 = (<int> floor(min4f(A0, B0, C0, D0)))
-                                offset1 = (<int> floor(min4f(A1, B1, C1, D1)))
-                                box_size0 = (<int> ceil(max4f(A0, B0, C0, D0))) - offset0
-                                box_size1 = (<int> ceil(max4f(A1, B1, C1, D1))) - offset1
-                                A0 -= <float> offset0
-                                A1 -= <float> offset1
-                                B0 -= <float> offset0
-                                B1 -= <float> offset1
-                                C0 -= <float> offset0
-                                C1 -= <float> offset1
-                                D0 -= <float> offset0
-                                D1 -= <float> offset1
-                                if B0 != A0:
-                                    pAB = (B1 - A1) / (B0 - A0)
-                                    cAB = A1 - pAB * A0
-                                else:
-                                    pAB = cAB = 0.0
-                                if C0 != B0:
-                                    pBC = (C1 - B1) / (C0 - B0)
-                                    cBC = B1 - pBC * B0
-                                else:
-                                    pBC = cBC = 0.0
-                                if D0 != C0:
-                                    pCD = (D1 - C1) / (D0 - C0)
-                                    cCD = C1 - pCD * C0
-                                else:
-                                    pCD = cCD = 0.0
-                                if A0 != D0:
-                                    pDA = (A1 - D1) / (A0 - D0)
-                                    cDA = D1 - pDA * D0
-                                else:
-                                    pDA = cDA = 0.0
-                                integrate(buffer, B0, A0, pAB, cAB)
-                                integrate(buffer, A0, D0, pDA, cDA)
-                                integrate(buffer, D0, C0, pCD, cCD)
-                                integrate(buffer, C0, B0, pBC, cBC)
-                                area = 0.5*((C0 - A0)*(D1 - B1)-(C1 - A1)*(D0 - B0))
-                                for ms in range(box_size0):
-                                    ml = ms + offset0
-                                    if ml < 0 or ml >= shape0:
-                                        continue
-                                    for ns in range(box_size1):
-                                        # ms,ns are indexes of the corrected image in short form, ml & nl are the same
-                                        nl = ns + offset1
-                                        if nl < 0 or nl >= shape1:
-                                            continue
-                                        value = buffer[ms, ns] / area
-                                        if value <= 0:
-                                            continue
-                                        k = outMax[ml, nl]
-                                        lut[ml, nl, k].idx = idx
-                                        lut[ml, nl, k].coef = value
-                                        outMax[ml, nl] = k + 1
-                                idx += 1
-                    self.LUT = lut.reshape(self.shape[0] * self.shape[1], self.lut_size)
+                        for idx in range(size):
+                            for p in range(start[idx], start[idx + 1]):
+                                d = dest[p]
+                                k = outMax[d]
+                                lut[d, k].idx = idx
+                                lut[d, k].coef = coef[p]
+                                outMax[d] = k + 1
+                    if self.tile is not None:
+                        lut_array = tile_lut(lut_array, self._calc_tile_order())
+                    self.lut_size = lut_size
+                    self.LUT = lut_array
+            if cache_key is not None:
+                path = os.path.join(self.lut_cache.directory, cache_key)
+                try:
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    self.save_lut(os.path.join(path, "lut.npy"))
+                except (IOError, OSError) as error:
+                    # most likely an other process stored the same entry meanwhile
+                    logger.info("Distortion look-up table %s not stored in cache: %s" % (cache_key, error))
+                else:
+                    if self.lut_cache.max_size:
+                        self.lut_cache.evict(keep=cache_key)
+
+    def _lut_cache_key(self):
+        """
+        Calculate the key of the look-up table in the persistent cache.
+
+        It depends on the content of the spline file, the binning, the
+        shape of the detector and the tiling of the look-up table.
+
+        @return: key for LUTCache or None if the detector has no spline file
+        @rtype: str
+        """
+        spline = self.detector.splineFile
+        if not spline or not os.path.isfile(spline):
+            return None
+        binning = tuple(float(i) for i in self.detector.binning)
+        args = ("distortion", lut_cache.file_checksum(spline), binning, self.shape)
+        if self.tile is not None:
+            args += (self.tile,)
+        return lut_cache.LUTCache.key(*args)
+
+    def _calc_tile_order(self):
+        """
+        @return: permutation of the pixels in the tiled look-up table, None if not tiled
+        """
+        if self.tile is not None and self.tile_order is None:
+            self.tile_order = tile_order(self.shape, self.tile)
+        return self.tile_order
+
+    def save_lut(self, filename):
+        """
+        Save the look-up table (calculated if needed) as a .npy file, which
+        can be memory-mapped by load_lut. The file is written atomically.
+        A tiled look-up table is saved as such and has to be loaded with
+        the same tile.
+
+        @param filename: name of the .npy file
+        @type filename: str
+        """
+        if self.LUT is None:
+            self.calc_LUT()
+        fd, tmp = tempfile.mkstemp(suffix=".npy", prefix=".tmp_",
+                                   dir=os.path.dirname(os.path.abspath(filename)))
+        os.close(fd)
+        try:
+            numpy.save(tmp, numpy.asarray(self.LUT))
+            os.rename(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
+        logger.info("Distortion look-up table saved in %s" % filename)
+
+    def load_lut(self, filename):
+        """
+        Use a look-up table saved by save_lut. The file is memory-mapped
+        copy-on-write: all processes using it share the same physical pages.
+
+        @param filename: name of the .npy file
+        @type filename: str
+        """
+        lut = numpy.load(filename, mmap_mode="c")
+        if (lut.dtype != numpy.dtype([("idx", numpy.int32), ("coef", numpy.float32)])) or \
+                (lut.ndim != 2) or (lut.shape[0] != self.shape[0] * self.shape[1]):
+            raise ValueError("%s is not a look-up table for a detector of shape %s" % (filename, self.shape))
+        with self._sem:
+            self.LUT = lut.view(numpy.recarray)
+            self.lut_size = lut.shape[1]
+            self.integrator = None
+            self.inverse = None
+            self.inverse_mask = None
+        logger.info("Distortion look-up table read from %s" % filename)
 
-    @cython.wraparound(False)
-    @cython.boundscheck(False)
     def correct(self, image):
         """
         Correct an image based on the look-up table calculated ...
@@ -718,62 +1036,117 @@ class Distortion(object):
         @param image: 2D-array with the image
         @return: corrected 2D image
         """
-        cdef int i,j, lshape0, lshape1, idx, size
-        cdef float coef
-        cdef lut_point[:,:] LUT
-        cdef float[:] lout, lin
         if self.LUT is None:
             self.calc_LUT()
-        LUT = self.LUT
-        lshape0 = LUT.shape[0]
-        lshape1 = LUT.shape[1]
         img_shape = image.shape
+        if (img_shape[0] > self.shape[0]) or (img_shape[1] > self.shape[1]):
+            image = image[:self.shape[0], :self.shape[1]]
+            logger.warning("Cropping image as image is %ix%i and spline is %ix%i" % (img_shape[1], img_shape[0], self.shape[1], self.shape[0]))
+            img_shape = image.shape
         if (img_shape[0]<self.shape[0]) or (img_shape[1]<self.shape[1]):
             new_image = numpy.zeros(self.shape, dtype=numpy.float32)
             new_image[:img_shape[0],:img_shape[1]] = image
             image = new_image
             logger.warning("Patching image as image is %ix%i and spline is %ix%i"%(img_shape[1],img_shape[0],self.shape[1],self.shape[0]))
-
-        out = numpy.zeros(self.shape, dtype=numpy.float32)
-        lout = out.ravel()
-        lin = numpy.ascontiguousarray(image.ravel(),dtype=numpy.float32)
-        size = lin.size
-        for i in prange(lshape0, nogil=True, schedule="static"):
-            for j in range(lshape1):
-                idx = LUT[i,j].idx
-                coef = LUT[i,j].coef
-                if coef<=0:
-                    continue
-                if idx>=size:
-                    with gil:
-                        logger.warning("Accessing %i >= %i !!!"%(idx,size))
-                        continue
-                lout[i] += lin[idx] * coef
+        order = self._calc_tile_order()
+        data = native_data(image)
+        if order is not None:
+            data = data[order]
+        if self.engine == "ocl":
+            if self.integrator is None:
+                with self._sem:
+                    if self.integrator is None:
+                        self.integrator = ocl_azim_lut.OCL_LUT_Integrator(self.LUT, self.shape[0] * self.shape[1])
+            out = self.integrator.integrate(data)[1]
+        else:
+            out = lut_dot(self.LUT, data)
+        if order is not None:
+            res = numpy.empty_like(out)
+            res[order] = out
+            out = res
+        out.shape = self.shape
         return out[:img_shape[0],:img_shape[1]]
 
-    @timeit
+    @cython.wraparound(False)
+    @cython.boundscheck(False)
+    @cython.cdivision(True)
+    def calc_inverse(self):
+        """
+        Calculate the transposed look-up table, used to distort a corrected
+        image back: a CSR matrix with a line per raw pixel, whose coefficients
+        are normalized by the total coefficient of each corrected pixel.
+        Corrected pixels without any contribution are masked.
+        """
+        cdef int d, j, r, size, lut_size
+        cdef numpy.int32_t p
+        cdef float coef
+        cdef lut_point[:, :] lut
+        cdef double[:] tot
+        cdef numpy.int32_t[:] indices, indptr, current
+        cdef float[:] coefs
+        if self.LUT is None:
+            self.calc_LUT()
+        if self.inverse is None:
+            with self._sem:
+                if self.inverse is None:
+                    lut = self.LUT
+                    size = lut.shape[0]
+                    lut_size = lut.shape[1]
+                    tot = numpy.zeros(size, dtype=numpy.float64)
+                    indptr = numpy.zeros(size + 1, dtype=numpy.int32)
+                    with nogil:
+                        for d in range(size):
+                            for j in range(lut_size):
+                                coef = lut[d, j].coef
+                                if coef <= 0:
+                                    break
+                                tot[d] += coef
+                                indptr[lut[d, j].idx + 1] += 1
+                        for r in range(size):
+                            indptr[r + 1] += indptr[r]
+                    indices = numpy.empty(indptr[size], dtype=numpy.int32)
+                    coefs = numpy.empty(indptr[size], dtype=numpy.float32)
+                    current = numpy.array(indptr[:size], dtype=numpy.int32)
+                    with nogil:
+                        # corrected pixels are visited in order: indices are sorted in each line
+                        for d in range(size):
+                            for j in range(lut_size):
+                                coef = lut[d, j].coef
+                                if coef <= 0:
+                                    break
+                                r = lut[d, j].idx
+                                p = current[r]
+                                indices[p] = d
+                                coefs[p] = coef / tot[d]
+                                current[r] = p + 1
+                    mask = (numpy.asarray(tot) <= 0).astype(numpy.int8)
+                    order = self._calc_tile_order()
+                    if order is not None:
+                        mask[order] = mask.copy()
+                    mask.shape = self.shape
+                    self.inverse_mask = mask
+                    self.inverse = (numpy.asarray(coefs), numpy.asarray(indices), numpy.asarray(indptr))
+
     def uncorrect(self, image):
         """
         Take an image which has been corrected and transform it into it's raw (with loose of information)
 
         @param image: 2D-array with the image
-        @return: uncorrected 2D image and a mask (pixels in raw image
+        @return: uncorrected 2D image and a mask (pixels of the corrected image without any raw pixel)
         """
-        if self.LUT is None:
-            with self._sem:
-                if self.LUT is None:
-                    self.calc_LUT()
-        out = numpy.zeros(self.shape,dtype=numpy.float32)
-        mask = numpy.zeros(self.shape, dtype=numpy.int8)
-        lmask = mask.ravel()
-        lout = out.ravel()
-        lin = image.ravel()
-        tot = self.LUT.coef.sum(axis= -1)
-        for idx in range(self.LUT.shape[0]):
-            t = tot[idx]
-            if t <= 0:
-                lmask[idx] = 1
-                continue
-            val = lin[idx]/t
-            lout[self.LUT[idx].idx] += val * self.LUT[idx].coef
-        return out, mask
+        if image.size != self.shape[0] * self.shape[1]:
+            raise ValueError("image of shape %s does not match a detector of shape %s" % (image.shape, self.shape))
+        if self.inverse is None:
+            self.calc_inverse()
+        coefs, indices, indptr = self.inverse
+        order = self._calc_tile_order()
+        data = native_data(image)
+        if order is not None:
+            data = data[order]
+        out = csr_dot(coefs, indices, indptr, data)
+        if order is not None:
+            res = numpy.empty_like(out)
+            res[order] = out
+            out = res
+        out.shape = self.shape
+        return out, self.inverse_mask.copy()
@@ -29,7 +29,8 @@ import cython
 cimport numpy
 import numpy
 from cython.parallel cimport prange
-from libc.math cimport sin, cos, atan2, sqrt, M_PI
+from cython cimport floating
+from libc.math cimport sin, cos, atan, atan2, sqrt, fabs, fmod, M_PI
 
 
 @cython.cdivision(True)
@@ -216,3 +217,261 @@ def calc_r(double L, double rot1, double rot2, double rot3,
     for i in prange(size, nogil=True, schedule="static"):
         out[i] = r(c1[i], c2[i], L, sinRot1, cosRot1, sinRot2, cosRot2, sinRot3, cosRot3)
     return out
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void fill_all(double L, double sinRot1, double cosRot1, double sinRot2, double cosRot2,
+                   double sinRot3, double cosRot3, double qfactor,
+                   double[:] c1, double[:] c2,
+                   floating[:] out_tth, floating[:] out_chi, floating[:] out_q,
+                   floating[:] out_r,
+                   bint do_tth, bint do_chi, bint do_q, bint do_r) nogil:
+    """
+    Kernel of calc_all, writing directly in float32 or float64 arrays
+    """
+    cdef ssize_t i, size = c1.shape[0]
+    cdef double t1, t2, t3, p1, p2, rho, tth_i
+    for i in prange(size, schedule="static"):
+        p1 = c1[i]
+        p2 = c2[i]
+        t1 = p1 * cosRot2 * cosRot3 + p2 * (cosRot3 * sinRot1 * sinRot2 - cosRot1 * sinRot3) - L * (cosRot1 * cosRot3 * sinRot2 + sinRot1 * sinRot3)
+        t2 = p1 * cosRot2 * sinRot3 + p2 * (cosRot1 * cosRot3 + sinRot1 * sinRot2 * sinRot3) - L * (-(cosRot3 * sinRot1) + cosRot1 * sinRot2 * sinRot3)
+        t3 = p1 * sinRot2 - p2 * cosRot2 * sinRot1 + L * cosRot1 * cosRot2
+        rho = sqrt(t1 * t1 + t2 * t2)
+        tth_i = atan2(rho, t3)
+        if do_tth:
+            out_tth[i] = tth_i
+        if do_chi:
+            out_chi[i] = atan2(t1, t2)
+        if do_q:
+            out_q[i] = qfactor * sin(tth_i / 2.0)
+        if do_r:
+            out_r[i] = L * rho / (t3 * cosRot1 * cosRot2)
+
+
+def calc_all(double L, double rot1, double rot2, double rot3,
+             numpy.ndarray pos1 not None, numpy.ndarray pos2 not None,
+             quantities=("tth", "chi"), wavelength=None, dtype=numpy.float64):
+    """
+    Calculate in parallel, in a single pass over the pixels, any subset of
+    2theta, chi, q and r: the rotated coordinates t1, t2, t3 are calculated
+    once per pixel and shared by all quantities.
+
+    @param L: distance sample - PONI
+    @param rot1: angle1
+    @param rot2: angle2
+    @param rot3: angle3
+    @param pos1: numpy array with distances in meter along dim1 from PONI (Y)
+    @param pos2: numpy array with distances in meter along dim2 from PONI (X)
+    @param quantities: names of the arrays to calculate among "tth", "chi", "q" and "r"
+    @param wavelength: in meter to get q in nm-1, mandatory for q
+    @param dtype: numpy.float32 or numpy.float64, type of the arrays returned (calculations are done in double precision)
+    @return: dict with a flat array for each of the quantities
+    """
+    cdef ssize_t  size = pos1.size
+    cdef bint do_tth = "tth" in quantities
+    cdef bint do_chi = "chi" in quantities
+    cdef bint do_q = "q" in quantities
+    cdef bint do_r = "r" in quantities
+    cdef double qfactor = 0
+    assert pos2.size == size
+    for name in quantities:
+        if name not in ("tth", "chi", "q", "r"):
+            raise KeyError("Unknown quantity %s" % name)
+    dtype = numpy.dtype(dtype)
+    if dtype not in (numpy.dtype(numpy.float32), numpy.dtype(numpy.float64)):
+        raise ValueError("dtype has to be float32 or float64, not %s" % dtype)
+    if do_q:
+        if not wavelength:
+            raise RuntimeError("Scattering vector q cannot be calculated without knowing wavelength !!!")
+        qfactor = 4.0e-9 * M_PI / wavelength
+    cdef double[:] c1 = numpy.ascontiguousarray(pos1.ravel(),dtype=numpy.float64)
+    cdef double[:] c2 = numpy.ascontiguousarray(pos2.ravel(),dtype=numpy.float64)
+    # arrays which are not requested are replaced by a single element placeholder
+    out_tth = numpy.empty(size if do_tth else 1, dtype=dtype)
+    out_chi = numpy.empty(size if do_chi else 1, dtype=dtype)
+    out_q = numpy.empty(size if do_q else 1, dtype=dtype)
+    out_r = numpy.empty(size if do_r else 1, dtype=dtype)
+    if dtype == numpy.dtype(numpy.float32):
+        fill_all[float](L, sin(rot1), cos(rot1), sin(rot2), cos(rot2), sin(rot3), cos(rot3), qfactor,
+                        c1, c2, out_tth, out_chi, out_q, out_r,
+                        do_tth, do_chi, do_q, do_r)
+    else:
+        fill_all[double](L, sin(rot1), cos(rot1), sin(rot2), cos(rot2), sin(rot3), cos(rot3), qfactor,
+                         c1, c2, out_tth, out_chi, out_q, out_r,
+                         do_tth, do_chi, do_q, do_r)
+    result = {}
+    if do_tth:
+        result["tth"] = out_tth
+    if do_chi:
+        result["chi"] = out_chi
+    if do_q:
+        result["q"] = out_q
+    if do_r:
+        result["r"] = out_r
+    return result
+
+
+@cython.cdivision(True)
+cdef inline double rectangle(double x, double y, double L) nogil:
+    """
+    Solid angle of the rectangle between the normal incidence point and
+    the point (x, y) of a plane at distance L (signed)
+    """
+    return atan(x * y / (L * sqrt(L * L + x * x + y * y)))
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void solid_angle_kernel(double L, double[:] c1, double[:] c2, double h1, double h2,
+                             double[:] carea, bint do_area, floating[:] out) nogil:
+    """
+    Kernel of calc_solid_angle, writing directly in float32 or float64 arrays
+    """
+    cdef ssize_t i, size = c1.shape[0]
+    cdef double p1, p2, value
+    for i in prange(size, schedule="static"):
+        p1 = c1[i]
+        p2 = c2[i]
+        if h1 > 0 and h2 > 0:
+            value = (rectangle(p1 + h1, p2 + h2, L) - rectangle(p1 - h1, p2 + h2, L) -
+                     rectangle(p1 + h1, p2 - h2, L) + rectangle(p1 - h1, p2 - h2, L)) * L * L / (4.0 * h1 * h2)
+        else:
+            value = L / sqrt(L * L + p1 * p1 + p2 * p2)
+        if do_area:
+            value = value * carea[i]
+        out[i] = value
+
+
+def calc_solid_angle(double L, numpy.ndarray pos1 not None, numpy.ndarray pos2 not None,
+                     pixel1=None, pixel2=None, area=None, dtype=numpy.float64):
+    """
+    Calculate in parallel, in a single pass, the relative solid angle of
+    every pixel, L / sqrt(L^2 + pos1^2 + pos2^2), multiplied by the relative
+    area of the pixel when given.
+
+    With the pixel size, the exact solid angle of the rectangular pixel in
+    the detector plane is calculated instead, relative to the one of a pixel
+    at the point of normal incidence.
+
+    @param L: distance sample - PONI
+    @param pos1: numpy array with distances in meter along dim1 from PONI (Y) of the center of the pixels
+    @param pos2: numpy array with distances in meter along dim2 from PONI (X) of the center of the pixels
+    @param pixel1: size of the pixels along dim1 in meter, for the exact solid angle
+    @param pixel2: size of the pixels along dim2 in meter, for the exact solid angle
+    @param area: relative area of the pixels (like the spline distortion correction) or None
+    @param dtype: numpy.float32 or numpy.float64, type of the array returned
+    @return: flat array with the relative solid angle of every pixel
+    """
+    cdef ssize_t size = pos1.size
+    cdef bint do_area = area is not None
+    cdef double h1 = 0.5 * pixel1 if (pixel1 and pixel2) else 0.0
+    cdef double h2 = 0.5 * pixel2 if (pixel1 and pixel2) else 0.0
+    assert pos2.size == size
+    dtype = numpy.dtype(dtype)
+    if dtype not in (numpy.dtype(numpy.float32), numpy.dtype(numpy.float64)):
+        raise ValueError("dtype has to be float32 or float64, not %s" % dtype)
+    cdef double[:] c1 = numpy.ascontiguousarray(pos1.ravel(), dtype=numpy.float64)
+    cdef double[:] c2 = numpy.ascontiguousarray(pos2.ravel(), dtype=numpy.float64)
+    cdef double[:] carea
+    if do_area:
+        assert area.size == size
+        carea = numpy.ascontiguousarray(area.ravel(), dtype=numpy.float64)
+    else:
+        carea = numpy.empty(1, dtype=numpy.float64)
+    out = numpy.empty(size, dtype=dtype)
+    if dtype == numpy.dtype(numpy.float32):
+        solid_angle_kernel[float](L, c1, c2, h1, h2, carea, do_area, out)
+    else:
+        solid_angle_kernel[double](L, c1, c2, h1, h2, carea, do_area, out)
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def calc_corners(numpy.ndarray radial not None, numpy.ndarray chi not None):
+    """
+    Build in parallel the 4 corners layout used by the pixel splitting
+    integrators from the values at the vertices of the pixel grid.
+
+    Corners are ordered (i, j), (i+1, j), (i+1, j+1), (i, j+1)
+
+    @param radial: (ny+1, nx+1) array with the radial position (2theta, q or r) of the vertices
+    @param chi: (ny+1, nx+1) array with the azimuthal angle of the vertices
+    @return: (ny, nx, 4, 2) float32 array with (radial, chi) for each corner of each pixel
+    """
+    assert radial.ndim == 2
+    assert chi.shape[0] == radial.shape[0]
+    assert chi.shape[1] == radial.shape[1]
+    cdef ssize_t ny = radial.shape[0] - 1, nx = radial.shape[1] - 1, i, j
+    cdef float[:, :] crad = numpy.ascontiguousarray(radial, dtype=numpy.float32)
+    cdef float[:, :] cchi = numpy.ascontiguousarray(chi, dtype=numpy.float32)
+    cdef numpy.ndarray[numpy.float32_t, ndim = 4] out = numpy.empty((ny, nx, 4, 2), dtype=numpy.float32)
+    cdef float[:, :, :, :] cout = out
+    for i in prange(ny, nogil=True, schedule="static"):
+        for j in range(nx):
+            cout[i, j, 0, 0] = crad[i, j]
+            cout[i, j, 0, 1] = cchi[i, j]
+            cout[i, j, 1, 0] = crad[i + 1, j]
+            cout[i, j, 1, 1] = cchi[i + 1, j]
+            cout[i, j, 2, 0] = crad[i + 1, j + 1]
+            cout[i, j, 2, 1] = cchi[i + 1, j + 1]
+            cout[i, j, 3, 0] = crad[i, j + 1]
+            cout[i, j, 3, 1] = cchi[i, j + 1]
+    return out
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void delta_kernel(float[:, :] cvert, floating[:, :] ccenter, float[:, :] cout, double period) nogil:
+    """
+    Kernel of calc_delta, reading the centers in float32 or float64
+    """
+    cdef ssize_t ny = ccenter.shape[0], nx = ccenter.shape[1], i, j, k
+    cdef double c, d, delta, corner
+    for i in prange(ny, schedule="static"):
+        for j in range(nx):
+            c = ccenter[i, j]
+            delta = 0.0
+            for k in range(4):
+                if k == 0:
+                    corner = cvert[i, j]
+                elif k == 1:
+                    corner = cvert[i + 1, j]
+                elif k == 2:
+                    corner = cvert[i + 1, j + 1]
+                else:
+                    corner = cvert[i, j + 1]
+                d = fabs(corner - c)
+                if period > 0:
+                    d = fmod(d, period)
+                    if period - d < d:
+                        d = period - d
+                if d > delta:
+                    delta = d
+            cout[i, j] = delta
+
+
+def calc_delta(numpy.ndarray vertices not None, numpy.ndarray center not None, double period=0):
+    """
+    Calculate in parallel the max distance between the center of every
+    pixel and any of its 4 corners, taken from the vertices of the grid.
+
+    @param vertices: (ny+1, nx+1) array with the values at the vertices of the pixels
+    @param center: (ny, nx) array with the values at the center of the pixels
+    @param period: period of the values (like 2pi for chi) to handle the wrap-around, 0 if not periodic
+    @return: (ny, nx) float32 array
+    """
+    assert vertices.ndim == 2
+    assert center.ndim == 2
+    assert vertices.shape[0] == center.shape[0] + 1
+    assert vertices.shape[1] == center.shape[1] + 1
+    cdef float[:, :] cvert = numpy.ascontiguousarray(vertices, dtype=numpy.float32)
+    cdef numpy.ndarray[numpy.float32_t, ndim = 2] out = numpy.empty((center.shape[0], center.shape[1]), dtype=numpy.float32)
+    if center.dtype == numpy.float32:
+        delta_kernel[float](cvert, numpy.ascontiguousarray(center), out, period)
+    else:
+        delta_kernel[double](cvert, numpy.ascontiguousarray(center, dtype=numpy.float64), out, period)
+    return out
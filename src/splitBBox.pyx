@@ -29,6 +29,7 @@ import cython
 cimport numpy
 import numpy
 from libc.math cimport fabs
+from .splitBBoxLUT import output_buffer
 
 EPS32 = (1 + numpy.finfo(numpy.float32).eps)
 
@@ -60,7 +61,9 @@ def histoBBox1d(numpy.ndarray weights not None,
                 dark=None,
                 flat=None,
                 solidangle=None,
-                polarization=None):
+                polarization=None,
+                variance=None,
+                out=None):
 
     """
     Calculates histogram of pos0 (tth) weighted by weights
@@ -82,29 +85,32 @@ def histoBBox1d(numpy.ndarray weights not None,
     @param flat: array (of float32) with flat-field image
     @param polarization: array (of float32) with polarization corrections
     @param solidangle: array (of float32) with solid angle corrections
+    @param variance: array (of float32) with the variance of the intensities, accumulated in the same pass (or None)
+    @param out: array (of float32) of size bins receiving I (or None)
 
-    @return 2theta, I, weighted histogram, unweighted histogram
+    @return 2theta, I, weighted histogram, unweighted histogram (and weighted histogram of the variance if variance is given)
     """
     cdef size_t  size = weights.size
     assert pos0.size == size
     assert delta_pos0.size == size
     assert  bins > 1
     cdef ssize_t   bin0_max, bin0_min, bin = 0
-    cdef float data, deltaR, deltaL, deltaA,p1, epsilon = 1e-10, cdummy = 0, ddummy = 0
+    cdef float data, var=0, deltaR, deltaL, deltaA,p1, epsilon = 1e-10, cdummy = 0, ddummy = 0
     cdef float pos0_min=0, pos0_max=0, pos0_maxin=0, pos1_min=0, pos1_max=0, pos1_maxin=0, min0=0, max0=0, fbin0_min=0, fbin0_max=0
-    cdef bint check_pos1=False, check_mask=False, check_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidangle=False
+    cdef bint check_pos1=False, check_mask=False, check_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidangle=False, do_variance=False
 
     cdef numpy.ndarray[numpy.float32_t, ndim = 1] cdata = numpy.ascontiguousarray(weights.ravel(),dtype=numpy.float32)
     cdef numpy.ndarray[numpy.float32_t, ndim = 1] cpos0, dpos0, cpos1, dpos1,cpos0_lower, cpos0_upper
     cdef numpy.int8_t[:] cmask
-    cdef float[:] cflat, cdark, cpolarization, csolidangle
+    cdef float[:] cflat, cdark, cpolarization, csolidangle, cvariance
 
     cpos0 = numpy.ascontiguousarray(pos0.ravel(), dtype=numpy.float32)
     dpos0 = numpy.ascontiguousarray(delta_pos0.ravel(), dtype=numpy.float32)
 
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] outData = numpy.zeros(bins, dtype=numpy.float64)
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] outCount = numpy.zeros(bins, dtype=numpy.float64)
-    cdef numpy.ndarray[numpy.float32_t, ndim = 1] outMerge = numpy.zeros(bins, dtype=numpy.float32)
+    cdef numpy.ndarray[numpy.float32_t, ndim = 1] outMerge = output_buffer(out, (bins,))
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outVariance = numpy.zeros(bins, dtype=numpy.float64)
 
     if  mask is not None:
         assert mask.size == size
@@ -139,6 +145,10 @@ def histoBBox1d(numpy.ndarray weights not None,
         do_solidangle = True
         assert solidangle.size == size
         csolidangle = numpy.ascontiguousarray(solidangle.ravel(), dtype=numpy.float32)
+    if variance is not None:
+        do_variance = True
+        assert variance.size == size
+        cvariance = numpy.ascontiguousarray(variance.ravel(), dtype=numpy.float32)
 
 
     cpos0_lower = numpy.zeros(size, dtype=numpy.float32)
@@ -205,6 +215,8 @@ def histoBBox1d(numpy.ndarray weights not None,
             else:
                 bin0_min = < ssize_t > fbin0_min
 
+            if do_variance:
+                var = cvariance[idx]
             if do_dark:
                 data -= cdark[idx]
             if do_flat:
@@ -218,6 +230,8 @@ def histoBBox1d(numpy.ndarray weights not None,
                 #All pixel is within a single bin
                 outCount[bin0_min] +=  1.0
                 outData[bin0_min] +=  data
+                if do_variance:
+                    outVariance[bin0_min] +=  var
 
             else: #we have pixel spliting.
                 deltaA = 1.0 / (fbin0_max - fbin0_min)
@@ -227,14 +241,20 @@ def histoBBox1d(numpy.ndarray weights not None,
 
                 outCount[bin0_min] +=  (deltaA * deltaL)
                 outData[bin0_min] +=  (data * deltaA * deltaL)
+                if do_variance:
+                    outVariance[bin0_min] +=  (var * deltaA * deltaL)
 
                 outCount[bin0_max] +=  (deltaA * deltaR)
                 outData[bin0_max] +=  (data * deltaA * deltaR)
+                if do_variance:
+                    outVariance[bin0_max] +=  (var * deltaA * deltaR)
 
                 if bin0_min + 1 < bin0_max:
                     for i in range(bin0_min + 1, bin0_max):
                         outCount[i] +=  deltaA
                         outData[i] +=  (data *  deltaA)
+                        if do_variance:
+                            outVariance[i] +=  (var *  deltaA)
 
         for i in range(bins):
                 if outCount[i] > epsilon:
@@ -242,6 +262,8 @@ def histoBBox1d(numpy.ndarray weights not None,
                 else:
                     outMerge[i] = cdummy
 
+    if do_variance:
+        return  outPos, outMerge, outData, outCount, outVariance
     return  outPos, outMerge, outData, outCount
 
 
@@ -264,7 +286,8 @@ def histoBBox2d(numpy.ndarray weights not None,
                 dark=None,
                 flat=None,
                 solidangle=None,
-                polarization=None):
+                polarization=None,
+                out=None):
     """
     Calculate 2D histogram of pos0(tth),pos1(chi) weighted by weights
 
@@ -286,6 +309,7 @@ def histoBBox2d(numpy.ndarray weights not None,
     @param flat: array (of float32) with flat-field image
     @param polarization: array (of float32) with polarization corrections
     @param solidangle: array (of float32) with solid angle corrections
+    @param out: array (of float32) of shape (bins1, bins0) receiving I (or None)
 
     @return  I, edges0, edges1, weighted histogram(2D), unweighted histogram (2D)
     """
@@ -313,7 +337,8 @@ def histoBBox2d(numpy.ndarray weights not None,
     cdef numpy.ndarray[numpy.float32_t, ndim = 1] cpos0_lower = numpy.empty(size,dtype=numpy.float32)
     cdef numpy.ndarray[numpy.float64_t, ndim = 2] outData = numpy.zeros((bins0, bins1), dtype=numpy.float64)
     cdef numpy.ndarray[numpy.float64_t, ndim = 2] outCount = numpy.zeros((bins0, bins1), dtype=numpy.float64)
-    cdef numpy.ndarray[numpy.float32_t, ndim = 2] outMerge = numpy.zeros((bins0, bins1), dtype=numpy.float32)
+    merged = output_buffer(out, (bins1, bins0))
+    cdef numpy.ndarray[numpy.float32_t, ndim = 2] outMerge = merged.T
 
     cdef float min0, max0, min1, max1, deltaR, deltaL, deltaU, deltaD, deltaA, tmp, delta0, delta1
     cdef float pos0_min, pos0_max, pos1_min, pos1_max, pos0_maxin, pos1_maxin
@@ -511,5 +536,5 @@ def histoBBox2d(numpy.ndarray weights not None,
                     outMerge[i, j] = <float> (outData[i, j] / outCount[i, j])
                 else:
                     outMerge[i, j] = cdummy
-    return outMerge.T, edges0, edges1, outData.T, outCount.T
+    return merged, edges0, edges1, outData.T, outCount.T
 
@@ -28,18 +28,27 @@
 import cython
 import os
 from cython.parallel import prange
-from libc.string cimport memset
+from openmp cimport omp_get_max_threads
 import numpy
 cimport numpy
 from libc.math cimport fabs
 cdef struct lut_point:
     numpy.int32_t idx
     numpy.float32_t coef
+
+# pixel types read without conversion
+ctypedef fused any_t:
+    numpy.uint16_t
+    numpy.int32_t
+    numpy.float32_t
+    numpy.float64_t
 try:
     from fastcrc import crc32
 except:
     from zlib import crc32
 EPS32 = (1.0 + numpy.finfo(numpy.float32).eps)
+NATIVE_TYPES = (numpy.dtype(numpy.uint16), numpy.dtype(numpy.int32),
+                numpy.dtype(numpy.float32), numpy.dtype(numpy.float64))
 
 @cython.cdivision(True)
 cdef float getBinNr( float x0, float pos0_min, float delta) nogil:
@@ -51,6 +60,545 @@ cdef float getBinNr( float x0, float pos0_min, float delta) nogil:
     """
     return (x0 - pos0_min) / delta
 
+def native_data(weights):
+    """
+    @param weights: input image
+    @return: flat view of the image if its type is handled natively by the
+             integrators (uint16, int32, float32 or float64), else a float32 copy
+    """
+    weights = numpy.ascontiguousarray(weights.ravel())
+    if weights.dtype not in NATIVE_TYPES:
+        weights = weights.astype(numpy.float32)
+    return weights
+
+def output_buffer(out, shape, dtype=numpy.float32):
+    """
+    @param out: array provided by the caller to receive the result, or None
+    @param shape: expected shape of the result
+    @param dtype: expected type of the result
+    @return: out, checked to be an array of the given type and shape, or a new zeroed array
+    """
+    if out is None:
+        return numpy.zeros(shape, dtype=dtype)
+    if (out.dtype != dtype) or (out.shape != tuple(shape)):
+        raise ValueError("output buffer has to be a %s array of shape %s, got %s of shape %s" % (numpy.dtype(dtype).name, tuple(shape), out.dtype, out.shape))
+    return out
+
+def merge_buffer(out, int bins):
+    """
+    @param out: float32 array of size bins, or 2D float32 array of bins elements (possibly a transposed view), or None
+    @param bins: number of bins of the look-up table
+    @return: out (or a new array of size bins) and a 2D view of it where bin i is at [i // n1, i % n1]
+    """
+    if (out is not None) and (out.ndim == 2):
+        if (out.dtype != numpy.float32) or (out.size != bins):
+            raise ValueError("output buffer has to be a float32 array of %i elements, got %s of shape %s" % (bins, out.dtype, out.shape))
+        return out, out
+    out = output_buffer(out, (bins,))
+    return out, out.reshape(bins, 1)
+
+def preprocess(weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None):
+    """
+    Apply the dark, flat, solid-angle and polarization corrections to an image
+    and flag all dummy-like values with the dummy value.
+    Integer images are read directly, without an intermediate float32 copy.
+
+    @param weights: input image
+    @type weights: ndarray
+    @param dummy: value for dead pixels (optional)
+    @type dummy: float
+    @param delta_dummy: precision for dead-pixel value in dynamic masking
+    @type delta_dummy: float
+    @param dark: array with the dark-current value to be subtracted (if any)
+    @type dark: ndarray
+    @param flat: array with the dark-current value to be divided by (if any)
+    @type flat: ndarray
+    @param solidAngle: array with the solid angle of each pixel to be divided by (if any)
+    @type solidAngle: ndarray
+    @param polarization: array with the polarization correction values to be divided by (if any)
+    @type polarization: ndarray
+    @return: corrected data, flattened
+    @rtype: 1D float32 ndarray
+    """
+    return _preprocess(native_data(weights), dummy, delta_dummy, dark, flat, solidAngle, polarization)
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _preprocess(any_t[:] weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None):
+    """
+    Typed implementation of preprocess
+
+    @param weights: flat input image
+    @type weights: ndarray
+    @param dummy: value for dead pixels (optional)
+    @type dummy: float
+    @param delta_dummy: precision for dead-pixel value in dynamic masking
+    @type delta_dummy: float
+    @param dark: array with the dark-current value to be subtracted (if any)
+    @type dark: ndarray
+    @param flat: array with the dark-current value to be divided by (if any)
+    @type flat: ndarray
+    @param solidAngle: array with the solid angle of each pixel to be divided by (if any)
+    @type solidAngle: ndarray
+    @param polarization: array with the polarization correction values to be divided by (if any)
+    @type polarization: ndarray
+    @return: corrected data, flattened
+    @rtype: 1D float32 ndarray
+    """
+    cdef int i=0, size=weights.shape[0]
+    cdef float data=0, cdummy=0, cddummy=0
+    cdef bint do_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidAngle=False
+    cdef float[:] cdata, cflat, cdark, csolidAngle, cpolarization
+
+    if dummy is not None:
+        do_dummy = True
+        cdummy =  <float>float(dummy)
+        if delta_dummy is None:
+            cddummy = <float>0.0
+        else:
+            cddummy = <float>float(delta_dummy)
+
+    if flat is not None:
+        do_flat = True
+        assert flat.size == size
+        cflat = numpy.ascontiguousarray(flat.ravel(), dtype=numpy.float32)
+    if dark is not None:
+        do_dark = True
+        assert dark.size == size
+        cdark = numpy.ascontiguousarray(dark.ravel(), dtype=numpy.float32)
+    if solidAngle is not None:
+        do_solidAngle = True
+        assert solidAngle.size == size
+        csolidAngle = numpy.ascontiguousarray(solidAngle.ravel(), dtype=numpy.float32)
+    if polarization is not None:
+        do_polarization = True
+        assert polarization.size == size
+        cpolarization = numpy.ascontiguousarray(polarization.ravel(), dtype=numpy.float32)
+
+    if (do_dark + do_flat + do_polarization + do_solidAngle):
+        cdata = numpy.zeros(size,dtype=numpy.float32)
+        if do_dummy:
+            for i in prange(size, nogil=True, schedule="static"):
+                data = weights[i]
+                if ((cddummy!=0) and (fabs(data-cdummy) > cddummy)) or ((cddummy==0) and (data!=cdummy)):
+                    #Nota: -= and /= operatore are seen as reduction in cython parallel.
+                    if do_dark:
+                        data = data - cdark[i]
+                    if do_flat:
+                        data = data / cflat[i]
+                    if do_polarization:
+                        data = data / cpolarization[i]
+                    if do_solidAngle:
+                        data = data / csolidAngle[i]
+                    cdata[i]+=data
+                else: #set all dummy_like values to cdummy. simplifies further processing
+                    cdata[i]+=cdummy
+        else:
+            for i in prange(size, nogil=True, schedule="static"):
+                data = weights[i]
+                if do_dark:
+                    data = data - cdark[i]
+                if do_flat:
+                    data = data / cflat[i]
+                if do_polarization:
+                    data = data / cpolarization[i]
+                if do_solidAngle:
+                    data = data / csolidAngle[i]
+                cdata[i]+=data
+    else:
+        if do_dummy:
+            cdata = numpy.zeros(size,dtype=numpy.float32)
+            for i in prange(size, nogil=True, schedule="static"):
+                data = weights[i]
+                if ((cddummy!=0) and (fabs(data-cdummy) > cddummy)) or ((cddummy==0) and (data!=cdummy)):
+                    cdata[i]+=data
+                else:
+                    cdata[i]+=cdummy
+        else:
+            cdata = numpy.ascontiguousarray(weights, dtype=numpy.float32)
+    return numpy.asarray(cdata)
+
+
+def preprocess_stack(frames, int size, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None):
+    """
+    Apply the corrections to a stack of frames and store them pixel-major,
+    so that all frames are contiguous for a given pixel.
+
+    @param frames: 3D array or sequence of images
+    @param size: number of pixels of each image
+    @type size: int
+    @return: corrected data
+    @rtype: 2D float32 ndarray of shape (size, nframes)
+    """
+    cdef int f, nframes = len(frames)
+    cdef numpy.ndarray[numpy.float32_t, ndim = 2] stack = numpy.empty((size, nframes), dtype=numpy.float32)
+    # correction arrays are converted once for all frames
+    if dark is not None:
+        dark = numpy.ascontiguousarray(dark.ravel(), dtype=numpy.float32)
+    if flat is not None:
+        flat = numpy.ascontiguousarray(flat.ravel(), dtype=numpy.float32)
+    if solidAngle is not None:
+        solidAngle = numpy.ascontiguousarray(solidAngle.ravel(), dtype=numpy.float32)
+    if polarization is not None:
+        polarization = numpy.ascontiguousarray(polarization.ravel(), dtype=numpy.float32)
+    for f in range(nframes):
+        frame = frames[f]
+        assert frame.size == size
+        stack[:, f] = preprocess(frame, dummy, delta_dummy, dark, flat, solidAngle, polarization)
+    return stack
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lut_dot_stack(lut_point[:, :] lut, float[:, :] stack, dummy=None):
+    """
+    Sparse matrix - dense matrix product between a look-up table and a stack
+    of frames: each element of the look-up table is read once for all frames.
+
+    @param lut: look-up table of shape (bins, lut_size)
+    @param stack: preprocessed frames of shape (size, nframes), as returned by preprocess_stack
+    @param dummy: value of dead pixels in the stack and of empty bins
+    @return: merged, weighted and unweighted histograms, each of shape (bins, nframes)
+    @rtype: 3-tuple of ndarrays
+    """
+    cdef int i=0, j=0, f=0, idx=0, bins=lut.shape[0], lut_size=lut.shape[1], nframes=stack.shape[1]
+    cdef double epsilon=1e-10
+    cdef float data=0, coef=0, cdummy=0
+    cdef bint do_dummy=False
+    cdef numpy.ndarray[numpy.float64_t, ndim = 2] outData = numpy.zeros((bins, nframes), dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 2] outCount = numpy.zeros((bins, nframes), dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float32_t, ndim = 2] outMerge = numpy.zeros((bins, nframes), dtype=numpy.float32)
+
+    if dummy is not None:
+        do_dummy = True
+        cdummy =  <float>float(dummy)
+
+    for i in prange(bins, nogil=True, schedule="guided"):
+        for j in range(lut_size):
+            idx = lut[i, j].idx
+            coef = lut[i, j].coef
+            if idx <= 0 and coef <= 0.0:
+                break
+            for f in range(nframes):
+                data = stack[idx, f]
+                if do_dummy and data==cdummy:
+                    continue
+                outData[i, f] += coef * data
+                outCount[i, f] += coef
+        for f in range(nframes):
+            if outCount[i, f] > epsilon:
+                outMerge[i, f] += outData[i, f] / outCount[i, f]
+            else:
+                outMerge[i, f] += cdummy
+    return outMerge, outData, outCount
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def csr_dot_stack(float[:] coefs, numpy.int32_t[:] indices, numpy.int32_t[:] indptr, float[:, :] stack, dummy=None):
+    """
+    Sparse matrix - dense matrix product between a CSR matrix and a stack
+    of frames: each element of the matrix is read once for all frames.
+
+    @param coefs, indices, indptr: CSR representation of the look-up table
+    @param stack: preprocessed frames of shape (size, nframes), as returned by preprocess_stack
+    @param dummy: value of dead pixels in the stack and of empty bins
+    @return: merged, weighted and unweighted histograms, each of shape (bins, nframes)
+    @rtype: 3-tuple of ndarrays
+    """
+    cdef int i=0, j=0, f=0, idx=0, bins=indptr.shape[0] - 1, nframes=stack.shape[1]
+    cdef double epsilon=1e-10
+    cdef float data=0, coef=0, cdummy=0
+    cdef bint do_dummy=False
+    cdef numpy.ndarray[numpy.float64_t, ndim = 2] outData = numpy.zeros((bins, nframes), dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 2] outCount = numpy.zeros((bins, nframes), dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float32_t, ndim = 2] outMerge = numpy.zeros((bins, nframes), dtype=numpy.float32)
+
+    if dummy is not None:
+        do_dummy = True
+        cdummy =  <float>float(dummy)
+
+    for i in prange(bins, nogil=True, schedule="guided"):
+        for j in range(indptr[i], indptr[i + 1]):
+            idx = indices[j]
+            coef = coefs[j]
+            for f in range(nframes):
+                data = stack[idx, f]
+                if do_dummy and data==cdummy:
+                    continue
+                outData[i, f] += coef * data
+                outCount[i, f] += coef
+        for f in range(nframes):
+            if outCount[i, f] > epsilon:
+                outMerge[i, f] += outData[i, f] / outCount[i, f]
+            else:
+                outMerge[i, f] += cdummy
+    return outMerge, outData, outCount
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lut_dot_fused(lut_point[:, :] lut, any_t[:] weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, variance=None, out=None):
+    """
+    Look-up table - vector product where the corrections (dark, flat,
+    polarization, solid-angle and dynamic masking) are applied on the fly
+    while reading the pixels: no corrected copy of the image is made and
+    integer images are read without conversion.
+
+    @param lut: look-up table of shape (bins, lut_size)
+    @param weights: flat input image of any type handled natively, see native_data
+    @type weights: ndarray
+    @param dummy: value for dead pixels (optional)
+    @type dummy: float
+    @param delta_dummy: precision for dead-pixel value in dynamic masking
+    @type delta_dummy: float
+    @param dark: array with the dark-current value to be subtracted (if any)
+    @type dark: ndarray
+    @param flat: array with the dark-current value to be divided by (if any)
+    @type flat: ndarray
+    @param solidAngle: array with the solid angle of each pixel to be divided by (if any)
+    @type solidAngle: ndarray
+    @param polarization: array with the polarization correction values to be divided by (if any)
+    @type polarization: ndarray
+    @param variance: variance of the input image, accumulated in the same pass (if any)
+    @type variance: ndarray
+    @param out: float32 array of size bins receiving the merged histogram, or 2D array with the bins in C order, like the transposed result of 2D integrators (optional)
+    @type out: ndarray
+    @return: merged (out if given), weighted and unweighted histograms and weighted histogram of the variance (or None), flat
+    @rtype: 4-tuple of ndarrays
+    """
+    cdef int i=0, j=0, idx=0, bins=lut.shape[0], lut_size=lut.shape[1], size=weights.shape[0]
+    cdef double sum_data=0, sum_count=0, sum_var=0, epsilon=1e-10
+    cdef float data=0, coef=0, norm=0, cdummy=0, cddummy=0
+    cdef bint do_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidAngle=False, do_norm=False, do_variance=False
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outData = numpy.zeros(bins, dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outCount = numpy.zeros(bins, dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outVariance = numpy.zeros(bins, dtype=numpy.float64)
+    cdef float[:, :] outMerge
+    cdef int bins1
+    cdef float[:] cflat, cdark, csolidAngle, cpolarization, cvariance
+
+    merged, outMerge = merge_buffer(out, bins)
+    bins1 = outMerge.shape[1]
+
+    if dummy is not None:
+        do_dummy = True
+        cdummy =  <float>float(dummy)
+        if delta_dummy is None:
+            cddummy = <float>0.0
+        else:
+            cddummy = <float>float(delta_dummy)
+    if flat is not None:
+        do_flat = True
+        assert flat.size == size
+        cflat = numpy.ascontiguousarray(flat.ravel(), dtype=numpy.float32)
+    if dark is not None:
+        do_dark = True
+        assert dark.size == size
+        cdark = numpy.ascontiguousarray(dark.ravel(), dtype=numpy.float32)
+    if solidAngle is not None:
+        do_solidAngle = True
+        assert solidAngle.size == size
+        csolidAngle = numpy.ascontiguousarray(solidAngle.ravel(), dtype=numpy.float32)
+    if polarization is not None:
+        do_polarization = True
+        assert polarization.size == size
+        cpolarization = numpy.ascontiguousarray(polarization.ravel(), dtype=numpy.float32)
+    if variance is not None:
+        do_variance = True
+        assert variance.size == size
+        cvariance = numpy.ascontiguousarray(variance.ravel(), dtype=numpy.float32)
+    do_norm = do_flat or do_polarization or do_solidAngle
+
+    for i in prange(bins, nogil=True, schedule="guided"):
+        sum_data = 0.0
+        sum_count = 0.0
+        sum_var = 0.0
+        for j in range(lut_size):
+            idx = lut[i, j].idx
+            coef = lut[i, j].coef
+            if idx <= 0 and coef <= 0.0:
+                break
+            data = weights[idx]
+            if do_dummy and (((cddummy!=0) and (fabs(data-cdummy) <= cddummy)) or ((cddummy==0) and (data==cdummy))):
+                continue
+            if do_dark:
+                data = data - cdark[idx]
+            if do_norm:
+                # a single division for all multiplicative corrections
+                norm = 1.0
+                if do_flat:
+                    norm = norm * cflat[idx]
+                if do_polarization:
+                    norm = norm * cpolarization[idx]
+                if do_solidAngle:
+                    norm = norm * csolidAngle[idx]
+                data = data / norm
+            sum_data = sum_data + coef * data
+            sum_count = sum_count + coef
+            if do_variance:
+                sum_var = sum_var + coef * cvariance[idx]
+        outData[i] += sum_data
+        outCount[i] += sum_count
+        outVariance[i] += sum_var
+        if sum_count > epsilon:
+            outMerge[i // bins1, i % bins1] = sum_data / sum_count
+        else:
+            outMerge[i // bins1, i % bins1] = cdummy
+    if do_variance:
+        return merged, outData, outCount, outVariance
+    return merged, outData, outCount, None
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def csr_dot_fused(float[:] coefs, numpy.int32_t[:] indices, numpy.int32_t[:] indptr, any_t[:] weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, variance=None, out=None):
+    """
+    CSR matrix - vector product where the corrections (dark, flat,
+    polarization, solid-angle and dynamic masking) are applied on the fly
+    while reading the pixels: no corrected copy of the image is made and
+    integer images are read without conversion.
+
+    @param coefs, indices, indptr: CSR representation of the look-up table
+    @param weights: flat input image of any type handled natively, see native_data
+    @type weights: ndarray
+    @param dummy: value for dead pixels (optional)
+    @type dummy: float
+    @param delta_dummy: precision for dead-pixel value in dynamic masking
+    @type delta_dummy: float
+    @param dark: array with the dark-current value to be subtracted (if any)
+    @type dark: ndarray
+    @param flat: array with the dark-current value to be divided by (if any)
+    @type flat: ndarray
+    @param solidAngle: array with the solid angle of each pixel to be divided by (if any)
+    @type solidAngle: ndarray
+    @param polarization: array with the polarization correction values to be divided by (if any)
+    @type polarization: ndarray
+    @param variance: variance of the input image, accumulated in the same pass (if any)
+    @type variance: ndarray
+    @param out: float32 array of size bins receiving the merged histogram, or 2D array with the bins in C order, like the transposed result of 2D integrators (optional)
+    @type out: ndarray
+    @return: merged (out if given), weighted and unweighted histograms and weighted histogram of the variance (or None), flat
+    @rtype: 4-tuple of ndarrays
+    """
+    cdef int i=0, j=0, idx=0, bins=indptr.shape[0] - 1, size=weights.shape[0]
+    cdef double sum_data=0, sum_count=0, sum_var=0, epsilon=1e-10
+    cdef float data=0, coef=0, norm=0, cdummy=0, cddummy=0
+    cdef bint do_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidAngle=False, do_norm=False, do_variance=False
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outData = numpy.zeros(bins, dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outCount = numpy.zeros(bins, dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outVariance = numpy.zeros(bins, dtype=numpy.float64)
+    cdef float[:, :] outMerge
+    cdef int bins1
+    cdef float[:] cflat, cdark, csolidAngle, cpolarization, cvariance
+
+    merged, outMerge = merge_buffer(out, bins)
+    bins1 = outMerge.shape[1]
+
+    if dummy is not None:
+        do_dummy = True
+        cdummy =  <float>float(dummy)
+        if delta_dummy is None:
+            cddummy = <float>0.0
+        else:
+            cddummy = <float>float(delta_dummy)
+    if flat is not None:
+        do_flat = True
+        assert flat.size == size
+        cflat = numpy.ascontiguousarray(flat.ravel(), dtype=numpy.float32)
+    if dark is not None:
+        do_dark = True
+        assert dark.size == size
+        cdark = numpy.ascontiguousarray(dark.ravel(), dtype=numpy.float32)
+    if solidAngle is not None:
+        do_solidAngle = True
+        assert solidAngle.size == size
+        csolidAngle = numpy.ascontiguousarray(solidAngle.ravel(), dtype=numpy.float32)
+    if polarization is not None:
+        do_polarization = True
+        assert polarization.size == size
+        cpolarization = numpy.ascontiguousarray(polarization.ravel(), dtype=numpy.float32)
+    if variance is not None:
+        do_variance = True
+        assert variance.size == size
+        cvariance = numpy.ascontiguousarray(variance.ravel(), dtype=numpy.float32)
+    do_norm = do_flat or do_polarization or do_solidAngle
+
+    for i in prange(bins, nogil=True, schedule="guided"):
+        sum_data = 0.0
+        sum_count = 0.0
+        sum_var = 0.0
+        for j in range(indptr[i], indptr[i + 1]):
+            idx = indices[j]
+            coef = coefs[j]
+            data = weights[idx]
+            if do_dummy and (((cddummy!=0) and (fabs(data-cdummy) <= cddummy)) or ((cddummy==0) and (data==cdummy))):
+                continue
+            if do_dark:
+                data = data - cdark[idx]
+            if do_norm:
+                # a single division for all multiplicative corrections
+                norm = 1.0
+                if do_flat:
+                    norm = norm * cflat[idx]
+                if do_polarization:
+                    norm = norm * cpolarization[idx]
+                if do_solidAngle:
+                    norm = norm * csolidAngle[idx]
+                data = data / norm
+            sum_data = sum_data + coef * data
+            sum_count = sum_count + coef
+            if do_variance:
+                sum_var = sum_var + coef * cvariance[idx]
+        outData[i] += sum_data
+        outCount[i] += sum_count
+        outVariance[i] += sum_var
+        if sum_count > epsilon:
+            outMerge[i // bins1, i % bins1] = sum_data / sum_count
+        else:
+            outMerge[i // bins1, i % bins1] = cdummy
+    if do_variance:
+        return merged, outData, outCount, outVariance
+    return merged, outData, outCount, None
+
+def check_memory(nbytes, description):
+    """
+    @param nbytes: size of the array about to be allocated
+    @param description: what the array is, for the error message
+    @raise MemoryError: if the array is larger than the memory of the system
+    """
+    if (os.name == "posix") and ("SC_PAGE_SIZE" in os.sysconf_names) and ("SC_PHYS_PAGES" in os.sysconf_names):
+        memsize =  os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+        if memsize <  nbytes:
+            raise MemoryError("%s is %.3fGB whereas the memory of the system is only %s"%(description, nbytes / 1e9, memsize))
+    #else hope we have enough memory
+
+def allocate_lut(outCount):
+    """
+    @param outCount: number of contributions to each bin, flat
+    @return: zeroed look-up table of shape (bins, lut_size), flat views on its indices and coefficients and the position of each bin in these views
+    """
+    bins = outCount.size
+    lut_size = outCount.max()
+    check_memory(bins * lut_size * sizeof(lut_point), "Lookup-table (%i, %i)" % (bins, lut_size))
+    lut = numpy.zeros((bins, lut_size), dtype=[("idx", numpy.int32), ("coef", numpy.float32)]).view(numpy.recarray)
+    flat = lut.reshape(-1)
+    return lut, flat.idx, flat.coef, numpy.arange(bins, dtype=numpy.int32) * lut_size
+
+def allocate_csr(outCount):
+    """
+    @param outCount: number of contributions to each bin, flat
+    @return: zeroed coefficients and indices of a CSR matrix, its indptr and the position of each bin in the first two
+    """
+    bins = outCount.size
+    indptr = numpy.zeros(bins + 1, dtype=numpy.int32)
+    indptr[1:] = outCount.cumsum(dtype=numpy.int32)
+    nnz = indptr[bins]
+    check_memory(nnz * (sizeof(numpy.int32_t) + sizeof(numpy.float32_t)), "CSR matrix with %i elements" % nnz)
+    return numpy.zeros(nnz, dtype=numpy.float32), numpy.zeros(nnz, dtype=numpy.int32), indptr, indptr[:bins]
+
 class HistoBBox1d(object):
     @cython.boundscheck(False)
     def __init__(self,
@@ -64,10 +612,15 @@ class HistoBBox1d(object):
                  mask=None,
                  mask_checksum=None,
                  allow_pos0_neg=False,
-                 unit="undefined"):
+                 unit="undefined",
+                 nthread=None):
 
         cdef int i, size
         self.size = pos0.size
+        if nthread is not None and nthread > 0:
+            self.nthread = int(nthread)
+        else:
+            self.nthread = omp_get_max_threads()
         assert delta_pos0.size == self.size
         self.bins = bins
         self.lut_size = 0
@@ -115,25 +668,29 @@ class HistoBBox1d(object):
         self.delta = (self.pos0_max - self.pos0_min) / bins
         self.lut_max_idx = self.calc_lut()
         self.outPos = numpy.linspace(self.pos0_min+0.5*self.delta, pos0_maxin-0.5*self.delta, self.bins)
-        self.lut_checksum = crc32(self.lut)
+        self.lut_checksum = self.calc_checksum()
         self.unit=unit
 
     @cython.cdivision(True)
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def calc_lut(self):
-        'calculate the max number of elements in the LUT and populate it'
-        cdef float delta=self.delta, pos0_min=self.pos0_min, pos1_min, pos1_max, min0, max0, fbin0_min, fbin0_max, deltaL, deltaR, deltaA
-        cdef int bin0_min, bin0_max, bins = self.bins, lut_size, i, size
-        cdef numpy.int32_t k,idx #same as numpy.int32
+    def count_contributions(self):
+        """
+        First pass over the pixels: count the contributions to each bin
+
+        @return: number of contributions of each chunk of pixels to each bin
+        @rtype: ndarray of shape (nthread, bins)
+        """
+        cdef float delta=self.delta, pos0_min=self.pos0_min, pos1_min, pos1_max, min0, max0
+        cdef int bin0_min, bin0_max, bins = self.bins, i, size = self.size
+        cdef int t, start, stop, nchunk=self.nthread, chunk=(self.size + nchunk - 1) // nchunk
+        cdef numpy.int32_t idx
         cdef bint check_mask, check_pos1
-        cdef numpy.ndarray[numpy.int32_t, ndim = 1] outMax = numpy.zeros(bins, dtype=numpy.int32)
+        cdef numpy.ndarray[numpy.int32_t, ndim = 2] outMax = numpy.zeros((nchunk, bins), dtype=numpy.int32)
         cdef float[:] cpos0_sup = self.cpos0_sup
         cdef float[:] cpos0_inf = self.cpos0_inf
         cdef float[:] cpos1_min, cpos1_max
-        cdef numpy.ndarray[lut_point, ndim = 2] lut
         cdef numpy.int8_t[:] cmask
-        size = self.size
         if self.check_mask:
             cmask = self.cmask
             check_mask = True
@@ -148,9 +705,12 @@ class HistoBBox1d(object):
             pos1_min = self.pos1_min
         else:
             check_pos1 = False
-#NOGIL
-        with nogil:
-            for idx in range(size):
+        for t in prange(nchunk, nogil=True, schedule="static", chunksize=1, num_threads=nchunk):
+            start = t * chunk
+            stop = start + chunk
+            if stop > size:
+                stop = size
+            for idx in range(start, stop):
                 if (check_mask) and (cmask[idx]):
                     continue
 
@@ -160,10 +720,8 @@ class HistoBBox1d(object):
                 if check_pos1 and ((cpos1_max[idx] < pos1_min) or (cpos1_min[idx] > pos1_max)):
                     continue
 
-                fbin0_min = getBinNr(min0, pos0_min, delta)
-                fbin0_max = getBinNr(max0, pos0_min, delta)
-                bin0_min = < int > fbin0_min
-                bin0_max = < int > fbin0_max
+                bin0_min = < int > getBinNr(min0, pos0_min, delta)
+                bin0_max = < int > getBinNr(max0, pos0_min, delta)
 
                 if (bin0_max < 0) or (bin0_min >= bins):
                     continue
@@ -172,32 +730,51 @@ class HistoBBox1d(object):
                 if  bin0_min < 0:
                     bin0_min = 0
 
-                if bin0_min == bin0_max:
-                    #All pixel is within a single bin
-                    outMax[bin0_min] += 1
+                for i in range(bin0_min, bin0_max + 1):
+                    outMax[t, i] += 1
+        return outMax
 
-                else: #we have pixel spliting.
-                    for i in range(bin0_min, bin0_max + 1):
-                        outMax[i] += 1
+    @cython.cdivision(True)
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def fill_contributions(self, numpy.int32_t[:, :] position, numpy.int32_t[:] indices, float[:] coefs):
+        """
+        Second pass over the pixels: store the index and the coefficient of
+        each contribution, whatever the storage of the look-up table
+
+        @param position: where each chunk of pixels writes its next contribution to each bin, updated in place
+        @param indices: receives the index of the pixel of each contribution
+        @param coefs: receives the fraction of the pixel falling in the bin
+        """
+        cdef float delta=self.delta, pos0_min=self.pos0_min, pos1_min, pos1_max, min0, max0, fbin0_min, fbin0_max, deltaL, deltaR, deltaA
+        cdef int bin0_min, bin0_max, bins = self.bins, i, size = self.size
+        cdef int t, start, stop, nchunk=self.nthread, chunk=(self.size + nchunk - 1) // nchunk
+        cdef numpy.int32_t k, idx
+        cdef bint check_mask, check_pos1
+        cdef float[:] cpos0_sup = self.cpos0_sup
+        cdef float[:] cpos0_inf = self.cpos0_inf
+        cdef float[:] cpos1_min, cpos1_max
+        cdef numpy.int8_t[:] cmask
+        if self.check_mask:
+            cmask = self.cmask
+            check_mask = True
+        else:
+            check_mask = False
 
-        lut_size = outMax.max()
-        #just recycle the outMax array
-        #outMax = numpy.zeros((bins0,bins1), dtype=numpy.int32)
-        memset(&outMax[0], 0, bins * sizeof(numpy.int32_t))
-
-        self.lut_size = lut_size
-
-        lut_nbytes = bins*lut_size*sizeof(lut_point)
-        if (os.name == "posix") and ("SC_PAGE_SIZE" in os.sysconf_names) and ("SC_PHYS_PAGES" in os.sysconf_names):
-            memsize =  os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
-            if memsize <  lut_nbytes:
-                raise MemoryError("Lookup-table (%i, %i) is %.3fGB whereas the memory of the system is only %s"%(bins,lut_size,lut_nbytes,memsize))
-        #else hope we have enough memory
-        lut = numpy.recarray(shape=(bins, lut_size),dtype=[("idx",numpy.int32),("coef",numpy.float32)])
-        memset(&lut[0,0], 0, bins*lut_size*sizeof(lut_point))
-        #NOGIL
-        with nogil:
-            for idx in range(size):
+        if self.check_pos1:
+            check_pos1 = True
+            cpos1_min = self.cpos1_min
+            cpos1_max = self.cpos1_max
+            pos1_max = self.pos1_max
+            pos1_min = self.pos1_min
+        else:
+            check_pos1 = False
+        for t in prange(nchunk, nogil=True, schedule="static", chunksize=1, num_threads=nchunk):
+            start = t * chunk
+            stop = start + chunk
+            if stop > size:
+                stop = size
+            for idx in range(start, stop):
                 if (check_mask) and (cmask[idx]):
                     continue
 
@@ -221,40 +798,58 @@ class HistoBBox1d(object):
 
                 if bin0_min == bin0_max:
                     #All pixel is within a single bin
-                    k = outMax[bin0_min]
-                    lut[bin0_min, k].idx = idx
-                    lut[bin0_min, k].coef = 1.0
-                    outMax[bin0_min] = k + 1
+                    k = position[t, bin0_min]
+                    indices[k] = idx
+                    coefs[k] = 1.0
+                    position[t, bin0_min] = k + 1
                 else: #we have pixel splitting.
                     deltaA = 1.0 / (fbin0_max - fbin0_min)
 
                     deltaL = (bin0_min + 1) - fbin0_min
                     deltaR = fbin0_max - (bin0_max)
 
-                    k = outMax[bin0_min]
-                    lut[bin0_min, k].idx = idx
-                    lut[bin0_min, k].coef = (deltaA * deltaL)
-                    outMax[bin0_min] = k + 1
+                    k = position[t, bin0_min]
+                    indices[k] = idx
+                    coefs[k] = (deltaA * deltaL)
+                    position[t, bin0_min] = k + 1
 
-                    k = outMax[bin0_max]
-                    lut[bin0_max, k].idx = idx
-                    lut[bin0_max, k].coef = (deltaA * deltaR)
-                    outMax[bin0_max] = k + 1
+                    k = position[t, bin0_max]
+                    indices[k] = idx
+                    coefs[k] = (deltaA * deltaR)
+                    position[t, bin0_max] = k + 1
 
                     if bin0_min + 1 < bin0_max:
                         for i in range(bin0_min + 1, bin0_max):
-                            k = outMax[i]
-                            lut[i, k].idx = idx
-                            lut[i, k].coef = (deltaA)
-                            outMax[i] = k + 1
-        self.lut = lut
-        return outMax
+                            k = position[t, i]
+                            indices[k] = idx
+                            coefs[k] = (deltaA)
+                            position[t, i] = k + 1
+
+    def calc_lut(self):
+        'calculate the number of elements per bin and populate the look-up table'
+        outMax = self.count_contributions()
+        outCount = outMax.sum(axis=0, dtype=numpy.int32)
+        self.lut_size = int(outCount.max())
+        indices, coefs, start = self.allocate(outCount)
+        #each chunk of pixels writes to a bin after the contributions of the previous chunks
+        self.fill_contributions(outMax.cumsum(axis=0, dtype=numpy.int32) - outMax + start, indices, coefs)
+        return outCount
+
+    def allocate(self, outCount):
+        """
+        @param outCount: number of contributions to each bin
+        @return: indices and coefficients of the look-up table to be filled and the position of each bin in them
+        """
+        self.lut, indices, coefs, start = allocate_lut(outCount)
+        return indices, coefs, start
 
+    def calc_checksum(self):
+        """
+        @return: checksum of the look-up table, used to check if the device copy is up to date
+        """
+        return crc32(self.lut)
 
-    @cython.cdivision(True)
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    def integrate(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None):
+    def integrate(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, fused=False, variance=None, out=None):
         """
         Actually perform the integration which in this case looks more like a matrix-vector product
         
@@ -272,113 +867,117 @@ class HistoBBox1d(object):
         @type solidAngle: ndarray
         @param polarization: array with the polarization correction values to be divided by (if any)
         @type polarization: ndarray
-        @return : positions, pattern, weighted_histogram and unweighted_histogram
+        @param fused: apply the corrections on the fly in the product instead of making a corrected copy of the image first
+        @type fused: bool
+        @param variance: variance of the input image, accumulated in the same pass (if any)
+        @type variance: ndarray
+        @param out: float32 array of size bins receiving the pattern instead of a newly allocated one (optional)
+        @type out: ndarray
+        @return : positions, pattern, weighted_histogram and unweighted_histogram (and weighted histogram of the variance if variance is given)
         @rtype: 4-tuple of ndarrays
         
         """
-        cdef int i=0, j=0, idx=0, bins=self.bins, lut_size=self.lut_size, size=self.size
-        cdef double sum_data=0, sum_count=0, epsilon=1e-10
-        cdef float data=0, coef=0, cdummy=0, cddummy=0
-        cdef bint do_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidAngle=False
-        cdef numpy.ndarray[numpy.float64_t, ndim = 1] outData = numpy.zeros(self.bins, dtype=numpy.float64)
-        cdef numpy.ndarray[numpy.float64_t, ndim = 1] outCount = numpy.zeros(self.bins, dtype=numpy.float64)
-        cdef numpy.ndarray[numpy.float32_t, ndim = 1] outMerge = numpy.zeros(self.bins, dtype=numpy.float32)
-        cdef lut_point[:,:] lut = self.lut
-        cdef float[:] cdata, tdata, cflat, cdark, csolidAngle, cpolarization
-
-        assert size == weights.size
-
-        if dummy is not None:
-            do_dummy = True
-            cdummy =  <float>float(dummy)
-            if delta_dummy is None:
-                cddummy = <float>0.0
-            else:
-                cddummy = <float>float(delta_dummy)
-
-        if flat is not None:
-            do_flat = True
-            assert flat.size == size
-            cflat = numpy.ascontiguousarray(flat.ravel(), dtype=numpy.float32)
-        if dark is not None:
-            do_dark = True
-            assert dark.size == size
-            cdark = numpy.ascontiguousarray(dark.ravel(), dtype=numpy.float32)
-        if solidAngle is not None:
-            do_solidAngle = True
-            assert solidAngle.size == size
-            csolidAngle = numpy.ascontiguousarray(solidAngle.ravel(), dtype=numpy.float32)
-        if polarization is not None:
-            do_polarization = True
-            assert polarization.size == size
-            cpolarization = numpy.ascontiguousarray(polarization.ravel(), dtype=numpy.float32)
-
-        if (do_dark + do_flat + do_polarization + do_solidAngle):
-            tdata = numpy.ascontiguousarray(weights.ravel(), dtype=numpy.float32)
-            cdata = numpy.zeros(size,dtype=numpy.float32)
-            if do_dummy:
-                for i in prange(size, nogil=True, schedule="static"):
-                    data = tdata[i]
-                    if ((cddummy!=0) and (fabs(data-cdummy) > cddummy)) or ((cddummy==0) and (data!=cdummy)):
-                        #Nota: -= and /= operatore are seen as reduction in cython parallel.
-                        if do_dark:
-                            data = data - cdark[i]
-                        if do_flat:
-                            data = data / cflat[i]
-                        if do_polarization:
-                            data = data / cpolarization[i]
-                        if do_solidAngle:
-                            data = data / csolidAngle[i]
-                        cdata[i]+=data
-                    else: #set all dummy_like values to cdummy. simplifies further processing
-                        cdata[i]+=cdummy
-            else:
-                for i in prange(size, nogil=True, schedule="static"):
-                    data = tdata[i]
-                    if do_dark:
-                        data = data - cdark[i]
-                    if do_flat:
-                        data = data / cflat[i]
-                    if do_polarization:
-                        data = data / cpolarization[i]
-                    if do_solidAngle:
-                        data = data / csolidAngle[i]
-                    cdata[i]+=data
+        assert self.size == weights.size
+
+        if (not fused) and (weights.dtype != numpy.float32) and \
+                (dark is None) and (flat is None) and (solidAngle is None) and (polarization is None):
+            # nothing to correct: read the raw pixels in the product instead of converting the image
+            fused = True
+        if fused:
+            data = native_data(weights)
         else:
-            if do_dummy:
-                tdata = numpy.ascontiguousarray(weights.ravel(), dtype=numpy.float32)
-                cdata = numpy.zeros(size,dtype=numpy.float32)
-                for i in prange(size, nogil=True, schedule="static"):
-                    data = tdata[i]
-                    if ((cddummy!=0) and (fabs(data-cdummy) > cddummy)) or ((cddummy==0) and (data!=cdummy)):
-                        cdata[i]+=data
-                    else:
-                        cdata[i]+=cdummy
-            else:
-                cdata = numpy.ascontiguousarray(weights.ravel(), dtype=numpy.float32)
-
-        for i in prange(bins, nogil=True, schedule="guided"):
-            sum_data = 0.0
-            sum_count = 0.0
-            for j in range(lut_size):
-                idx = lut[i, j].idx
-                coef = lut[i, j].coef
-                if idx <= 0 and coef <= 0.0:
-                    break
-                data = cdata[idx]
-                if do_dummy and data==cdummy:
-                    continue
+            # the corrected copy has its dummy-like values flagged with dummy
+            data = preprocess(weights, dummy, delta_dummy, dark, flat, solidAngle, polarization)
+            delta_dummy = dark = flat = solidAngle = polarization = None
+        merged, weighted, unweighted, var = self.dot(data, dummy, delta_dummy, dark, flat, solidAngle, polarization, variance, output_buffer(out, (self.bins,)))
+        if var is None:
+            return self.outPos, merged, weighted, unweighted
+        return self.outPos, merged, weighted, unweighted, var
+
+    def dot(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, variance=None, out=None):
+        """
+        @param weights: flat image, as returned by native_data or preprocess
+        @return: merged, weighted and unweighted histograms and weighted histogram of the variance (or None), see lut_dot_fused
+        """
+        return lut_dot_fused(self.lut, weights, dummy, delta_dummy, dark, flat, solidAngle, polarization, variance, out)
 
-                sum_data = sum_data + coef * data
-                sum_count = sum_count + coef
-            outData[i] += sum_data
-            outCount[i] += sum_count
-            if sum_count > epsilon:
-                outMerge[i] += sum_data / sum_count
-            else:
-                outMerge[i] += cdummy
-        return  self.outPos, outMerge, outData, outCount
+    def dot_stack(self, stack, dummy=None):
+        """
+        @param stack: preprocessed frames, as returned by preprocess_stack
+        @return: merged, weighted and unweighted histograms, each of shape (bins, nframes)
+        """
+        return lut_dot_stack(self.lut, stack, dummy)
+
+    def integrate_stack(self, frames, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, out=None):
+        """
+        Integrate a stack of frames at once: the look-up table is applied to
+        all frames as a sparse matrix - dense matrix product.
+
+        @param frames: 3D array or sequence of input images
+        @type frames: ndarray
+        @param dummy: value for dead pixels (optional)
+        @type dummy: float
+        @param delta_dummy: precision for dead-pixel value in dynamic masking
+        @type delta_dummy: float
+        @param dark: array with the dark-current value to be subtracted (if any)
+        @type dark: ndarray
+        @param flat: array with the dark-current value to be divided by (if any)
+        @type flat: ndarray
+        @param solidAngle: array with the solid angle of each pixel to be divided by (if any)
+        @type solidAngle: ndarray
+        @param polarization: array with the polarization correction values to be divided by (if any)
+        @type polarization: ndarray
+        @param out: float32 array of shape (nframes, bins) receiving the patterns (optional)
+        @type out: ndarray
+        @return : positions, patterns, weighted_histograms and unweighted_histograms, the last three of shape (nframes, bins)
+        @rtype: 4-tuple of ndarrays
+        """
+        stack = preprocess_stack(frames, self.size, dummy, delta_dummy, dark, flat, solidAngle, polarization)
+        outMerge, outData, outCount = self.dot_stack(stack, dummy)
+        if out is None:
+            out = outMerge.T.copy()
+        else:
+            output_buffer(out, (stack.shape[1], self.bins))[...] = outMerge.T
+        return self.outPos, out, outData.T.copy(), outCount.T.copy()
+
+
+
+class HistoBBox1dCSR(HistoBBox1d):
+    """
+    Same as HistoBBox1d but the look-up table is stored in compressed sparse
+    row (CSR) format: data/indices/indptr, like scipy.sparse.csr_matrix.
+
+    Memory scales with the number of pixel-bin contributions instead of
+    bins * lut_size, and the integration does not walk any padding.
+    """
+    def allocate(self, outCount):
+        """
+        @param outCount: number of contributions to each bin, flat
+        @return: indices and coefficients of the CSR matrix to be filled and the position of each bin in them
+        """
+        self.data, self.indices, self.indptr, start = allocate_csr(outCount)
+        self.nnz = int(self.indptr[-1])
+        return self.indices, self.data, start
+
+    def calc_checksum(self):
+        """
+        @return: checksum of the CSR matrix
+        """
+        return crc32(self.indptr) ^ crc32(self.indices) ^ crc32(self.data)
+
+    def dot(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, variance=None, out=None):
+        """
+        @param weights: flat image, as returned by native_data or preprocess
+        @return: merged, weighted and unweighted histograms and weighted histogram of the variance (or None), flat, see csr_dot_fused
+        """
+        return csr_dot_fused(self.data, self.indices, self.indptr, weights, dummy, delta_dummy, dark, flat, solidAngle, polarization, variance, out)
 
+    def dot_stack(self, stack, dummy=None):
+        """
+        @param stack: preprocessed frames, as returned by preprocess_stack
+        @return: merged, weighted and unweighted histograms, each of shape (bins, nframes)
+        """
+        return csr_dot_stack(self.data, self.indices, self.indptr, stack, dummy)
 
 
 ################################################################################
@@ -398,10 +997,15 @@ class HistoBBox2d(object):
                  mask=None,
                  mask_checksum=None,
                  allow_pos0_neg=False,
-                 unit="undefined"):
+                 unit="undefined",
+                 nthread=None):
 
         cdef int i, size, bin0, bin1
         self.size = pos0.size
+        if nthread is not None and nthread > 0:
+            self.nthread = int(nthread)
+        else:
+            self.nthread = omp_get_max_threads()
         assert delta_pos0.size == self.size
         assert pos1.size == self.size
         assert delta_pos1.size == self.size
@@ -461,36 +1065,43 @@ class HistoBBox2d(object):
         self.outPos0 = numpy.linspace(self.pos0_min+0.5*self.delta0, pos0_maxin-0.5*self.delta0, bins0)
         self.outPos1 = numpy.linspace(self.pos1_min+0.5*self.delta1, pos1_maxin-0.5*self.delta1, bins1)
         self.unit=unit
-        self.lut.shape = -1, self.lut_size #this makes integration look like a 1D integration
-        self.lut_checksum = crc32(self.lut) 
+        self.lut_checksum = self.calc_checksum()
         
     @cython.boundscheck(False)
     @cython.wraparound(False)
     @cython.cdivision(True)
-    def calc_lut(self):
-        'calculate the max number of elements in the LUT and populate it'
-        cdef float delta0=self.delta0, pos0_min=self.pos0_min, min0, max0, fbin0_min, fbin0_max
-        cdef float delta1=self.delta1, pos1_min=self.pos1_min, min1, max1, fbin1_min, fbin1_max 
-        cdef int bin0_min, bin0_max, bins0 = self.bins[0] 
-        cdef int bin1_min, bin1_max, bins1 = self.bins[1] 
-        cdef numpy.int32_t k, idx, lut_size, i, j, size=self.size
+    def count_contributions(self):
+        """
+        First pass over the pixels: count the contributions to each bin
+
+        @return: number of contributions of each chunk of pixels to each bin, the bins being flattened as bin0 * bins1 + bin1
+        @rtype: ndarray of shape (nthread, bins0 * bins1)
+        """
+        cdef float delta0=self.delta0, pos0_min=self.pos0_min, min0, max0
+        cdef float delta1=self.delta1, pos1_min=self.pos1_min, min1, max1
+        cdef int bin0_min, bin0_max, bins0 = self.bins[0]
+        cdef int bin1_min, bin1_max, bins1 = self.bins[1]
+        cdef int t, start, stop, nchunk=self.nthread, chunk=(self.size + nchunk - 1) // nchunk
+        cdef numpy.int32_t idx, i, j, size=self.size
         cdef bint check_mask
         cdef float[:] cpos0_sup = self.cpos0_sup
         cdef float[:] cpos0_inf = self.cpos0_inf
         cdef float[:] cpos1_inf = self.cpos1_inf
         cdef float[:] cpos1_sup = self.cpos1_sup
-        cdef numpy.ndarray[numpy.int32_t, ndim = 2] outMax = numpy.zeros((bins0,bins1), dtype=numpy.int32)
-        cdef numpy.ndarray[lut_point, ndim = 3] lut
+        cdef numpy.ndarray[numpy.int32_t, ndim = 2] outMax = numpy.zeros((nchunk, bins0 * bins1), dtype=numpy.int32)
         cdef numpy.int8_t[:] cmask
         if self.check_mask:
             cmask = self.cmask
             check_mask = True
         else:
             check_mask = False
-        
-#NOGIL
-        with nogil:
-            for idx in range(size):
+
+        for t in prange(nchunk, nogil=True, schedule="static", chunksize=1, num_threads=nchunk):
+            start = t * chunk
+            stop = start + chunk
+            if stop > size:
+                stop = size
+            for idx in range(start, stop):
                 if (check_mask) and (cmask[idx]):
                     continue
 
@@ -519,36 +1130,59 @@ class HistoBBox2d(object):
 
                 for i in range(bin0_min, bin0_max+1):
                     for j in range(bin1_min , bin1_max+1):
-                        outMax[i, j] +=  1
-
-        self.lut_size = lut_size = outMax.max()
-        #just recycle the outMax array
-        #outMax = numpy.zeros((bins0,bins1), dtype=numpy.int32)
-        memset(&outMax[0,0], 0, bins0*bins1*sizeof(numpy.int32_t))
-
-        lut_nbytes = bins0 * bins1 * lut_size * sizeof(lut_point)
-        if (os.name == "posix") and ("SC_PAGE_SIZE" in os.sysconf_names) and ("SC_PHYS_PAGES" in os.sysconf_names):
-            memsize =  os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
-            if memsize <  lut_nbytes:
-                raise MemoryError("Lookup-table (%i, %i, %i) is %.3fGB whereas the memory of the system is only %s"%(bins0, bins1, lut_size, lut_nbytes, memsize))
-        #else hope we have enough memory
-        lut = numpy.recarray(shape=(bins0, bins1, lut_size),dtype=[("idx",numpy.int32),("coef",numpy.float32)])
-        memset(&lut[0,0,0], 0, lut_nbytes)
-        with nogil:
-            for idx in range(size):
+                        outMax[t, i * bins1 + j] +=  1
+        return outMax
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def fill_contributions(self, numpy.int32_t[:, :] position, numpy.int32_t[:] indices, float[:] coefs):
+        """
+        Second pass over the pixels: store the index and the coefficient of
+        each contribution, whatever the storage of the look-up table
+
+        @param position: where each chunk of pixels writes its next contribution to each bin, updated in place
+        @param indices: receives the index of the pixel of each contribution
+        @param coefs: receives the fraction of the pixel falling in the bin
+        """
+        cdef float delta0=self.delta0, pos0_min=self.pos0_min, min0, max0, fbin0_min, fbin0_max
+        cdef float delta1=self.delta1, pos1_min=self.pos1_min, min1, max1, fbin1_min, fbin1_max
+        cdef int bin0_min, bin0_max, bins0 = self.bins[0]
+        cdef int bin1_min, bin1_max, bins1 = self.bins[1]
+        cdef double deltaL, deltaR, deltaU, deltaD, deltaA
+        cdef int t, start, stop, nchunk=self.nthread, chunk=(self.size + nchunk - 1) // nchunk
+        cdef numpy.int32_t k, idx, i, j, size=self.size
+        cdef bint check_mask
+        cdef float[:] cpos0_sup = self.cpos0_sup
+        cdef float[:] cpos0_inf = self.cpos0_inf
+        cdef float[:] cpos1_inf = self.cpos1_inf
+        cdef float[:] cpos1_sup = self.cpos1_sup
+        cdef numpy.int8_t[:] cmask
+        if self.check_mask:
+            cmask = self.cmask
+            check_mask = True
+        else:
+            check_mask = False
+
+        for t in prange(nchunk, nogil=True, schedule="static", chunksize=1, num_threads=nchunk):
+            start = t * chunk
+            stop = start + chunk
+            if stop > size:
+                stop = size
+            for idx in range(start, stop):
                 if (check_mask) and cmask[idx]:
                     continue
-    
+
                 min0 = cpos0_inf[idx]
                 max0 = cpos0_sup[idx]
                 min1 = cpos1_inf[idx]
                 max1 = cpos1_sup[idx]
-       
+
                 fbin0_min = getBinNr(min0, pos0_min, delta0)
                 fbin0_max = getBinNr(max0, pos0_min, delta0)
                 fbin1_min = getBinNr(min1, pos1_min, delta1)
                 fbin1_max = getBinNr(max1, pos1_min, delta1)
-    
+
                 bin0_min = <int> fbin0_min
                 bin0_max = <int> fbin0_max
                 bin1_min = <int> fbin1_min
@@ -565,61 +1199,61 @@ class HistoBBox2d(object):
                     bin1_max = bins1 - 1
                 if  bin1_min < 0:
                     bin1_min = 0
-     
+
                 if bin0_min == bin0_max:
                     if bin1_min == bin1_max:
                         #All pixel is within a single bin
-                        k = outMax[bin0_min, bin1_min]
-                        lut[bin0_min, bin1_min, k].idx = idx
-                        lut[bin0_min, bin1_min, k].coef = 1.0
-                        outMax[bin0_min, bin1_min]= k+1
-                    
+                        k = position[t, bin0_min * bins1 + bin1_min]
+                        indices[k] = idx
+                        coefs[k] = 1.0
+                        position[t, bin0_min * bins1 + bin1_min] = k + 1
+
                     else:
                         #spread on more than 2 bins
                         deltaD = (< float > (bin1_min + 1)) - fbin1_min
                         deltaU = fbin1_max - ( bin1_max)
                         deltaA = 1.0 / (fbin1_max - fbin1_min)
-    
-                        k = outMax[bin0_min, bin1_min]
-                        lut[bin0_min, bin1_min, k].idx = idx 
-                        lut[bin0_min, bin1_min, k].coef =  deltaA * deltaD
-                        outMax[bin0_min, bin1_min] = k + 1
-    
-                        k = outMax[bin0_min, bin1_max]
-                        lut[bin0_min, bin1_max, k].idx = idx 
-                        lut[bin0_min, bin1_max, k].coef =  deltaA * deltaU
-                        outMax[bin0_min, bin1_max] = k + 1
-                        
+
+                        k = position[t, bin0_min * bins1 + bin1_min]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaD
+                        position[t, bin0_min * bins1 + bin1_min] = k + 1
+
+                        k = position[t, bin0_min * bins1 + bin1_max]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaU
+                        position[t, bin0_min * bins1 + bin1_max] = k + 1
+
                         for j in range(bin1_min + 1, bin1_max):
-                            k = outMax[bin0_min, j]
-                            lut[bin0_min, j, k].idx = idx 
-                            lut[bin0_min, j, k].coef =  deltaA
-                            outMax[bin0_min, j] = k + 1
-    
+                            k = position[t, bin0_min * bins1 + j]
+                            indices[k] = idx
+                            coefs[k] =  deltaA
+                            position[t, bin0_min * bins1 + j] = k + 1
+
                 else: #spread on more than 2 bins in dim 0
                     if bin1_min == bin1_max:
                         #All pixel fall on 1 bins in dim 1
                         deltaA = 1.0 / (fbin0_max - fbin0_min)
                         deltaL = (< float > (bin0_min + 1)) - fbin0_min
-                        
-                        k = outMax[bin0_min, bin1_min]
-                        lut[bin0_min, bin1_min, k].idx = idx 
-                        lut[bin0_min, bin1_min, k].coef =  deltaA * deltaL
-                        outMax[bin0_min, bin1_min] = k+1
-                        
+
+                        k = position[t, bin0_min * bins1 + bin1_min]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaL
+                        position[t, bin0_min * bins1 + bin1_min] = k + 1
+
                         deltaR = fbin0_max - (< float > bin0_max)
-                        
-                        k = outMax[bin0_max, bin1_min]                        
-                        lut[bin0_max, bin1_min, k].idx = idx 
-                        lut[bin0_max, bin1_min, k].coef =  deltaA * deltaR
-                        outMax[bin0_max, bin1_min] = k + 1
-                        
+
+                        k = position[t, bin0_max * bins1 + bin1_min]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaR
+                        position[t, bin0_max * bins1 + bin1_min] = k + 1
+
                         for i in range(bin0_min + 1, bin0_max):
-                            k = outMax[i, bin1_min]
-                            lut[i, bin1_min ,k].idx = idx 
-                            lut[i, bin1_min, k].coef =  deltaA
-                            outMax[i, bin1_min] = k + 1
-                                
+                            k = position[t, i * bins1 + bin1_min]
+                            indices[k] = idx
+                            coefs[k] =  deltaA
+                            position[t, i * bins1 + bin1_min] = k + 1
+
                     else:
                         #spread on n pix in dim0 and m pixel in dim1:
                         deltaL = (< float > (bin0_min + 1)) - fbin0_min
@@ -627,62 +1261,82 @@ class HistoBBox2d(object):
                         deltaD = (< float > (bin1_min + 1)) - fbin1_min
                         deltaU = fbin1_max - (< float > bin1_max)
                         deltaA = 1.0 / ((fbin0_max - fbin0_min) * (fbin1_max - fbin1_min))
-    
-                        k = outMax[bin0_min, bin1_min] 
-                        lut[bin0_min, bin1_min ,k].idx = idx
-                        lut[bin0_min, bin1_min, k].coef =  deltaA * deltaL * deltaD
-                        outMax[bin0_min, bin1_min] = k + 1 
-                        
-                        k = outMax[bin0_min, bin1_max]
-                        lut[bin0_min, bin1_max, k].idx = idx
-                        lut[bin0_min, bin1_max, k].coef =  deltaA * deltaL * deltaU
-                        outMax[bin0_min, bin1_max] = k + 1
-                        
-                        k = outMax[bin0_max, bin1_min]
-                        lut[bin0_max, bin1_min, k].idx = idx
-                        lut[bin0_max, bin1_min, k].coef =  deltaA * deltaR * deltaD
-                        outMax[bin0_max, bin1_min] = k + 1
-                        
-                        k = outMax[bin0_max, bin1_max]
-                        lut[bin0_max, bin1_max, k].idx = idx
-                        lut[bin0_max, bin1_max, k].coef =  deltaA * deltaR * deltaU
-                        outMax[bin0_max, bin1_max] = k + 1
-                        
+
+                        k = position[t, bin0_min * bins1 + bin1_min]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaL * deltaD
+                        position[t, bin0_min * bins1 + bin1_min] = k + 1
+
+                        k = position[t, bin0_min * bins1 + bin1_max]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaL * deltaU
+                        position[t, bin0_min * bins1 + bin1_max] = k + 1
+
+                        k = position[t, bin0_max * bins1 + bin1_min]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaR * deltaD
+                        position[t, bin0_max * bins1 + bin1_min] = k + 1
+
+                        k = position[t, bin0_max * bins1 + bin1_max]
+                        indices[k] = idx
+                        coefs[k] =  deltaA * deltaR * deltaU
+                        position[t, bin0_max * bins1 + bin1_max] = k + 1
+
                         for i in range(bin0_min + 1, bin0_max):
-                            k = outMax[i, bin1_min]
-                            lut[i, bin1_min, k].idx = idx
-                            lut[i, bin1_min, k].coef =  deltaA * deltaD
-                            outMax[i, bin1_min] = k + 1
-                            
+                            k = position[t, i * bins1 + bin1_min]
+                            indices[k] = idx
+                            coefs[k] =  deltaA * deltaD
+                            position[t, i * bins1 + bin1_min] = k + 1
+
                             for j in range(bin1_min + 1, bin1_max):
-                                k = outMax[i, j]
-                                lut[i, j, k].idx = idx
-                                lut[i, j, k].coef =  deltaA
-                                outMax[i, j] = k + 1
-                                
-                            k = outMax[i, bin1_max]    
-                            lut[i, bin1_max, k].idx = idx
-                            lut[i, bin1_max, k].coef =  deltaA * deltaU
-                            outMax[i, bin1_max] = k + 1
-                            
+                                k = position[t, i * bins1 + j]
+                                indices[k] = idx
+                                coefs[k] =  deltaA
+                                position[t, i * bins1 + j] = k + 1
+
+                            k = position[t, i * bins1 + bin1_max]
+                            indices[k] = idx
+                            coefs[k] =  deltaA * deltaU
+                            position[t, i * bins1 + bin1_max] = k + 1
+
                         for j in range(bin1_min + 1, bin1_max):
-                            k = outMax[bin0_min, j]
-                            lut[bin0_min, j, k].idx = idx
-                            lut[bin0_min, j, k].coef =  deltaA * deltaL
-                            outMax[bin0_min, j] = k + 1
-                            
-                            k = outMax[bin0_max, j]
-                            lut[bin0_max, j, k].idx = idx
-                            lut[bin0_max, j, k].coef =  deltaA * deltaR
-                            outMax[bin0_max, j] = k + 1    
-        
-        self.lut=lut
-        return outMax
-    
-    @cython.cdivision(True)
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    def integrate(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None):
+                            k = position[t, bin0_min * bins1 + j]
+                            indices[k] = idx
+                            coefs[k] =  deltaA * deltaL
+                            position[t, bin0_min * bins1 + j] = k + 1
+
+                            k = position[t, bin0_max * bins1 + j]
+                            indices[k] = idx
+                            coefs[k] =  deltaA * deltaR
+                            position[t, bin0_max * bins1 + j] = k + 1
+
+
+    def calc_lut(self):
+        'calculate the number of elements per bin and populate the look-up table'
+        outMax = self.count_contributions()
+        outCount = outMax.sum(axis=0, dtype=numpy.int32)
+        self.lut_size = int(outCount.max())
+        indices, coefs, start = self.allocate(outCount)
+        #each chunk of pixels writes to a bin after the contributions of the previous chunks
+        self.fill_contributions(outMax.cumsum(axis=0, dtype=numpy.int32) - outMax + start, indices, coefs)
+        return outCount.reshape(self.bins)
+
+    def allocate(self, outCount):
+        """
+        @param outCount: number of contributions to each bin, flat
+        @return: indices and coefficients of the look-up table to be filled and the position of each bin in them
+        """
+        #a row per bin0 * bins1 + bin1 makes integration look like a 1D integration
+        self.lut, indices, coefs, start = allocate_lut(outCount)
+        return indices, coefs, start
+
+    def calc_checksum(self):
+        """
+        @return: checksum of the look-up table, used to check if the device copy is up to date
+        """
+        return crc32(self.lut)
+
+    def integrate(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, fused=False, variance=None, out=None):
         """
         Actually perform the 2D integration which in this case looks more like a matrix-vector product
         
@@ -700,116 +1354,119 @@ class HistoBBox2d(object):
         @type solidAngle: ndarray
         @param polarization: array with the polarization correction values to be divided by (if any)
         @type polarization: ndarray
-        @return:  I(2d), edges0(1d), edges1(1d), weighted histogram(2d), unweighted histogram (2d)
+        @param fused: apply the corrections on the fly in the product instead of making a corrected copy of the image first
+        @type fused: bool
+        @param variance: variance of the input image, accumulated in the same pass (if any)
+        @type variance: ndarray
+        @param out: float32 array of shape (bins1, bins0) receiving I instead of a newly allocated one (optional)
+        @type out: ndarray
+        @return:  I(2d), edges0(1d), edges1(1d), weighted histogram(2d), unweighted histogram (2d) and weighted histogram of the variance (2d) if variance is given
         @rtype: 5-tuple of ndarrays
         
         """
-        cdef int i=0, j=0, idx=0, bins0=self.bins[0], bins1=self.bins[1], bins=bins0*bins1, lut_size=self.lut_size, size=self.size
-        cdef double sum_data=0, sum_count=0, epsilon=1e-10
-        cdef float data=0, coef=0, cdummy=0, cddummy=0
-        cdef bint do_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidAngle=False
-        cdef numpy.ndarray[numpy.float64_t, ndim = 2] outData = numpy.zeros(self.bins, dtype=numpy.float64)
-        cdef numpy.ndarray[numpy.float64_t, ndim = 2] outCount = numpy.zeros(self.bins, dtype=numpy.float64)
-        cdef numpy.ndarray[numpy.float32_t, ndim = 2] outMerge = numpy.zeros(self.bins, dtype=numpy.float32)
-        cdef numpy.ndarray[numpy.float64_t, ndim = 1] outData_1d = outData.ravel()
-        cdef numpy.ndarray[numpy.float64_t, ndim = 1] outCount_1d = outCount.ravel()
-        cdef numpy.ndarray[numpy.float32_t, ndim = 1] outMerge_1d = outMerge.ravel()
-
-        cdef lut_point[:,:] lut = self.lut
-        cdef float[:] cdata, tdata, cflat, cdark, csolidAngle, cpolarization
-
-        assert size == weights.size
-
-        if dummy is not None:
-            do_dummy = True
-            cdummy =  <float>float(dummy)
-            if delta_dummy is None:
-                cddummy = <float>0.0
-            else:
-                cddummy = <float>float(delta_dummy)
-
-        if flat is not None:
-            do_flat = True
-            assert flat.size == size
-            cflat = numpy.ascontiguousarray(flat.ravel(), dtype=numpy.float32)
-        if dark is not None:
-            do_dark = True
-            assert dark.size == size
-            cdark = numpy.ascontiguousarray(dark.ravel(), dtype=numpy.float32)
-        if solidAngle is not None:
-            do_solidAngle = True
-            assert solidAngle.size == size
-            csolidAngle = numpy.ascontiguousarray(solidAngle.ravel(), dtype=numpy.float32)
-        if polarization is not None:
-            do_polarization = True
-            assert polarization.size == size
-            cpolarization = numpy.ascontiguousarray(polarization.ravel(), dtype=numpy.float32)
-
-        if (do_dark + do_flat + do_polarization + do_solidAngle):
-            tdata = numpy.ascontiguousarray(weights.ravel(), dtype=numpy.float32)
-            cdata = numpy.zeros(size,dtype=numpy.float32)
-            if do_dummy:
-                for i in prange(size, nogil=True, schedule="static"):
-                    data = tdata[i]
-                    if ((cddummy!=0) and (fabs(data-cdummy) > cddummy)) or ((cddummy==0) and (data!=cdummy)):
-                        #Nota: -= and /= operatore are seen as reduction in cython parallel.
-                        if do_dark:
-                            data = data - cdark[i]
-                        if do_flat:
-                            data = data / cflat[i]
-                        if do_polarization:
-                            data = data / cpolarization[i]
-                        if do_solidAngle:
-                            data = data / csolidAngle[i]
-                        cdata[i]+=data
-                    else: #set all dummy_like values to cdummy. simplifies further processing
-                        cdata[i]+=cdummy
-            else:
-                for i in prange(size, nogil=True, schedule="static"):
-                    data = tdata[i]
-                    if do_dark:
-                        data = data - cdark[i]
-                    if do_flat:
-                        data = data / cflat[i]
-                    if do_polarization:
-                        data = data / cpolarization[i]
-                    if do_solidAngle:
-                        data = data / csolidAngle[i]
-                    cdata[i]+=data
+        assert self.size == weights.size
+
+        if (not fused) and (weights.dtype != numpy.float32) and \
+                (dark is None) and (flat is None) and (solidAngle is None) and (polarization is None):
+            # nothing to correct: read the raw pixels in the product instead of converting the image
+            fused = True
+        if fused:
+            data = native_data(weights)
         else:
-            if do_dummy:
-                tdata = numpy.ascontiguousarray(weights.ravel(), dtype=numpy.float32)
-                cdata = numpy.zeros(size,dtype=numpy.float32)
-                for i in prange(size, nogil=True, schedule="static"):
-                    data = tdata[i]
-                    if ((cddummy!=0) and (fabs(data-cdummy) > cddummy)) or ((cddummy==0) and (data!=cdummy)):
-                        cdata[i]+=data
-                    else:
-                        cdata[i]+=cdummy
-            else:
-                cdata = numpy.ascontiguousarray(weights.ravel(), dtype=numpy.float32)
-
-        for i in prange(bins, nogil=True, schedule="guided"):
-            sum_data = 0.0
-            sum_count = 0.0
-            for j in range(lut_size):
-                idx = lut[i, j].idx
-                coef = lut[i, j].coef
-                if idx <= 0 and coef <= 0.0:
-                    break
-                data = cdata[idx]
-                if do_dummy and data==cdummy:
-                    continue
+            # the corrected copy has its dummy-like values flagged with dummy
+            data = preprocess(weights, dummy, delta_dummy, dark, flat, solidAngle, polarization)
+            delta_dummy = dark = flat = solidAngle = polarization = None
+        # out has the shape of the returned pattern, i.e. (bins1, bins0)
+        merged = output_buffer(out, (self.bins[1], self.bins[0]))
+        _, weighted, unweighted, var = self.dot(data, dummy, delta_dummy, dark, flat, solidAngle, polarization, variance, merged.T)
+        if var is None:
+            return merged, self.outPos0, self.outPos1, weighted.reshape(self.bins).T, unweighted.reshape(self.bins).T
+        return merged, self.outPos0, self.outPos1, weighted.reshape(self.bins).T, unweighted.reshape(self.bins).T, var.reshape(self.bins).T
+
+    def dot(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, variance=None, out=None):
+        """
+        @param weights: flat image, as returned by native_data or preprocess
+        @return: merged, weighted and unweighted histograms and weighted histogram of the variance (or None), flat, see lut_dot_fused
+        """
+        return lut_dot_fused(self.lut, weights, dummy, delta_dummy, dark, flat, solidAngle, polarization, variance, out)
+
+    def dot_stack(self, stack, dummy=None):
+        """
+        @param stack: preprocessed frames, as returned by preprocess_stack
+        @return: merged, weighted and unweighted histograms, each of shape (bins, nframes)
+        """
+        return lut_dot_stack(self.lut, stack, dummy)
+
+    def integrate_stack(self, frames, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, out=None):
+        """
+        Integrate a stack of frames at once: the look-up table is applied to
+        all frames as a sparse matrix - dense matrix product.
+
+        @param frames: 3D array or sequence of input images
+        @type frames: ndarray
+        @param dummy: value for dead pixels (optional)
+        @type dummy: float
+        @param delta_dummy: precision for dead-pixel value in dynamic masking
+        @type delta_dummy: float
+        @param dark: array with the dark-current value to be subtracted (if any)
+        @type dark: ndarray
+        @param flat: array with the dark-current value to be divided by (if any)
+        @type flat: ndarray
+        @param solidAngle: array with the solid angle of each pixel to be divided by (if any)
+        @type solidAngle: ndarray
+        @param polarization: array with the polarization correction values to be divided by (if any)
+        @type polarization: ndarray
+        @param out: float32 array of shape (nframes, bins1, bins0) receiving the patterns (optional)
+        @type out: ndarray
+        @return : patterns, positions in dim0, positions in dim1, weighted_histograms and unweighted_histograms, the patterns and histograms of shape (nframes, bins1, bins0)
+        @rtype: 5-tuple of ndarrays
+        """
+        stack = preprocess_stack(frames, self.size, dummy, delta_dummy, dark, flat, solidAngle, polarization)
+        outMerge, outData, outCount = self.dot_stack(stack, dummy)
+        shape = (stack.shape[1],) + self.bins
+        outMerge, outData, outCount = [i.T.reshape(shape).transpose(0, 2, 1)
+                                       for i in (outMerge, outData, outCount)]
+        if out is None:
+            out = numpy.ascontiguousarray(outMerge)
+        else:
+            output_buffer(out, outMerge.shape)[...] = outMerge
+        return  out, self.outPos0, self.outPos1, numpy.ascontiguousarray(outData), numpy.ascontiguousarray(outCount)
+
+
+class HistoBBox2dCSR(HistoBBox2d):
+    """
+    Same as HistoBBox2d but the look-up table is stored in compressed sparse
+    row (CSR) format: data/indices/indptr, the row index being bin0 * bins1 + bin1.
+    """
+    def allocate(self, outCount):
+        """
+        @param outCount: number of contributions to each bin, flat
+        @return: indices and coefficients of the CSR matrix to be filled and the position of each bin in them
+        """
+        self.data, self.indices, self.indptr, start = allocate_csr(outCount)
+        self.nnz = int(self.indptr[-1])
+        return self.indices, self.data, start
+
+    def calc_checksum(self):
+        """
+        @return: checksum of the CSR matrix
+        """
+        return crc32(self.indptr) ^ crc32(self.indices) ^ crc32(self.data)
+
+    def dot(self, weights, dummy=None, delta_dummy=None, dark=None, flat=None, solidAngle=None, polarization=None, variance=None, out=None):
+        """
+        @param weights: flat image, as returned by native_data or preprocess
+        @return: merged, weighted and unweighted histograms and weighted histogram of the variance (or None), flat, see csr_dot_fused
+        """
+        return csr_dot_fused(self.data, self.indices, self.indptr, weights, dummy, delta_dummy, dark, flat, solidAngle, polarization, variance, out)
+
+    def dot_stack(self, stack, dummy=None):
+        """
+        @param stack: preprocessed frames, as returned by preprocess_stack
+        @return: merged, weighted and unweighted histograms, each of shape (bins, nframes)
+        """
+        return csr_dot_stack(self.data, self.indices, self.indptr, stack, dummy)
 
-                sum_data = sum_data + coef * data
-                sum_count = sum_count + coef
-            outData_1d[i] += sum_data
-            outCount_1d[i] += sum_count
-            if sum_count > epsilon:
-                outMerge_1d[i] += sum_data / sum_count
-            else:
-                outMerge_1d[i] += cdummy
-        return  outMerge.T, self.outPos0, self.outPos1, outData.T, outCount.T
 
 @cython.cdivision(True)
 @cython.boundscheck(False)
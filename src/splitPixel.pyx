@@ -29,6 +29,7 @@ import cython
 cimport numpy
 import numpy
 from libc.math cimport fabs
+from .splitBBoxLUT import output_buffer
 
 #cdef double areaTriangle(double a0,
 #                         double a1,
@@ -95,6 +96,20 @@ cdef double max4f(double a, double b, double c, double d) nogil:
     else:
         return d
 
+def is_vertex_grid(pos, weights):
+    """
+    Tell if the pixel positions are given as a (ny+1, nx+1, 2) grid of
+    vertices, shared by neighbouring pixels, rather than as the 4 corners
+    of each pixel.
+
+    @param pos: positions of the pixels
+    @param weights: 2D array with intensities
+    @return: True for a vertex grid
+    """
+    return (pos.ndim == 3) and (weights.ndim == 2) and (pos.shape[2] == 2) and\
+           (pos.shape[0] == weights.shape[0] + 1) and (pos.shape[1] == weights.shape[1] + 1)
+
+
 @cython.cdivision(True)
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -109,7 +124,9 @@ def fullSplit1D(numpy.ndarray pos not None,
                 dark=None,
                 flat=None,
                 solidangle=None,
-                polarization=None
+                polarization=None,
+                variance=None,
+                out=None
               ):
     """
     Calculates histogram of pos weighted by weights
@@ -118,7 +135,7 @@ def fullSplit1D(numpy.ndarray pos not None,
     No compromise for speed has been made here.
 
 
-    @param pos: 3D array with pos0; Corner A,B,C,D; tth or chi
+    @param pos: 3D array with pos0; Corner A,B,C,D; tth or chi, or (ny+1, nx+1, 2) array with tth and chi at the vertices of the pixels
     @param weights: array with intensities
     @param bins: number of output bins
     @param pos0Range: minimum and maximum  of the 2th range
@@ -130,33 +147,40 @@ def fullSplit1D(numpy.ndarray pos not None,
     @param flat: array (of float64) with flat image
     @param polarization: array (of float64) with polarization correction
     @param solidangle: array (of float64) with flat image
-    @return 2theta, I, weighted histogram, unweighted histogram
+    @param variance: array (of float64) with the variance of the intensities, accumulated in the same pass (or None)
+    @param out: array (of float64) of size bins receiving I (or None)
+    @return 2theta, I, weighted histogram, unweighted histogram (and weighted histogram of the variance if variance is given)
     """
-    cdef size_t  size = weights.size
-    if pos.ndim>3: #create a view
-        pos = pos.reshape((-1,4,2))
-    assert pos.shape[0] == size
-    assert pos.shape[1] == 4
-    assert pos.shape[2] == 2
-    assert pos.ndim == 3
+    cdef size_t  size = weights.size, nx = 0, row = 0, col = 0
+    cdef bint vertex = is_vertex_grid(pos, weights)
+    if vertex:
+        nx = weights.shape[1]
+    else:
+        if pos.ndim>3: #create a view
+            pos = pos.reshape((-1,4,2))
+        assert pos.shape[0] == size
+        assert pos.shape[1] == 4
+        assert pos.shape[2] == 2
+        assert pos.ndim == 3
     assert  bins > 1
 
     cdef numpy.ndarray[numpy.float64_t, ndim = 3] cpos = numpy.ascontiguousarray(pos,dtype=numpy.float64)
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] cdata = numpy.ascontiguousarray(weights.ravel(), dtype=numpy.float64)
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] outData = numpy.zeros(bins, dtype=numpy.float64)
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] outCount = numpy.zeros(bins, dtype=numpy.float64)
-    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outMerge = numpy.zeros(bins, dtype=numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outMerge = output_buffer(out, (bins,), numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 1] outVariance = numpy.zeros(bins, dtype=numpy.float64)
     cdef numpy.int8_t[:] cmask
-    cdef double[:] cflat, cdark, cpolarization, csolidangle
+    cdef double[:] cflat, cdark, cpolarization, csolidangle, cvariance
 
-    cdef double cdummy=0, cddummy=0, data=0
+    cdef double cdummy=0, cddummy=0, data=0, var=0
     cdef double deltaR=0, deltaL=0, deltaA=0
     cdef double pos0_min=0, pos0_max=0, pos0_maxin=0, pos1_min=0, pos1_max=0, pos1_maxin=0
     cdef double aeraPixel=0, dpos=0, fbin0_min=0, fbin0_max=0#, fbin1_min, fbin1_max 
     cdef double a0=0, b0=0, c0=0, d0=0, max0=0, min0=0, a1=0, b1=0, c1=0, d1=0, max1=0, min1=0
     cdef double epsilon=1e-10
 
-    cdef bint check_pos1=False, check_mask=False, do_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidangle=False
+    cdef bint check_pos1=False, check_mask=False, do_dummy=False, do_dark=False, do_flat=False, do_polarization=False, do_solidangle=False, do_variance=False
     cdef size_t i=0, idx=0, bin=0, bin0_max=0, bin0_min=0
 
     if pos0Range is not None and len(pos0Range) > 1:
@@ -212,6 +236,10 @@ def fullSplit1D(numpy.ndarray pos not None,
         do_solidangle = True
         assert solidangle.size == size
         csolidangle = numpy.ascontiguousarray(solidangle.ravel(), dtype=numpy.float64)
+    if variance is not None:
+        do_variance = True
+        assert variance.size == size
+        cvariance = numpy.ascontiguousarray(variance.ravel(), dtype=numpy.float64)
 
     with nogil:
         for idx in range(size):
@@ -223,14 +251,26 @@ def fullSplit1D(numpy.ndarray pos not None,
             if check_dummy and ( (cddummy==0.0 and data==cdummy) or (cddummy!=0.0 and fabs(data-cdummy)<=cddummy)):
                 continue
 
-            a0 = < double > cpos[idx, 0, 0]
-            a1 = < double > cpos[idx, 0, 1]
-            b0 = < double > cpos[idx, 1, 0]
-            b1 = < double > cpos[idx, 1, 1]
-            c0 = < double > cpos[idx, 2, 0]
-            c1 = < double > cpos[idx, 2, 1]
-            d0 = < double > cpos[idx, 3, 0]
-            d1 = < double > cpos[idx, 3, 1]
+            if vertex:
+                row = idx // nx
+                col = idx % nx
+                a0 = cpos[row, col, 0]
+                a1 = cpos[row, col, 1]
+                b0 = cpos[row + 1, col, 0]
+                b1 = cpos[row + 1, col, 1]
+                c0 = cpos[row + 1, col + 1, 0]
+                c1 = cpos[row + 1, col + 1, 1]
+                d0 = cpos[row, col + 1, 0]
+                d1 = cpos[row, col + 1, 1]
+            else:
+                a0 = < double > cpos[idx, 0, 0]
+                a1 = < double > cpos[idx, 0, 1]
+                b0 = < double > cpos[idx, 1, 0]
+                b1 = < double > cpos[idx, 1, 1]
+                c0 = < double > cpos[idx, 2, 0]
+                c1 = < double > cpos[idx, 2, 1]
+                d0 = < double > cpos[idx, 3, 0]
+                d1 = < double > cpos[idx, 3, 1]
             min0 = min4f(a0, b0, c0, d0)
             max0 = max4f(a0, b0, c0, d0)
             if (max0<pos0_min) or (min0 > pos0_maxin):
@@ -245,6 +285,8 @@ def fullSplit1D(numpy.ndarray pos not None,
             if max0>pos0_maxin:
                 max0=pos0_maxin
 
+            if do_variance:
+                var = cvariance[idx]
             if do_dark:
                 data -= cdark[idx]
             if do_flat:
@@ -263,6 +305,8 @@ def fullSplit1D(numpy.ndarray pos not None,
                 #All pixel is within a single bin
                 outCount[bin0_min] += 1.0
                 outData[bin0_min] += data
+                if do_variance:
+                    outVariance[bin0_min] += var
 
     #        else we have pixel spliting.
             else:
@@ -275,15 +319,21 @@ def fullSplit1D(numpy.ndarray pos not None,
                 tmp = deltaA * deltaL
                 outCount[bin0_min] += tmp
                 outData[bin0_min] += data * tmp
+                if do_variance:
+                    outVariance[bin0_min] += var * tmp
 
                 tmp = deltaA * deltaR
                 outCount[bin0_max] += tmp
                 outData[bin0_max] += data * tmp
+                if do_variance:
+                    outVariance[bin0_max] += var * tmp
 
                 if bin0_min + 1 != bin0_max:
                     for i in range(bin0_min + 1, bin0_max):
                         outCount[i] += deltaA
                         outData[i] += data * deltaA
+                        if do_variance:
+                            outVariance[i] += var * deltaA
 
 
         for i in range(bins):
@@ -292,6 +342,8 @@ def fullSplit1D(numpy.ndarray pos not None,
             else:
                 outMerge[i] = cdummy
 
+    if do_variance:
+        return  outPos, outMerge, outData, outCount, outVariance
     return  outPos, outMerge, outData, outCount
 
 
@@ -313,14 +365,15 @@ def fullSplit2D(numpy.ndarray pos not None,
                 dark=None,
                 flat=None,
                 solidangle=None,
-                polarization=None):
+                polarization=None,
+                out=None):
     """
     Calculate 2D histogram of pos weighted by weights
 
     Splitting is done on the pixel's bounding box like fit2D
 
 
-    @param pos: 3D array with pos0; Corner A,B,C,D; tth or chi
+    @param pos: 3D array with pos0; Corner A,B,C,D; tth or chi, or (ny+1, nx+1, 2) array with tth and chi at the vertices of the pixels
     @param weights: array with intensities
     @param bins: number of output bins int or 2-tuple of int
     @param pos0Range: minimum and maximum  of the 2th range
@@ -332,17 +385,22 @@ def fullSplit2D(numpy.ndarray pos not None,
     @param flat: array (of float64) with flat-field image
     @param polarization: array (of float64) with polarization correction
     @param solidangle: array (of float64)with solid angle corrections
+    @param out: array (of float64) of shape (bins1, bins0) receiving I (or None)
     @return  I, edges0, edges1, weighted histogram(2D), unweighted histogram (2D)
     """
 
-    cdef size_t  bins0=0, bins1=0, size = weights.size
-    if pos.ndim>3: #create a view
-        pos = pos.reshape((-1,4,2))
+    cdef size_t  bins0=0, bins1=0, size = weights.size, nx = 0, row = 0, col = 0
+    cdef bint vertex = is_vertex_grid(pos, weights)
+    if vertex:
+        nx = weights.shape[1]
+    else:
+        if pos.ndim>3: #create a view
+            pos = pos.reshape((-1,4,2))
 
-    assert pos.shape[0] == size
-    assert pos.shape[1] == 4 # 4 corners
-    assert pos.shape[2] == 2 # tth and chi
-    assert pos.ndim == 3
+        assert pos.shape[0] == size
+        assert pos.shape[1] == 4 # 4 corners
+        assert pos.shape[2] == 2 # tth and chi
+        assert pos.ndim == 3
     try:
         bins0, bins1 = tuple(bins)
     except:
@@ -356,7 +414,8 @@ def fullSplit2D(numpy.ndarray pos not None,
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] cdata = weights.astype(numpy.float64).ravel()
     cdef numpy.ndarray[numpy.float64_t, ndim = 2] outData = numpy.zeros((bins0, bins1), dtype=numpy.float64)
     cdef numpy.ndarray[numpy.float64_t, ndim = 2] outCount = numpy.zeros((bins0, bins1), dtype=numpy.float64)
-    cdef numpy.ndarray[numpy.float64_t, ndim = 2] outMerge = numpy.zeros((bins0, bins1), dtype=numpy.float64)
+    merged = output_buffer(out, (bins1, bins0), numpy.float64)
+    cdef numpy.ndarray[numpy.float64_t, ndim = 2] outMerge = merged.T
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] edges0 = numpy.zeros(bins0, dtype=numpy.float64)
     cdef numpy.ndarray[numpy.float64_t, ndim = 1] edges1 = numpy.zeros(bins1, dtype=numpy.float64)
     cdef numpy.int8_t[:] cmask
@@ -438,14 +497,26 @@ def fullSplit2D(numpy.ndarray pos not None,
             if check_dummy and ( (cddummy==0.0 and data==cdummy) or (cddummy!=0.0 and fabs(data-cdummy)<=cddummy)):
                 continue
 
-            a0 =  cpos[idx, 0, 0]
-            a1 =  cpos[idx, 0, 1]
-            b0 =  cpos[idx, 1, 0]
-            b1 =  cpos[idx, 1, 1]
-            c0 =  cpos[idx, 2, 0]
-            c1 =  cpos[idx, 2, 1]
-            d0 =  cpos[idx, 3, 0]
-            d1 =  cpos[idx, 3, 1]
+            if vertex:
+                row = idx // nx
+                col = idx % nx
+                a0 = cpos[row, col, 0]
+                a1 = cpos[row, col, 1]
+                b0 = cpos[row + 1, col, 0]
+                b1 = cpos[row + 1, col, 1]
+                c0 = cpos[row + 1, col + 1, 0]
+                c1 = cpos[row + 1, col + 1, 1]
+                d0 = cpos[row, col + 1, 0]
+                d1 = cpos[row, col + 1, 1]
+            else:
+                a0 =  cpos[idx, 0, 0]
+                a1 =  cpos[idx, 0, 1]
+                b0 =  cpos[idx, 1, 0]
+                b1 =  cpos[idx, 1, 1]
+                c0 =  cpos[idx, 2, 0]
+                c1 =  cpos[idx, 2, 1]
+                d0 =  cpos[idx, 3, 0]
+                d1 =  cpos[idx, 3, 1]
 
             min0 = min4f(a0, b0, c0, d0)
             max0 = max4f(a0, b0, c0, d0)
@@ -578,5 +649,5 @@ def fullSplit2D(numpy.ndarray pos not None,
                     outMerge[i, j] = outData[i, j] / outCount[i, j]
                 else:
                     outMerge[i, j] = cdummy
-    return outMerge.T, edges0, edges1, outData.T, outCount.T
+    return merged, edges0, edges1, outData.T, outCount.T
 
@@ -32,16 +32,21 @@ __date__ = "23/02/2013"
 
 
 import unittest
-# import os
+import os
 import numpy
 # import logging, time
 import sys
+import shutil
+import tempfile
 import fabio
 
 from utilstest import UtilsTest, getLogger
 logger = getLogger(__file__)
 pyFAI = sys.modules["pyFAI"]
-from pyFAI import _distortion, detectors
+from pyFAI import _distortion, detectors, lut_cache
+# coarse spline of a half FReLoN shipped with the tests, for the tests which
+# do not compare with fit2d
+HALFCCD_COARSE = os.path.join(os.path.dirname(__file__), "halfccd_coarse.spline")
 
 class test_halfccd(unittest.TestCase):
     """basic test"""
@@ -78,9 +83,201 @@ class test_halfccd(unittest.TestCase):
         logger.info("ratio of good points (less than 1/1000 relative error): %.4f" % good_points_ratio)
         self.assert_(good_points_ratio > 0.99, "99% of all points have a relative error below 1/1000")
 
+class TestLUT(unittest.TestCase):
+    """Look-up table of the distortion correction"""
+    splineFile = HALFCCD_COARSE
+
+    def setUp(self):
+        self.det = detectors.FReLoN(self.splineFile)
+        self.dis = _distortion.Distortion(self.det)
+
+    def test_lut(self):
+        """
+        Every raw pixel is split without loss, raw pixels are sorted in each
+        line of the table and the size estimated from the bounding boxes is
+        an upper bound
+        """
+        bound = self.dis.calc_LUT_size()
+        self.dis.calc_LUT()
+        lut = self.dis.LUT
+        size = self.dis.shape[0] * self.dis.shape[1]
+        self.assertEqual(lut.shape[0], size)
+        count = (lut.coef > 0).sum(axis=-1)
+        self.assertEqual(lut.shape[1], count.max(), "table as narrow as possible")
+        self.assert_((count <= bound.ravel()).all(), "bounding boxes give an upper bound")
+        valid = lut.coef > 0
+        total = numpy.bincount(lut.idx[valid], weights=lut.coef[valid], minlength=size)
+        total.shape = self.dis.shape
+        self.assert_(abs(total[100:-100, 100:-100] - 1).max() < 1e-3, "pixels inside the image are fully redistributed")
+        idx = numpy.where(valid, lut.idx, -1)
+        self.assert_((numpy.diff(idx, axis=-1)[valid[:, 1:]] > 0).all(), "raw pixels are sorted")
+
+
+    def test_correct(self):
+        """
+        The CPU engine is a plain sparse matrix - vector product, whatever
+        the type of the image
+        """
+        raw = (numpy.random.random(self.dis.shape) * 1000).astype(numpy.uint16)
+        cor = self.dis.correct(raw)
+        lut = self.dis.LUT
+        ref = (raw.ravel().astype(numpy.float64)[lut.idx] * lut.coef).sum(axis=-1)
+        ref.shape = self.dis.shape
+        self.assertEqual(cor.dtype, numpy.float32)
+        self.assert_(abs(cor - ref).max() < 1e-3, "same as numpy")
+        self.assert_(abs(self.dis.correct(raw.astype(numpy.float32)) - cor).max() == 0, "uint16 read natively")
+        self.assertRaises(ValueError, _distortion.Distortion, self.det, engine="gpu")
+
+    def test_uncorrect(self):
+        """
+        Distorting back an image spreads each corrected pixel over its raw
+        pixels and a flat raw image survives the round trip
+        """
+        img = numpy.random.random(self.dis.shape).astype(numpy.float32)
+        raw, mask = self.dis.uncorrect(img)
+        lut = self.dis.LUT
+        size = img.size
+        valid = lut.coef > 0
+        tot = lut.coef.sum(axis=-1)
+        self.assert_((mask.ravel() == (tot <= 0)).all(), "mask")
+        weight = (img.ravel() / numpy.where(tot > 0, tot, 1))[:, None] * lut.coef
+        ref = numpy.bincount(lut.idx[valid], weights=weight[valid], minlength=size)
+        ref.shape = self.dis.shape
+        self.assert_(abs(raw - ref).max() < 1e-5, "same as the scatter with numpy")
+        flat = numpy.ones(self.dis.shape, dtype=numpy.float32)
+        back = self.dis.uncorrect(self.dis.correct(flat))[0]
+        self.assert_(abs(back[100:-100, 100:-100] - 1).max() < 1e-3, "round trip")
+
+    def test_shapes(self):
+        """
+        Images larger than the detector are cropped, smaller ones padded,
+        inconsistent inputs raise a ValueError
+        """
+        raw = numpy.random.random(self.dis.shape).astype(numpy.float32)
+        ref = self.dis.correct(raw)
+        large = numpy.random.random((self.dis.shape[0] + 10, self.dis.shape[1] + 5)).astype(numpy.float32)
+        large[:self.dis.shape[0], :self.dis.shape[1]] = raw
+        self.assert_(abs(self.dis.correct(large) - ref).max() == 0, "cropped to the detector")
+        small = raw[:-10, :-5]
+        padded = raw.copy()
+        padded[-10:] = 0
+        padded[:, -5:] = 0
+        self.assert_(abs(self.dis.correct(small) - self.dis.correct(padded)[:-10, :-5]).max() == 0, "padded with zeros")
+        self.assertRaises(ValueError, self.dis.uncorrect, small)
+        self.assertRaises(ValueError, _distortion.lut_dot, self.dis.LUT, raw.ravel()[:-1])
+        self.assertRaises(ValueError, _distortion.lut_dot, self.dis.LUT, raw.ravel(), numpy.zeros(10, numpy.float32))
+        self.assertRaises(ValueError, _distortion.tile_lut, self.dis.LUT, numpy.arange(10, dtype=numpy.int32))
+
+    def test_tile(self):
+        """
+        A look-up table built by tiles gives the same corrections, with raw
+        pixels renumbered in tile order and sorted in each line
+        """
+        tiled = _distortion.Distortion(self.det, tile=(16, 128))
+        tiled.lut_cache = self.dis.lut_cache = None
+        order = _distortion.tile_order(self.dis.shape, (16, 128))
+        self.assertEqual(order[16 * 128 - 1], 15 * self.dis.shape[1] + 127, "end of the first tile")
+        self.assert_((numpy.sort(order) == numpy.arange(order.size)).all(), "permutation")
+        img = numpy.random.random(self.dis.shape).astype(numpy.float32)
+        self.assert_(abs(tiled.correct(img) - self.dis.correct(img)).max() < 1e-5, "same correction")
+        lut = tiled.LUT
+        self.assertEqual(lut.shape, self.dis.LUT.shape)
+        valid = lut.coef > 0
+        idx = numpy.where(valid, lut.idx, -1)
+        self.assert_((numpy.diff(idx, axis=-1)[valid[:, 1:]] > 0).all(), "raw pixels are sorted")
+        raw, mask = tiled.uncorrect(img)
+        ref_raw, ref_mask = self.dis.uncorrect(img)
+        self.assert_(abs(raw - ref_raw).max() < 1e-5, "same uncorrection")
+        self.assert_((mask == ref_mask).all(), "same mask")
+
+
+class TestLUTFile(unittest.TestCase):
+    """Look-up table of the distortion correction saved on disk"""
+    splineFile = HALFCCD_COARSE
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="pyFAI_distortion_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_save_load(self):
+        "a look-up table read back from a file is memory-mapped and gives the same result"
+        dis = _distortion.Distortion(detectors.FReLoN(self.splineFile))
+        dis.lut_cache = None
+        filename = os.path.join(self.tmpdir, "lut.npy")
+        dis.save_lut(filename)
+        other = _distortion.Distortion(detectors.FReLoN(self.splineFile))
+        other.load_lut(filename)
+        self.assert_(isinstance(other.LUT.base, numpy.memmap) or isinstance(other.LUT, numpy.memmap), "memory-mapped")
+        self.assertEqual(other.lut_size, dis.lut_size)
+        img = numpy.random.random(dis.shape).astype(numpy.float32)
+        self.assert_(abs(other.correct(img) - dis.correct(img)).max() == 0, "same correction")
+        small = _distortion.Distortion("Pilatus1M")
+        self.assertRaises(ValueError, small.load_lut, filename)
+
+    def test_cache(self):
+        "the look-up table is stored in the cache and keyed on the spline file content and the binning"
+        dis = _distortion.Distortion(detectors.FReLoN(self.splineFile))
+        dis.lut_cache = lut_cache.LUTCache(self.tmpdir)
+        dis.calc_LUT()
+        self.assertEqual(len(dis.lut_cache.entries()), 1)
+        copy = os.path.join(self.tmpdir, "copy.spline")
+        shutil.copy(self.splineFile, copy)
+        other = _distortion.Distortion(detectors.FReLoN(copy))
+        other.lut_cache = lut_cache.LUTCache(self.tmpdir)
+        self.assertEqual(other._lut_cache_key(), dis._lut_cache_key(), "same content, same key")
+        other.calc_LUT()
+        self.assert_(other.pos is None, "read from the cache")
+        self.assert_(abs(other.LUT.coef - dis.LUT.coef).max() == 0, "same look-up table")
+        det = detectors.FReLoN(copy)
+        det.binning = 2
+        self.assertNotEqual(_distortion.Distortion(det)._lut_cache_key(), dis._lut_cache_key())
+
+
+class TestSplinePoints(unittest.TestCase):
+    """Spline evaluated on scattered points"""
+    splineFile = HALFCCD_COARSE
+
+    def setUp(self):
+        self.det = detectors.FReLoN(self.splineFile)
+
+    def test_points(self):
+        """
+        Positions of scattered points are the same as the ones calculated
+        point by point and are cached
+        """
+        d1 = numpy.random.random(500) * 1100 - 50
+        d2 = numpy.random.random(500) * 1100 - 50
+        p1, p2 = self.det.calc_cartesian_positions(d1, d2)
+        spline = self.det.spline
+        dX = numpy.array([spline.splineFuncX(i2, i1) for i1, i2 in zip(d1 + 0.5, d2 + 0.5)])
+        dY = numpy.array([spline.splineFuncY(i2, i1) for i1, i2 in zip(d1 + 0.5, d2 + 0.5)])
+        self.assert_(abs(p1 / self.det.pixel1 - (dY + 0.5 + d1)).max() < 1e-6, "same dY")
+        self.assert_(abs(p2 / self.det.pixel2 - (dX + 0.5 + d2)).max() < 1e-6, "same dX")
+        self.assertEqual(len(self.det._splineCache), 1)
+        self.det.calc_cartesian_positions(d1.copy(), d2.copy())
+        self.assertEqual(len(self.det._splineCache), 1, "cached by value")
+        self.det.calc_cartesian_positions(d2, d1)
+        self.assertEqual(len(self.det._splineCache), 2)
+        d3 = d1.copy()
+        d3[250] += 1e-9
+        p3 = self.det.calc_cartesian_positions(d3, d2)[0]
+        self.assertEqual(len(self.det._splineCache), 3, "a single moved point is a new entry")
+        self.assert_(p3[250] != p1[250])
+
+
 def test_suite_all_distortion():
     testSuite = unittest.TestSuite()
     testSuite.addTest(test_halfccd("test_vs_fit2d"))
+    testSuite.addTest(TestLUT("test_lut"))
+    testSuite.addTest(TestLUT("test_correct"))
+    testSuite.addTest(TestLUT("test_uncorrect"))
+    testSuite.addTest(TestLUT("test_shapes"))
+    testSuite.addTest(TestLUT("test_tile"))
+    testSuite.addTest(TestLUTFile("test_save_load"))
+    testSuite.addTest(TestLUTFile("test_cache"))
+    testSuite.addTest(TestSplinePoints("test_points"))
 #    testSuite.addTest(test_azim_halfFrelon("test_numpy_vs_fit2d"))
 #    testSuite.addTest(test_azim_halfFrelon("test_cythonSP_vs_fit2d"))
 #    testSuite.addTest(test_azim_halfFrelon("test_cython_vs_numpy"))
@@ -107,8 +107,8 @@ class TestFlat2D(unittest.TestCase):
             I, _, _ = self.ai.__getattribute__(meth)(self.raw, self.bins, self.azim, correctSolidAngle=False, dark=self.dark, flat=self.flat)
             I = I[numpy.where(I > 0)]
             logger.info("1D method:%s Imin=%s Imax=%s <I>=%s std=%s" % (meth, I.min(), I.max(), I.mean(), I.std()))
-            self.assertAlmostEqual(I.mean(), 1, 1, "Mean should be 1 in %s" % meth)
-            self.assert_(I.max() - I.min() < 0.1, "deviation should be small")
+            self.assertAlmostEqual(I.mean(), 1, 2, "Mean should be 1 in %s" % meth)
+            self.assert_(I.max() - I.min() < self.eps, "deviation should be small")
 
 def test_suite_all_Flat():
     testSuite = unittest.TestSuite()
@@ -11,7 +11,9 @@ from utilstest import UtilsTest, getLogger
 logger = getLogger(__file__)
 pyFAI = sys.modules["pyFAI"]
 import pyFAI.geometry
+import pyFAI.splitPixel
 geometry = pyFAI.geometry
+splitPixel = pyFAI.splitPixel
 
 class ParameterisedTestCase(unittest.TestCase):
     """ TestCase classes that want to be parameterised should
@@ -57,6 +59,54 @@ class TestGeometry(ParameterisedTestCase):
             self.assertAlmostEquals(maxDelta, 0, 3, msg)
         logger.info(msg)
 
+
+class TestInvalidate(unittest.TestCase):
+    """
+    Only the cached arrays depending on a changed parameter are dropped
+    """
+    shape = (64, 64)
+
+    def setUp(self):
+        self.geo = geometry.Geometry(dist=0.1, poni1=0.003, poni2=0.004,
+                                     pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        self.geo.twoThetaArray(self.shape)
+        self.geo.chiArray(self.shape)
+        self.geo.qArray(self.shape)
+        self.geo.solidAngleArray(self.shape)
+
+    def test_same_value(self):
+        ttha = self.geo._ttha
+        qa = self.geo._qa
+        self.geo.dist = 0.1
+        self.geo.set_wavelength(1e-10)
+        self.assert_(self.geo._ttha is ttha, "2theta kept")
+        self.assert_(self.geo._qa is qa, "q kept")
+
+    def test_wavelength(self):
+        ttha = self.geo._ttha
+        chia = self.geo._chia
+        dssa = self.geo._dssa
+        self.geo.wavelength = 2e-10
+        self.assert_(self.geo._ttha is ttha, "2theta kept")
+        self.assert_(self.geo._chia is chia, "chi kept")
+        self.assert_(self.geo._dssa is dssa, "solid angle kept")
+        self.assert_(self.geo._qa is None, "q dropped")
+
+    def test_rotation(self):
+        dssa = self.geo._dssa
+        self.geo.rot1 = 0.1
+        self.assert_(self.geo._dssa is dssa, "solid angle kept")
+        self.assert_(self.geo._ttha is None, "2theta dropped")
+        self.assert_(self.geo._qa is None, "q dropped")
+        ref = geometry.Geometry(dist=0.1, poni1=0.003, poni2=0.004, rot1=0.1,
+                                pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        self.assert_(abs(self.geo.twoThetaArray(self.shape) - ref.twoThetaArray(self.shape)).max() < 1e-6, "2theta recalculated")
+
+    def test_reset(self):
+        self.geo.reset()
+        for key in ("_ttha", "_chia", "_qa", "_dssa"):
+            self.assert_(self.geo.__dict__[key] is None, "%s dropped" % key)
+
 size = 1024
 d1, d2 = numpy.mgrid[-size:size:32, -size:size:32]
 
@@ -124,11 +174,176 @@ TESTCASES = [
  ]
 
 
+class TestCalcArrays(unittest.TestCase):
+    """
+    The arrays filled in a single pass are the same as the ones calculated
+    one by one with numpy
+    """
+    shape = (100, 120)
+
+    def test_arrays(self):
+        for kwds in ({}, {"rot1": 0.1, "rot2": -0.2, "rot3": 0.3}):
+            geo = geometry.Geometry(dist=0.1, poni1=0.003, poni2=0.004,
+                                    pixel1=1e-4, pixel2=1e-4, wavelength=1e-10, **kwds)
+            geo.setChiDiscAtZero()
+            geo.calc_arrays(self.shape, "tth", "chi", "q", "r", "dssa")
+            d1, d2 = numpy.mgrid[:self.shape[0], :self.shape[1]]
+            ref = {"_ttha": geo.tth(d1, d2, path="tan"),
+                   "_chia": geo.chi(d1, d2, path="tan") % (2 * numpy.pi),
+                   "_qa": geo.qFunction(d1, d2, path="numpy"),
+                   "_ra": geo.rFunction(d1, d2, path="numpy"),
+                   "_dssa": geo.diffSolidAngle(d1, d2)}
+            for key, value in ref.items():
+                self.assertEqual(geo.__dict__[key].shape, self.shape, key)
+                self.assert_(abs(geo.__dict__[key] - value).max() < 1e-6 * abs(value).max(), key)
+            ttha = geo._ttha
+            geo.calc_arrays(self.shape)
+            self.assert_(geo._ttha is ttha, "arrays already available are kept")
+
+    def test_dtype(self):
+        geo = geometry.Geometry(dist=0.1, poni1=0.003, poni2=0.004,
+                                pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        names = ("_ttha", "_chia", "_qa", "_ra", "_dssa")
+        geo.calc_arrays(self.shape, "tth", "chi", "q", "r", "dssa")
+        single = dict((key, geo.__dict__[key]) for key in names)
+        geo.dtype = numpy.float64
+        for key in names:
+            self.assert_(geo.__dict__[key] is None, "%s dropped" % key)
+        geo.calc_arrays(self.shape, "tth", "chi", "q", "r", "dssa")
+        for key in names:
+            self.assertEqual(single[key].dtype, numpy.float32, key)
+            self.assertEqual(geo.__dict__[key].dtype, numpy.float64, key)
+            self.assert_(abs(single[key] - geo.__dict__[key]).max() < 1e-6 * abs(single[key]).max(), key)
+        self.assertRaises(ValueError, geo.set_dtype, numpy.int32)
+
+    def test_solid_angle(self):
+        """
+        The solid angle kernel keeps the formula of the numpy version,
+        dist / sqrt(dist^2 + p1^2 + p2^2), times the pixel area with a spline
+        """
+        spline = os.path.join(os.path.dirname(__file__), "example.sp")
+        for kwds in ({"pixel1": 1e-4, "pixel2": 1e-4}, {"splineFile": spline}):
+            geo = geometry.Geometry(dist=0.1, poni1=0.003, poni2=0.004, rot1=0.1, rot2=-0.2, **kwds)
+            d1, d2 = numpy.mgrid[:self.shape[0], :self.shape[1]]
+            p1, p2 = geo._calcCartesianPositions(d1, d2)
+            ref = geo._pixelArea(d1, d2) * 0.1 / numpy.sqrt(0.1 ** 2 + p1 ** 2 + p2 ** 2)
+            self.assert_(abs(geo.solidAngleArray(self.shape) - ref).max() < 1e-6, "same as numpy")
+
+    def test_exact_solid_angle(self):
+        """
+        With exact_solid_angle, the solid angles of the pixels add up to the
+        one of the whole detector
+        """
+        pixel = 1e-4
+        dist = 0.01
+        geo = geometry.Geometry(dist=dist, poni1=self.shape[0] * pixel / 2, poni2=self.shape[1] * pixel / 2,
+                                pixel1=pixel, pixel2=pixel)
+        geo.dtype = numpy.float64
+        approx = geo.solidAngleArray(self.shape)
+        geo.exact_solid_angle = True
+        self.assert_(geo._dssa is None, "solid angle dropped")
+        dssa = geo.solidAngleArray(self.shape)
+        self.assert_(abs(dssa - approx).max() > 0.1, "different from cos(alpha)")
+        self.assert_(1 - 1e-3 < dssa.max() <= 1, "relative solid angle is 1 at the PONI")
+        a = self.shape[0] * pixel / 2
+        b = self.shape[1] * pixel / 2
+        ref = 4 * numpy.arctan(a * b / (dist * numpy.sqrt(dist ** 2 + a ** 2 + b ** 2)))
+        res = dssa.sum() * pixel * pixel / dist ** 2
+        self.assert_(abs(res - ref) < 1e-6 * ref, "total solid angle %s, expected %s" % (res, ref))
+        d1, d2 = numpy.mgrid[:self.shape[0], :self.shape[1]]
+        self.assert_(abs(geo.diffSolidAngle(d1, d2) - dssa).max() < 1e-6, "same as numpy")
+
+    def test_corners(self):
+        geo = geometry.Geometry(dist=0.1, poni1=0.003, poni2=0.004, rot1=0.1, rot2=-0.2, rot3=0.3,
+                                pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        shape = (self.shape[0] + 1, self.shape[1] + 1)
+        chi = numpy.fromfunction(geo.chi_corner, shape, dtype=numpy.float32)
+        for method, funct in ((geo.cornerArray, geo.tth_corner),
+                              (geo.cornerQArray, geo.qCornerFunct),
+                              (geo.cornerRArray, geo.rCornerFunct)):
+            radial = numpy.fromfunction(funct, shape, dtype=numpy.float32)
+            corners = method(self.shape)
+            self.assertEqual(corners.shape, self.shape + (4, 2))
+            self.assertEqual(corners.dtype, numpy.float32)
+            for i, (s1, s2) in enumerate(((slice(None, -1), slice(None, -1)),
+                                          (slice(1, None), slice(None, -1)),
+                                          (slice(1, None), slice(1, None)),
+                                          (slice(None, -1), slice(1, None)))):
+                self.assert_(abs(corners[:, :, i, 0] - radial[s1, s2]).max() < 1e-6 * abs(radial).max(), "radial corner %s" % i)
+                self.assert_(abs(corners[:, :, i, 1] - chi[s1, s2]).max() < 1e-6, "chi corner %s" % i)
+
+    def test_vertices(self):
+        geo = geometry.Geometry(dist=0.1, poni1=0.003, poni2=0.004, rot1=0.1, rot2=-0.2, rot3=0.3,
+                                pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        vertices = geo.vertexArray(self.shape)
+        self.assertEqual(vertices.shape, (self.shape[0] + 1, self.shape[1] + 1, 2))
+        self.assert_(geo.vertexArray(self.shape) is vertices, "vertex grid cached")
+        corners = geo.cornerArray(self.shape)
+        tth = geo.twoThetaArray(self.shape)
+        chi = geo.chiArray(self.shape)
+        delta = abs(corners[:, :, :, 0] - tth[:, :, None]).max(axis=-1)
+        self.assert_(abs(geo.delta2Theta(self.shape) - delta).max() < 1e-6, "delta2Theta")
+        dchi = numpy.minimum((corners[:, :, :, 1] - chi[:, :, None]) % (2 * numpy.pi),
+                             (chi[:, :, None] - corners[:, :, :, 1]) % (2 * numpy.pi)).max(axis=-1)
+        self.assert_(abs(geo.deltaChi(self.shape) - dchi).max() < 1e-6, "deltaChi")
+        for corner, center, delta in ((geo.cornerQArray, geo.qArray, geo.deltaQ),
+                                      (geo.cornerRArray, geo.rArray, geo.deltaR)):
+            ref = abs(corner(self.shape)[:, :, :, 0] - center(self.shape)[:, :, None]).max(axis=-1)
+            self.assert_(abs(delta(self.shape) - ref).max() < 1e-6 * ref.max(), delta.__name__)
+        data = numpy.random.random(self.shape).astype(numpy.float32)
+        ref = splitPixel.fullSplit1D(corners, data, bins=100)
+        res = splitPixel.fullSplit1D(vertices, data, bins=100)
+        for a, b in zip(ref, res):
+            self.assert_(abs(a - b).max() == 0, "same 1D histogram from the vertex grid")
+        ref = splitPixel.fullSplit2D(corners, data, bins=(100, 36))
+        res = splitPixel.fullSplit2D(vertices, data, bins=(100, 36))
+        for a, b in zip(ref, res):
+            self.assert_(abs(a - b).max() == 0, "same 2D histogram from the vertex grid")
+
+    def test_integrate(self):
+        """
+        Integrations request all the arrays they need in a single call, the
+        look-up table methods only need the positions to build the table
+        """
+        data = numpy.random.random(self.shape).astype(numpy.float32)
+        for integrate, kwargs, names in (
+                ("integrate1d", dict(nbPt=100, method="splitbbox", unit="q_nm^-1", azimuth_range=(-90, 90), polarization_factor=0.9), [("q", "chi", "tth", "dssa")]),
+                ("integrate1d", dict(nbPt=100, method="lut", unit="q_nm^-1"), [("dssa",), ("q",)]),
+                ("integrate2d", dict(nbPt_rad=100, method="numpy", unit="r_mm"), [("r", "chi", "dssa")]),
+                ("xrpd_splitBBox", dict(nbPt=100), [("tth", "dssa")]),
+                ("xrpd2_splitBBox", dict(nbPt2Th=100, polarization_factor=0.9), [("tth", "chi", "dssa")])):
+            ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.003, poni2=0.004,
+                                           pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+            calls = []
+            calc_arrays = ai.calc_arrays
+
+            def record(shape, *args):
+                calls.append(set(args))
+                calc_arrays(shape, *args)
+            ai.calc_arrays = record
+            ai.__getattribute__(integrate)(data, **kwargs)
+            expected = [set(i) for i in names]
+            self.assertEqual(calls[:len(expected)], expected, "%s %s" % (integrate, kwargs))
+            for later in calls[len(expected):]:
+                self.assert_(later <= set.union(*expected), "%s: %s already calculated" % (integrate, later))
+
+
 def test_suite_all_Geometry():
     testSuite = unittest.TestSuite()
     for param in TESTCASES:
         testSuite.addTest(ParameterisedTestCase.parameterise(
                 TestGeometry, param))
+    testSuite.addTest(TestInvalidate("test_same_value"))
+    testSuite.addTest(TestInvalidate("test_wavelength"))
+    testSuite.addTest(TestInvalidate("test_rotation"))
+    testSuite.addTest(TestInvalidate("test_reset"))
+    testSuite.addTest(TestCalcArrays("test_arrays"))
+    testSuite.addTest(TestCalcArrays("test_dtype"))
+    testSuite.addTest(TestCalcArrays("test_solid_angle"))
+    testSuite.addTest(TestCalcArrays("test_exact_solid_angle"))
+    testSuite.addTest(TestCalcArrays("test_corners"))
+    testSuite.addTest(TestCalcArrays("test_vertices"))
+    testSuite.addTest(TestCalcArrays("test_integrate"))
     return testSuite
 
 
@@ -0,0 +1,591 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: Fast Azimuthal integration
+#             https://github.com/kif/pyFAI
+#
+#
+#    Copyright (C) European Synchrotron Radiation Facility, Grenoble, France
+#
+#    Principal author:       Jérôme Kieffer (Jerome.Kieffer@ESRF.eu)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"test suite for look-up table based integrators"
+
+__author__ = "Jérôme Kieffer"
+__contact__ = "Jerome.Kieffer@ESRF.eu"
+__license__ = "GPLv3+"
+__copyright__ = "European Synchrotron Radiation Facility, Grenoble, France"
+__date__ = "16/10/2013"
+
+
+import unittest
+import numpy
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import time
+from utilstest import UtilsTest, getLogger
+logger = getLogger(__file__)
+pyFAI = sys.modules["pyFAI"]
+from pyFAI import splitBBoxLUT, splitBBox, splitPixel, units, lut_cache
+
+
+class TestCSR(unittest.TestCase):
+    """Compare the CSR storage with the dense look-up table"""
+    shape = (256, 300)
+    ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                   pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    data = numpy.random.random(shape).astype("float32") * 1000.0
+
+    def test_1d(self):
+        "CSR and LUT give the same 1D pattern"
+        lut = self.ai.setup_LUT(self.shape, 500, unit=units.TTH)
+        csr = self.ai.setup_LUT(self.shape, 500, unit=units.TTH, csr=True)
+        self.assert_(isinstance(csr, splitBBoxLUT.HistoBBox1dCSR))
+        self.assertEqual(csr.nnz, (lut.lut.coef > 0).sum(), "same number of contributions")
+        self.assertEqual(csr.lut_size, lut.lut_size)
+        ref = lut.integrate(self.data, dummy=0)
+        obt = csr.integrate(self.data, dummy=0)
+        for a, b in zip(ref, obt):
+            self.assert_(abs(a - b).max() == 0, "identical results")
+
+    def test_2d(self):
+        "CSR and LUT give the same 2D regrouping"
+        lut = self.ai.setup_LUT(self.shape, (100, 36), unit=units.TTH)
+        csr = self.ai.setup_LUT(self.shape, (100, 36), unit=units.TTH, csr=True)
+        self.assert_(isinstance(csr, splitBBoxLUT.HistoBBox2dCSR))
+        ref = lut.integrate(self.data, solidAngle=self.ai.solidAngleArray(self.shape))
+        obt = csr.integrate(self.data, solidAngle=self.ai.solidAngleArray(self.shape))
+        for a, b in zip(ref, obt):
+            self.assert_(abs(a - b).max() == 0, "identical results")
+
+    def test_integrate1d(self):
+        "integrate1d with method=csr"
+        ref = self.ai.integrate1d(self.data, 200, method="lut", unit="2th_deg")
+        obt = self.ai.integrate1d(self.data, 200, method="csr", unit="2th_deg")
+        self.assert_(isinstance(self.ai._lut_integrator, splitBBoxLUT.HistoBBox1dCSR), "integrator was reset")
+        self.assert_(abs(ref[0] - obt[0]).max() == 0, "same radial positions")
+        self.assert_(abs(ref[1] - obt[1]).max() == 0, "same intensities")
+
+    def test_integrate2d(self):
+        "integrate2d with method=csr"
+        ref = self.ai.integrate2d(self.data, 100, 36, method="lut", unit="2th_deg")
+        obt = self.ai.integrate2d(self.data, 100, 36, method="csr", unit="2th_deg")
+        self.assert_(isinstance(self.ai._lut_integrator, splitBBoxLUT.HistoBBox2dCSR), "CSR integrator used")
+        self.assertEqual(obt[0].dtype, numpy.float32, "not the numpy implementation")
+        for a, b in zip(ref, obt):
+            self.assert_(abs(a - b).max() == 0, "identical results")
+
+
+class TestParallelLUT(unittest.TestCase):
+    """The look-up table built in parallel is the same as the serial one"""
+    shape = (256, 300)
+    ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02, rot1=0.1,
+                                   pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    tth = ai.twoThetaArray(shape)
+    dtth = ai.delta2Theta(shape)
+    chi = ai.chiArray(shape)
+    dchi = ai.deltaChi(shape)
+    mask = numpy.zeros(shape, dtype="int8")
+    mask[100:120, 50:80] = 1
+
+    def test_1d(self):
+        "1D look-up tables are bit-identical whatever the number of threads"
+        for klass in (splitBBoxLUT.HistoBBox1d, splitBBoxLUT.HistoBBox1dCSR):
+            ref = klass(self.tth, self.dtth, bins=500, mask=self.mask, nthread=1)
+            for nthread in (3, 8):
+                obt = klass(self.tth, self.dtth, bins=500, mask=self.mask, nthread=nthread)
+                self.assertEqual(ref.lut_checksum, obt.lut_checksum, "%s with %s threads" % (klass.__name__, nthread))
+                self.assert_((ref.lut_max_idx == obt.lut_max_idx).all())
+
+    def test_2d(self):
+        "2D look-up tables are bit-identical whatever the number of threads"
+        for klass in (splitBBoxLUT.HistoBBox2d, splitBBoxLUT.HistoBBox2dCSR):
+            ref = klass(self.tth, self.dtth, self.chi, self.dchi, bins=(100, 36), nthread=1)
+            for nthread in (3, 8):
+                obt = klass(self.tth, self.dtth, self.chi, self.dchi, bins=(100, 36), nthread=nthread)
+                self.assertEqual(ref.lut_checksum, obt.lut_checksum, "%s with %s threads" % (klass.__name__, nthread))
+
+
+class TestLUTCache(unittest.TestCase):
+    """Persistent cache of look-up tables"""
+    shape = (256, 300)
+    data = numpy.random.random(shape).astype("float32") * 1000.0
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="pyFAI_lut_cache_")
+        self.ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                            pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        self.ai.lut_cache = lut_cache.LUTCache(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_reload(self):
+        "a look-up table read back from the cache gives the same result"
+        for nbPt, csr in ((500, False), (500, True), ((100, 36), False), ((100, 36), True)):
+            ref = self.ai.setup_LUT(self.shape, nbPt, unit=units.Q, pos0_range=(1, 20), csr=csr)
+            ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                           pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+            ai.lut_cache = lut_cache.LUTCache(self.tmpdir)
+            obt = ai.setup_LUT(self.shape, nbPt, unit=units.Q, pos0_range=(1, 20), csr=csr)
+            self.assert_("cpos0" not in dir(obt), "integrator comes from the cache")
+            self.assertEqual(obt.__class__, ref.__class__)
+            self.assertEqual(obt.lut_checksum, ref.lut_checksum)
+            self.assertEqual(obt.unit, units.Q)
+            self.assertEqual(obt.pos0Range, ref.pos0Range)
+            for a, b in zip(ref.integrate(self.data), obt.integrate(self.data)):
+                self.assert_(abs(a - b).max() == 0, "same result")
+        self.assertEqual(len(self.ai.lut_cache.entries()), 4)
+
+    def test_key(self):
+        "the key depends on the geometry, the unit and the mask"
+        ref = self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH)
+        self.assertEqual(ref, self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH))
+        self.assertNotEqual(ref, self.ai._lut_cache_key(self.shape, 500, 1234, None, None, units.TTH))
+        self.assertNotEqual(ref, self.ai._lut_cache_key(self.shape, 500, None, None, None, units.Q))
+        self.ai.wavelength = 2e-10
+        self.assertEqual(ref, self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH), "2theta does not depend on the wavelength")
+        self.ai.rot1 = 0.1
+        self.assertNotEqual(ref, self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH))
+        self.ai.set_dtype(numpy.float64)
+        self.assertNotEqual(ref, self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH), "precision of the positions")
+
+    def test_key_spline(self):
+        "the key depends on the content of the spline file"
+        spline = os.path.join(self.tmpdir, "example.sp")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "example.sp"), spline)
+        self.ai.detector = pyFAI.detectors.FReLoN(spline)
+        ref = self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH)
+        self.assertEqual(ref, self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH))
+        with open(spline, "a") as f:
+            f.write(os.linesep)
+        self.assertNotEqual(ref, self.ai._lut_cache_key(self.shape, 500, None, None, None, units.TTH))
+
+    def test_spline(self):
+        "the look-up table of a detector with a spline file is cached"
+        spline = os.path.join(os.path.dirname(__file__), "example.sp")
+        self.ai.detector = pyFAI.detectors.FReLoN(spline)
+        ref = self.ai.setup_LUT(self.shape, 500)
+        ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02, wavelength=1e-10,
+                                       detector=pyFAI.detectors.FReLoN(spline))
+        ai.lut_cache = lut_cache.LUTCache(self.tmpdir)
+        obt = ai.setup_LUT(self.shape, 500)
+        self.assert_("cpos0" not in dir(obt), "integrator comes from the cache")
+        self.assertEqual(obt.lut_checksum, ref.lut_checksum)
+        self.assertEqual(len(ai.lut_cache.entries()), 1)
+
+    def test_eviction(self):
+        "least recently used entries are removed when the cache is full"
+        self.ai.setup_LUT(self.shape, 100)
+        size = self.ai.lut_cache.size()
+        self.ai.lut_cache.max_size = int(2.5 * size)
+        self.ai.setup_LUT(self.shape, 101)
+        first = self.ai._lut_cache_key(self.shape, 100, None, None, None, units.TTH)
+        later = time.time() + 10
+        os.utime(os.path.join(self.tmpdir, first), (later, later))
+        self.ai.setup_LUT(self.shape, 102)
+        keys = [i[2] for i in self.ai.lut_cache.entries()]
+        self.assertEqual(len(keys), 2)
+        self.assert_(first in keys, "recently used entry is kept")
+
+
+class TestIntegratorCache(unittest.TestCase):
+    """In-memory cache of look-up table integrators"""
+    shape = (256, 300)
+    data = numpy.random.random(shape).astype("float32") * 1000.0
+
+    def test_interleave(self):
+        "alternating 1D/2D integrations in different units does not rebuild the look-up tables"
+        ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                       pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        ai.lut_cache = None
+        for i in range(3):
+            ai.integrate1d(self.data, 100, unit="q_nm^-1", method="lut")
+            ai.integrate2d(self.data, 100, 36, unit="2th_deg", method="lut")
+            ai.integrate1d(self.data, 100, unit="2th_deg", method="lut", radial_range=(1, 10))
+        self.assertEqual(ai._lut_integrators.misses, 3)
+        self.assertEqual(ai._lut_integrators.hits, 6)
+        self.assertEqual(len(ai._lut_integrators), 3)
+        ai.integrate1d(self.data, 100, unit="q_nm^-1", method="lut", safe=False)
+        self.assertEqual(ai._lut_integrators.hits, 7)
+        mask = numpy.zeros(self.shape, dtype="int8")
+        mask[10:20] = 1
+        ai.integrate1d(self.data, 100, unit="q_nm^-1", method="lut", mask=mask)
+        self.assertEqual(ai._lut_integrators.misses, 4, "mask changed")
+        ai.rot1 = 0.1
+        self.assertEqual(len(ai._lut_integrators), 0, "geometry change empties the cache")
+
+    def test_wavelength(self):
+        "a change of wavelength only drops the look-up tables in q"
+        ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                       pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        ai.lut_cache = None
+        ai.integrate1d(self.data, 100, unit="q_nm^-1", method="lut")
+        ai.integrate1d(self.data, 100, unit="2th_deg", method="lut")
+        self.assertEqual(len(ai._lut_integrators), 2)
+        ai.wavelength = 1e-10
+        self.assertEqual(len(ai._lut_integrators), 2, "unchanged wavelength")
+        ai.wavelength = 2e-10
+        self.assertEqual(len(ai._lut_integrators), 1, "q look-up table dropped")
+        ai.integrate1d(self.data, 100, unit="2th_deg", method="lut")
+        self.assertEqual(ai._lut_integrators.misses, 2)
+        q, I = ai.integrate1d(self.data, 100, unit="q_nm^-1", method="lut")
+        self.assertEqual(ai._lut_integrators.misses, 3)
+        ref = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                        pixel1=1e-4, pixel2=1e-4, wavelength=2e-10)
+        qref, Iref = ref.integrate1d(self.data, 100, unit="q_nm^-1", method="lut")
+        self.assert_(abs(q - qref).max() < 1e-6, "q rebuilt for the new wavelength")
+
+    def test_budget(self):
+        "least recently used integrators are evicted"
+        ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                       pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        ai.lut_cache = None
+        ai._lut_integrators = lut_cache.IntegratorCache(max_entries=2)
+        for npt in (100, 200, 100, 300):
+            ai.integrate1d(self.data, npt, unit="2th_deg", method="lut")
+        self.assertEqual(len(ai._lut_integrators), 2)
+        self.assertEqual(ai._lut_integrators.hits, 1)
+        ai.integrate1d(self.data, 100, unit="2th_deg", method="lut")
+        self.assertEqual(ai._lut_integrators.hits, 2, "100 was used more recently than 200")
+        size = ai._lut_integrators.nbytes
+        ai._lut_integrators.max_size = size // 2
+        ai.integrate1d(self.data, 200, unit="2th_deg", method="lut")
+        self.assertEqual(len(ai._lut_integrators), 1, "memory budget")
+
+
+class TestStack(unittest.TestCase):
+    """Integration of a stack of frames at once"""
+    shape = (256, 300)
+    ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                   pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    frames = numpy.random.random((5,) + shape).astype("float32") * 1000.0
+    frames[:, 100, 100] = -1
+
+    def test_1d(self):
+        "integrate1d_stack is the same as integrate1d on each frame"
+        for method in ("lut", "csr"):
+            # a generator and small blocks to test the iteration
+            q, I = self.ai.integrate1d_stack((i for i in self.frames), 200, dummy=-1,
+                                             method=method, block_size=2)
+            self.assertEqual(I.shape, (5, 200))
+            for i, data in enumerate(self.frames):
+                ref = self.ai.integrate1d(data, 200, dummy=-1, method=method)
+                self.assert_(abs(ref[0] - q).max() == 0, "same radial position")
+                self.assert_(abs(ref[1] - I[i]).max() == 0, "same intensity for frame %s" % i)
+
+    def test_2d(self):
+        "integrate2d_stack is the same as integrate2d on each frame"
+        I, rad, azim = self.ai.integrate2d_stack(self.frames, 100, 36, unit="2th_deg")
+        self.assertEqual(I.shape, (5, 36, 100))
+        for i, data in enumerate(self.frames):
+            ref = self.ai.integrate2d(data, 100, 36, method="lut", unit="2th_deg")
+            self.assert_(abs(ref[1] - rad).max() == 0, "same radial position")
+            self.assert_(abs(ref[2] - azim).max() == 0, "same azimuthal position")
+            self.assert_(abs(ref[0] - I[i]).max() == 0, "same intensity for frame %s" % i)
+
+
+class TestFused(unittest.TestCase):
+    """Corrections applied within the look-up table product"""
+    shape = (256, 300)
+    ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                   pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    data = numpy.random.random(shape).astype("float32") * 1000.0
+    data[100, 100] = -1
+    dark = numpy.random.random(shape).astype("float32")
+    flat = 1.0 + numpy.random.random(shape).astype("float32")
+
+    def test_integrators(self):
+        "fused and preprocessed integrations are the same"
+        kwarg = {"dummy":-1, "dark": self.dark, "flat": self.flat,
+                 "solidAngle": self.ai.solidAngleArray(self.shape),
+                 "polarization": self.ai.polarization(self.shape, 0.95)}
+        for nbPt in (200, (100, 36)):
+            for csr in (False, True):
+                integrator = self.ai.setup_LUT(self.shape, nbPt, unit=units.TTH, csr=csr)
+                ref = integrator.integrate(self.data, **kwarg)
+                obt = integrator.integrate(self.data, fused=True, **kwarg)
+                for a, b in zip(ref, obt):
+                    self.assertEqual(a.shape, b.shape)
+                    self.assert_(abs(a - b).max() <= 1e-5 * abs(a).max(), "same result for %s, csr=%s" % (nbPt, csr))
+
+    def test_integrate1d(self):
+        "integrate1d with method=lut_fused"
+        ref = self.ai.integrate1d(self.data, 200, dummy=-1, method="lut", unit="2th_deg")
+        obt = self.ai.integrate1d(self.data, 200, dummy=-1, method="lut_fused", unit="2th_deg")
+        # a single correction: bit-identical
+        self.assert_(abs(ref[1] - obt[1]).max() == 0, "identical results")
+
+
+class TestVariance(unittest.TestCase):
+    """Signal and variance accumulated in a single pass"""
+    shape = (256, 300)
+    ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                   pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    data = numpy.random.random(shape).astype("float32") * 1000.0
+    variance = numpy.random.random(shape).astype("float32") * 100.0
+
+    def test_integrators(self):
+        "same as integrating the variance in a second pass"
+        solidangle = self.ai.solidAngleArray(self.shape)
+        for csr in (False, True):
+            for nbPt in (200, (100, 36)):
+                integrator = self.ai.setup_LUT(self.shape, nbPt, unit=units.TTH, csr=csr)
+                for fused in (False, True):
+                    res = integrator.integrate(self.data, solidAngle=solidangle, fused=fused, variance=self.variance)
+                    ref = integrator.integrate(self.data, solidAngle=solidangle, fused=fused)
+                    var = integrator.integrate(self.variance)
+                    self.assertEqual(len(res), len(ref) + 1)
+                    for a, b in zip(res, ref):
+                        self.assert_(abs(a - b).max() == 0, "same signal")
+                    if len(ref) == 4:  # 1D
+                        self.assert_(abs(res[-1] - var[2]).max() == 0, "same variance")
+                    else:
+                        self.assert_(abs(res[-1] - var[3]).max() == 0, "same variance")
+
+    def test_histograms(self):
+        "splitBBox and splitPixel"
+        tth = self.ai.twoThetaArray(self.shape)
+        dtth = self.ai.delta2Theta(self.shape)
+        res = splitBBox.histoBBox1d(self.data, tth, dtth, bins=200, variance=self.variance)
+        var = splitBBox.histoBBox1d(self.variance, tth, dtth, bins=200)
+        self.assertEqual(len(res), 5)
+        self.assert_(abs(res[-1] - var[2]).max() == 0, "same variance with splitBBox")
+        pos = self.ai.cornerArray(self.shape)
+        res = splitPixel.fullSplit1D(pos, self.data, bins=200, variance=self.variance)
+        var = splitPixel.fullSplit1D(pos, self.variance, bins=200)
+        self.assertEqual(len(res), 5)
+        self.assert_(abs(res[-1] - var[2]).max() == 0, "same variance with splitPixel")
+
+    def test_integrate1d(self):
+        "poisson error model in integrate1d"
+        for method in ("lut", "csr", "splitbbox", "splitpixel"):
+            q, I, sigma = self.ai.integrate1d(self.data, 200, error_model="poisson",
+                                              method=method, unit="2th_deg")
+            ref = self.ai.integrate1d(self.data, 200, method=method, unit="2th_deg")
+            self.assert_(abs(ref[1] - I).max() == 0, "same signal with %s" % method)
+            self.assert_(numpy.isfinite(sigma).all() and (sigma.max() > 0), "errors with %s" % method)
+
+
+class TestNative(unittest.TestCase):
+    """Integer images are integrated without conversion to float32"""
+    shape = (256, 300)
+    ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                   pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    raw = (numpy.random.random(shape) * 1000).astype("int32")
+
+    def test_types(self):
+        "uint16, int32, float64 and int64 give the same as float32"
+        solidangle = self.ai.solidAngleArray(self.shape)
+        ref32 = self.raw.astype("float32")
+        for csr in (False, True):
+            integrator = self.ai.setup_LUT(self.shape, 200, unit=units.TTH, csr=csr)
+            for kwarg in ({}, {"dummy": 5}, {"dummy": 5, "solidAngle": solidangle}):
+                ref = integrator.integrate(ref32, **kwarg)
+                for dtype in ("uint16", "int32", "float64", "int64"):
+                    obt = integrator.integrate(self.raw.astype(dtype), **kwarg)
+                    for a, b in zip(ref, obt):
+                        self.assert_(abs(a - b).max() == 0, "same result for %s, csr=%s" % (dtype, csr))
+
+    def test_preprocess(self):
+        "typed preprocessing"
+        dark = numpy.random.random(self.shape).astype("float32")
+        ref = splitBBoxLUT.preprocess(self.raw.astype("float32"), dummy=5, dark=dark)
+        for dtype in ("uint16", "int32", "float64", "int64"):
+            obt = splitBBoxLUT.preprocess(self.raw.astype(dtype), dummy=5, dark=dark)
+            self.assertEqual(obt.dtype, numpy.float32)
+            self.assert_(abs(ref - obt).max() == 0, "same result for %s" % dtype)
+
+
+class TestOutput(unittest.TestCase):
+    """Results written into caller-provided buffers"""
+    shape = (256, 300)
+    ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                   pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+    frames = numpy.random.random((3,) + shape).astype("float32") * 1000.0
+
+    def test_integrators(self):
+        "the pattern is the output buffer"
+        data = self.frames[0]
+        for csr in (False, True):
+            for nbPt in (200, (100, 36)):
+                integrator = self.ai.setup_LUT(self.shape, nbPt, unit=units.TTH, csr=csr)
+                for fused in (False, True):
+                    ref = integrator.integrate(data, fused=fused)
+                    if nbPt == 200:
+                        out = numpy.empty(200, dtype=numpy.float32)
+                        obt = integrator.integrate(data, fused=fused, out=out)
+                        self.assert_(obt[1] is out, "1D pattern written in place")
+                        self.assert_(abs(ref[1] - out).max() == 0, "same 1D pattern")
+                    else:
+                        out = numpy.empty((36, 100), dtype=numpy.float32)
+                        obt = integrator.integrate(data, fused=fused, out=out)
+                        self.assert_(obt[0] is out, "2D pattern written in place")
+                        self.assert_(abs(ref[0] - out).max() == 0, "same 2D pattern")
+                self.assertRaises(ValueError, integrator.integrate, data, out=numpy.empty(7, dtype=numpy.float32))
+
+    def test_integrate1d(self):
+        "integrate1d and integrate1d_stack fill the buffers"
+        for method, dtype in (("lut", "float32"), ("csr", "float32"), ("splitbbox", "float32"), ("splitpixel", "float64")):
+            ref = self.ai.integrate1d(self.frames[0], 200, error_model="poisson", method=method)
+            out = numpy.zeros((3, 200), dtype=dtype)
+            out_sigma = numpy.zeros(200)
+            obt = self.ai.integrate1d(self.frames[0], 200, error_model="poisson", method=method,
+                                      out=out[1], out_sigma=out_sigma)
+            self.assert_(obt[1] is out[1] or obt[1].base is out, "filled directly with %s" % method)
+            self.assert_(abs(ref[1] - out[1]).max() == 0, "same intensity with %s" % method)
+            self.assert_(abs(ref[2] - out_sigma).max() == 0, "same error with %s" % method)
+            self.assert_(obt[2] is out_sigma)
+        for dtype in ("float32", "float64"):
+            out = numpy.zeros((3, 200), dtype=dtype)
+            q, I = self.ai.integrate1d_stack(self.frames, 200, method="csr", block_size=2, out=out)
+            self.assert_(I is out)
+            for i, data in enumerate(self.frames):
+                ref = self.ai.integrate1d(data, 200, method="csr")
+                self.assert_(abs(ref[1] - out[i]).max() == 0, "same intensity for frame %s" % i)
+
+    def test_integrate2d(self):
+        "integrate2d and integrate2d_stack fill the buffers"
+        for method, dtype in (("lut", "float32"), ("lut_fused", "float32"),
+                              ("csr", "float32"), ("csr_fused", "float32"),
+                              ("splitbbox", "float32"), ("splitpixel", "float64")):
+            ref = self.ai.integrate2d(self.frames[0], 100, 36, method=method)
+            out = numpy.zeros((36, 100), dtype=dtype)
+            obt = self.ai.integrate2d(self.frames[0], 100, 36, method=method, out=out)
+            self.assert_(obt[0] is out, "filled directly with %s" % method)
+            self.assert_(abs(ref[0] - out).max() == 0, "same 2D pattern with %s" % method)
+        for method in ("lut", "lut_fused", "csr", "csr_fused"):
+            ref = self.ai.integrate2d(self.frames[0], 100, 36, error_model="poisson", method=method)
+            out_sigma = numpy.zeros((36, 100))
+            obt = self.ai.integrate2d(self.frames[0], 100, 36, error_model="poisson", method=method,
+                                      out_sigma=out_sigma)
+            self.assert_(obt[3] is out_sigma)
+            self.assert_(abs(ref[3] - out_sigma).max() == 0, "same error with %s" % method)
+        out = numpy.zeros((3, 36, 100), dtype=numpy.float32)
+        I, rad, azim = self.ai.integrate2d_stack(self.frames, 100, 36, block_size=2, out=out)
+        self.assert_(I is out)
+        for i, data in enumerate(self.frames):
+            ref = self.ai.integrate2d(data, 100, 36, method="lut")
+            self.assert_(abs(ref[0] - out[i]).max() == 0, "same 2D pattern for frame %s" % i)
+
+
+class TestThreads(unittest.TestCase):
+    """Several threads integrating with the same AzimuthalIntegrator"""
+    shape = (256, 300)
+    frames = numpy.random.random((8,) + shape).astype("float32") * 1000.0
+
+    def test_concurrent(self):
+        "same results as sequential integrations, look-up tables built once"
+        ai = pyFAI.AzimuthalIntegrator(dist=0.1, poni1=0.01, poni2=0.02,
+                                       pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        ref = [ai.integrate1d(data, 200, method="csr")[1] for data in self.frames]
+        ai.reset()
+        result = [None] * len(self.frames)
+        errors = []
+
+        def worker(i):
+            try:
+                result[i] = ai.integrate1d(self.frames[i], 200, method="csr")[1]
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(self.frames))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(ai._lut_integrators), 1, "a single look-up table was built")
+        for i in range(len(self.frames)):
+            self.assert_(abs(ref[i] - result[i]).max() == 0, "same result for frame %s" % i)
+
+
+class TestExport(unittest.TestCase):
+    """Geometry arrays and integrators shared through a directory"""
+    shape = (256, 300)
+    data = numpy.random.random(shape).astype("float32") * 1000.0
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="pyFAI_export_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_attach(self):
+        "attached process uses the exported arrays and look-up tables"
+        kwds = dict(dist=0.1, poni1=0.01, poni2=0.02, pixel1=1e-4, pixel2=1e-4, wavelength=1e-10)
+        ai = pyFAI.AzimuthalIntegrator(**kwds)
+        ai.lut_cache = None
+        ref1d = ai.integrate1d(self.data, 200, method="csr", unit="q_nm^-1", polarization_factor=0.9)
+        ref2d = ai.integrate2d(self.data, 100, 36, method="lut")
+        ai.export(self.tmpdir)
+        other = pyFAI.AzimuthalIntegrator(**kwds)
+        other.lut_cache = None
+        self.assert_(other.attach(self.tmpdir), "attached")
+        self.assert_(isinstance(other._dssa, numpy.memmap), "memory-mapped solid angle")
+        self.assertEqual(len(other._lut_integrators), 2)
+        self.assertEqual(other._polarization[0], ai._polarization[0], "same polarization key")
+        self.assertEqual(other._polarization[2], ai._polarization[2], "same polarization checksum")
+        res1d = other.integrate1d(self.data, 200, method="csr", unit="q_nm^-1", polarization_factor=0.9)
+        res2d = other.integrate2d(self.data, 100, 36, method="lut")
+        self.assertEqual(other._lut_integrators.misses, 0, "no look-up table built")
+        for a, b in zip(ref1d, res1d):
+            self.assert_(abs(a - b).max() == 0, "same 1D result")
+        for a, b in zip(ref2d, res2d):
+            self.assert_(abs(a - b).max() == 0, "same 2D result")
+        kwds["dist"] = 0.2
+        self.assertFalse(pyFAI.AzimuthalIntegrator(**kwds).attach(self.tmpdir), "other geometry")
+
+
+def test_suite_all_LUT():
+    testSuite = unittest.TestSuite()
+    testSuite.addTest(TestCSR("test_1d"))
+    testSuite.addTest(TestCSR("test_2d"))
+    testSuite.addTest(TestCSR("test_integrate1d"))
+    testSuite.addTest(TestCSR("test_integrate2d"))
+    testSuite.addTest(TestParallelLUT("test_1d"))
+    testSuite.addTest(TestParallelLUT("test_2d"))
+    testSuite.addTest(TestLUTCache("test_reload"))
+    testSuite.addTest(TestLUTCache("test_key"))
+    testSuite.addTest(TestLUTCache("test_key_spline"))
+    testSuite.addTest(TestLUTCache("test_spline"))
+    testSuite.addTest(TestLUTCache("test_eviction"))
+    testSuite.addTest(TestIntegratorCache("test_interleave"))
+    testSuite.addTest(TestIntegratorCache("test_wavelength"))
+    testSuite.addTest(TestIntegratorCache("test_budget"))
+    testSuite.addTest(TestStack("test_1d"))
+    testSuite.addTest(TestStack("test_2d"))
+    testSuite.addTest(TestFused("test_integrators"))
+    testSuite.addTest(TestFused("test_integrate1d"))
+    testSuite.addTest(TestVariance("test_integrators"))
+    testSuite.addTest(TestVariance("test_histograms"))
+    testSuite.addTest(TestVariance("test_integrate1d"))
+    testSuite.addTest(TestNative("test_types"))
+    testSuite.addTest(TestNative("test_preprocess"))
+    testSuite.addTest(TestOutput("test_integrators"))
+    testSuite.addTest(TestOutput("test_integrate1d"))
+    testSuite.addTest(TestOutput("test_integrate2d"))
+    testSuite.addTest(TestThreads("test_concurrent"))
+    testSuite.addTest(TestExport("test_attach"))
+    return testSuite
+
+if __name__ == '__main__':
+    mysuite = test_suite_all_LUT()
+    runner = unittest.TextTestRunner()
+    if not runner.run(mysuite).wasSuccessful():
+        sys.exit(1)
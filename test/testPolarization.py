@@ -36,6 +36,7 @@ import os
 import numpy
 import logging, time
 import sys
+import threading
 import fabio
 from utilstest import UtilsTest, Rwp, getLogger
 logger = getLogger(__file__)
@@ -84,6 +85,47 @@ class TestPolarization(unittest.TestCase):
         self.assert_(abs(self.ai.polarization(factor=1, axis_offset=numpy.pi / 2)[6] - numpy.ones(13)).max() == 0, "No correction in the horizontal plane")
         self.assert_(abs(self.ai.polarization(factor=1, axis_offset=numpy.pi / 2)[:, 6] - (numpy.cos((2 * self.rotX)) + 1) / 2).max() < 1e-15, "cos(2th)^2 like in the verical plane")
 
+    def testCache(self):
+        "polarization arrays and their checksum are kept for several factors"
+        ai = pyFAI.AzimuthalIntegrator(dist=0.1, pixel1=1e-4, pixel2=1e-4)
+        shape = (50, 60)
+        pol1 = ai.polarization(shape, factor=0.95)
+        key1, _, crc1 = ai._polarization
+        self.assertEqual(key1, (shape, 0.95, 0))
+        pol2 = ai.polarization(shape, factor=0.5, axis_offset=0.1)
+        key2, array2, crc2 = ai._polarization
+        self.assert_(array2 is pol2, "last entry follows the array returned")
+        self.assert_(crc2 != crc1, "checksum follows the array returned")
+        self.assert_(ai.polarization(shape, factor=0.95) is pol1, "array reused")
+        self.assertEqual(ai._polarization, (key1, pol1, crc1))
+        self.assert_(ai.polarization(shape, factor=0.5, axis_offset=0.1) is pol2, "array reused")
+        tth = ai.twoThetaArray(shape)
+        chi = ai.chiArray(shape)
+        ref = (1 + numpy.cos(tth) ** 2 - 0.5 * numpy.cos(2 * (chi + 0.1)) * (1 - numpy.cos(tth) ** 2)) / 2
+        self.assert_(abs(pol2 - ref).max() < 1e-6, "same as the direct formula")
+        ai.rot1 = 0.1
+        self.assert_(ai.polarization(shape, factor=0.95) is not pol1, "cache dropped when the geometry changes")
+
+    def testThreads(self):
+        "concurrent calls with different factors get the array of their own factor"
+        ai = pyFAI.AzimuthalIntegrator(dist=0.1, pixel1=1e-4, pixel2=1e-4)
+        shape = (50, 60)
+        factors = (0.95, 0.5, -0.3)
+        refs = dict((f, ai.polarization(shape, factor=f)) for f in factors)
+        errors = []
+
+        def run(offset):
+            for i in range(300):
+                factor = factors[(i + offset) % len(factors)]
+                if ai.polarization(shape, factor=factor) is not refs[factor]:
+                    errors.append(factor)
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
 
 def test_suite_all_Polarization():
     testSuite = unittest.TestSuite()
@@ -92,6 +134,8 @@ def test_suite_all_Polarization():
     testSuite.addTest(TestPolarization("testHorizPol"))
     testSuite.addTest(TestPolarization("testVertPol"))
     testSuite.addTest(TestPolarization("testoffsetPol"))
+    testSuite.addTest(TestPolarization("testCache"))
+    testSuite.addTest(TestPolarization("testThreads"))
 #    testSuite.addTest(TestPolarization("test2th"))
 
     return testSuite
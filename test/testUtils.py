@@ -34,6 +34,9 @@ import unittest
 import numpy
 import logging
 import sys
+import os
+import shutil
+import tempfile
 import fabio
 from utilstest import UtilsTest, getLogger
 logger = getLogger(__file__)
@@ -64,8 +67,12 @@ class test_utils(unittest.TestCase):
     flat = 1 + numpy.random.random((64, 32))
     raw = flat + dark
     def setUp(self):
-        """Download files"""
-        pass
+        """Create a temporary directory for the output files"""
+        self.tmpdir = tempfile.mkdtemp(prefix="pyFAI_utils_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
     def test_binning(self):
         """
         test the binning and unbinning functions
@@ -98,7 +105,8 @@ class test_utils(unittest.TestCase):
         six = pyFAI.utils.averageDark([numpy.ones_like(self.dark), self.dark, numpy.zeros_like(self.dark), self.dark, self.dark ], "median", .001)
         self.assert_(abs(self.dark - six).max() < 1e-4, "data are the same: test threshold")
 
-        seven = pyFAI.utils.averageImages([self.raw], darks=[self.dark], flats=[self.flat], threshold=0)
+        seven = pyFAI.utils.averageImages([self.raw], darks=[self.dark], flats=[self.flat], threshold=0,
+                                          output=os.path.join(self.tmpdir, "merged.edf"))
         self.assert_(abs(numpy.ones_like(self.dark) - fabio.open(seven).data).mean() < 1e-2, "averageImages")
 
     def test_shift(self):